@@ -9,11 +9,11 @@ Per avviare il bot: python bot.py
 
 import logging
 import asyncio
-import threading
+import functools
+import tempfile
 from datetime import datetime
-from aiohttp import web
-import stripe
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import (
     Application, 
     CommandHandler, 
@@ -29,27 +29,54 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from config import (
     BOT_TOKEN, LINKS, CHANNEL_LINKS, GROUP_LINKS, MESSAGES, 
     RENEWAL_REMINDER_DAYS, STAFF_ADMIN_CHAT_ID,
-    GROUP_IDS, CHANNEL_IDS, STRIPE_WEBHOOK_SECRET,
+    GROUP_IDS, CHANNEL_IDS,
     ADMIN_LINKS, SUPER_ADMIN_IDS, CONSENT_DOCUMENT_VERSION,
-    OTP_VALIDITY_MINUTES, DATA_CONTROLLER_NAME, DATA_CONTROLLER_EMAIL
+    OTP_VALIDITY_MINUTES, DATA_CONTROLLER_NAME, DATA_CONTROLLER_EMAIL,
+    MAX_CONCURRENT_UPDATES, PERSISTENCE_UPDATE_INTERVAL, PERSISTENCE_FLUSH_DELAY,
+    JOIN_REQUEST_BATCH_WINDOW, JOIN_REQUEST_MAX_BATCH, JOIN_REQUEST_CONCURRENCY,
+    TELEGRAM_RATE_LIMIT, EXPIRING_JOB_SHARDS, EXPIRING_JOB_WINDOW_MINUTES,
+    EXPIRED_JOB_SHARDS, EXPIRED_JOB_WINDOW_MINUTES, LEADER_LOCK_ID, LEADER_RENEW_SECONDS,
+    WEBHOOK_PORT, CHECKOUT_TIMEOUT, RECONCILE_HOUR, TIMEZONE
 )
 
 SUPPORT_BOT_USERNAME = "@ORSupportoTecnicoBot"
 SUPPORT_BOT_LINK = "https://t.me/ORSupportoTecnicoBot"
 STAFF_ADMIN_GROUP_ID = -3379647913
+# Dimensione massima di un file inviato da un bot (limite della Bot API)
+TELEGRAM_MAX_UPLOAD_BYTES = 50 * 1024 * 1024
 
 from database import (
     init_db, add_user, get_user, is_subscribed, get_subscription_info,
-    activate_subscription, get_expiring_subscriptions, get_expired_subscriptions,
+    get_expiring_subscriptions, get_expired_subscriptions,
     deactivate_subscription, create_ticket, get_open_tickets, close_ticket,
-    get_stats, log_activity,
+    get_stats, log_activity, get_revenue_report,
     is_approved, set_pending, approve_user, reject_user, get_pending_users,
-    get_user_by_username, can_access_groups, can_subscribe,
+    get_user_by_username, can_subscribe,
     is_admin, is_super_admin, add_admin, remove_admin, get_all_admins, get_admin_ids,
     create_consent_record, verify_otp, get_user_consent, has_valid_consent,
-    get_pending_consent, regenerate_otp, get_consent_stats
+    get_pending_consent, regenerate_otp, get_consent_stats, user_status_from_row,
+    claim_notifications, release_notification, NOTIFICATION_EXPIRING_REMINDER, close_pool,
+    log_otp_event
 )
-from payments import create_checkout_session, get_customer_portal_url
+from payments import get_checkout_url, get_customer_portal_url
+from update_processor import PerUserUpdateProcessor
+from persistence import PostgresPersistence
+from join_requests import JoinRequestQueue
+from callback_tasks import run_deferred
+from sharded_jobs import ShardedJob
+from leader import LeaderElection
+from webhook import start_server as start_webhook_server
+import stripe_client
+from stripe_client import warm_up as warm_up_stripe
+from reconcile import reconcile_subscriptions, format_report
+from gdpr_export import write_export, export_filename, FORMATS as EXPORT_FORMATS
+from render_cache import edit_message
+from receipts import (
+    send_receipt, shutdown as shutdown_receipts, render_consent_document, DOCUMENT_DATE_FORMAT
+)
+import db_profiler
+from instrumentation import instrument_handlers, InstrumentedRequest
+from otp_store import otp_store, WRONG as OTP_WRONG, EXPIRED as OTP_EXPIRED, LOCKED as OTP_LOCKED
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -63,6 +90,20 @@ SUPPORT_CATEGORY, SUPPORT_DESCRIPTION = range(2)
  CONSENT_BIRTH_PLACE, CONSENT_RESIDENCE, CONSENT_REVIEW, 
  CONSENT_OTP_VERIFY) = range(10, 17)
 
+# Elezione del leader: solo una replica esegue i task schedulati
+leader = LeaderElection(LEADER_LOCK_ID, renew_interval=LEADER_RENEW_SECONDS)
+
+# Coda delle richieste di accesso ai gruppi (decise in blocco)
+join_request_queue = JoinRequestQueue(
+    window=JOIN_REQUEST_BATCH_WINDOW,
+    max_batch=JOIN_REQUEST_MAX_BATCH,
+    concurrency=JOIN_REQUEST_CONCURRENCY,
+    rate_per_second=TELEGRAM_RATE_LIMIT,
+)
+
+# Server webhook Stripe (aiohttp), avviato in on_startup
+webhook_runner = None
+
 
 def get_user_status(user_id: int) -> str:
     """Restituisce lo stato dell'utente."""
@@ -70,25 +111,12 @@ def get_user_status(user_id: int) -> str:
     if not user:
         return 'new'
     
-    status = user.get('subscription_status', 'inactive')
-    approved = user.get('approved', False)
-    consent_completed = user.get('consent_completed', False)
-    
-    if status == 'pending':
-        return 'pending'
-    if status == 'rejected':
-        return 'rejected'
+    # Il consenso in attesa serve solo per gli approvati senza consenso
+    has_pending_consent = False
+    if user.get('approved', False) and not user.get('consent_completed', False):
+        has_pending_consent = get_pending_consent(user_id) is not None
     
-    if approved:
-        if not consent_completed:
-            pending_consent = get_pending_consent(user_id)
-            if pending_consent:
-                return 'consent_pending_otp'
-            return 'awaiting_consent'
-        if is_subscribed(user_id):
-            return 'subscribed'
-        return 'approved_not_subscribed'
-    return 'new'
+    return user_status_from_row(user, has_pending_consent)
 
 
 def get_main_keyboard(user_status: str, user_id: int = None) -> InlineKeyboardMarkup:
@@ -242,7 +270,9 @@ async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        checkout_url = create_checkout_session(user.id)
+        checkout_url = await asyncio.wait_for(
+            asyncio.to_thread(get_checkout_url, user.id), CHECKOUT_TIMEOUT
+        )
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("💳 Vai al Pagamento", url=checkout_url)],
             [InlineKeyboardButton("❌ Annulla", callback_data='cancel')]
@@ -260,35 +290,13 @@ async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Gestisce le richieste di accesso ai gruppi privati."""
+    """
+    Gestisce le richieste di accesso ai gruppi privati.
+    Le richieste vengono accodate e decise in blocco (vedi join_requests.py).
+    """
     join_request = update.chat_join_request
-    user = join_request.from_user
-    chat = join_request.chat
-    
-    logger.info(f"Richiesta accesso {chat.title} da {user.id}")
-    
-    if can_access_groups(user.id):
-        await join_request.approve()
-        logger.info(f"Utente {user.id} approvato per {chat.title}")
-        try:
-            await context.bot.send_message(user.id, f"✅ *Accesso Approvato!*\n\nBenvenuto in *{chat.title}*!", parse_mode='Markdown')
-        except Exception as e:
-            logger.error(f"Errore notifica: {e}")
-    else:
-        await join_request.decline()
-        user_status = get_user_status(user.id)
-        reasons = {
-            'new': "Non hai ancora richiesto l'accesso. Scrivi /start al bot.",
-            'pending': "La tua richiesta è ancora in attesa di approvazione.",
-            'rejected': "La tua richiesta non è stata approvata.",
-            'awaiting_consent': "Devi completare il modulo di consenso. Scrivi /start.",
-            'consent_pending_otp': "Devi confermare il consenso con OTP. Scrivi /start.",
-            'approved_not_subscribed': "Devi completare l'abbonamento. Scrivi /start."
-        }
-        try:
-            await context.bot.send_message(user.id, f"❌ *Accesso Negato*\n\n{reasons.get(user_status, 'Scrivi /start per info.')}", parse_mode='Markdown')
-        except Exception as e:
-            logger.error(f"Errore notifica rifiuto: {e}")
+    logger.info(f"Richiesta accesso {join_request.chat.title} da {join_request.from_user.id}")
+    join_request_queue.enqueue(join_request)
 
 
 # =============================================================================
@@ -302,11 +310,11 @@ async def consent_start_callback(update: Update, context: ContextTypes.DEFAULT_T
     user = update.effective_user
     
     if not is_approved(user.id):
-        await query.edit_message_text("❌ Devi prima essere approvato.")
+        await edit_message(query, "❌ Devi prima essere approvato.")
         return ConversationHandler.END
     
     if has_valid_consent(user.id):
-        await query.edit_message_text("✅ Hai già completato il consenso! Usa /start per procedere.")
+        await edit_message(query, "✅ Hai già completato il consenso! Usa /start per procedere.")
         return ConversationHandler.END
     
     intro_text = MESSAGES['consent_intro']
@@ -315,7 +323,7 @@ async def consent_start_callback(update: Update, context: ContextTypes.DEFAULT_T
         [InlineKeyboardButton("📖 Leggi Documento", callback_data='consent_full_doc')],
         [InlineKeyboardButton("❌ Annulla", callback_data='back_to_menu')]
     ])
-    await query.edit_message_text(intro_text, parse_mode='Markdown', reply_markup=keyboard)
+    await edit_message(query, intro_text, parse_mode='Markdown', reply_markup=keyboard)
     return CONSENT_START
 
 
@@ -327,7 +335,7 @@ async def consent_begin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     text = "📝 *COMPILAZIONE MODULO*\n\n*Passaggio 1/5 - Nome e Cognome*\n\nInserisci il tuo *nome e cognome completo*.\n\n_Esempio: Mario Rossi_"
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Annulla", callback_data='cancel_consent')]])
-    await query.edit_message_text(text, parse_mode='Markdown', reply_markup=keyboard)
+    await edit_message(query, text, parse_mode='Markdown', reply_markup=keyboard)
     return CONSENT_FULL_NAME
 
 
@@ -412,12 +420,23 @@ async def consent_receive_residence(update: Update, context: ContextTypes.DEFAUL
     context.user_data['consent']['residence'] = residence
     consent_data = context.user_data['consent']
     
+    # Il documento mostrato è quello firmato: testo e data vengono fissati
+    # qui e create_consent_record ne salva l'hash senza rigenerarlo
+    consent_data['document_date'] = datetime.now().strftime(DOCUMENT_DATE_FORMAT)
+    consent_data['document'] = render_consent_document(
+        consent_data['full_name'],
+        datetime.strptime(consent_data['birth_date'], '%Y-%m-%d'),
+        consent_data['birth_place'],
+        consent_data['residence'],
+        consent_data['document_date'],
+    )
+    
     document_text = MESSAGES['consent_document'].format(
         full_name=consent_data['full_name'],
         birth_place=consent_data['birth_place'],
         birth_date=consent_data['birth_date_display'],
         residence=consent_data['residence'],
-        date=datetime.now().strftime('%d/%m/%Y %H:%M')
+        date=consent_data['document_date']
     )
     await update.message.reply_text(document_text, parse_mode='Markdown')
     
@@ -448,8 +467,12 @@ async def consent_confirm_send_otp(update: Update, context: ContextTypes.DEFAULT
     user = update.effective_user
     consent_data = context.user_data.get('consent', {})
     
-    if not consent_data:
-        await query.edit_message_text("❌ Errore: dati non trovati. Ricomincia con /start")
+    if not consent_data or not consent_data.get('document'):
+        await edit_message(query, "❌ Errore: dati non trovati. Ricomincia con /start")
+        return ConversationHandler.END
+    
+    if not otp_store.can_issue(user.id):
+        await edit_message(query, "⏳ Hai richiesto troppi codici. Riprova tra un'ora.")
         return ConversationHandler.END
     
     result = create_consent_record(
@@ -458,14 +481,17 @@ async def consent_confirm_send_otp(update: Update, context: ContextTypes.DEFAULT
         birth_date=consent_data['birth_date'],
         birth_place=consent_data['birth_place'],
         residence=consent_data['residence'],
+        document=consent_data['document'],
+        document_date=consent_data['document_date'],
         telegram_username=user.username
     )
     
     if not result['success']:
-        await query.edit_message_text(f"❌ Errore: {result.get('error', 'Sconosciuto')}. Riprova.")
+        await edit_message(query, f"❌ Errore: {result.get('error', 'Sconosciuto')}. Riprova.")
         return ConversationHandler.END
     
     otp_code = result['otp_code']
+    otp_store.issue(user.id, otp_code, result['expires_at'].timestamp())
     
     # Invia OTP in un messaggio separato
     await context.bot.send_message(
@@ -474,7 +500,7 @@ async def consent_confirm_send_otp(update: Update, context: ContextTypes.DEFAULT
         parse_mode='Markdown'
     )
     
-    await query.edit_message_text(
+    await edit_message(query, 
         "✅ *Codice OTP inviato!*\n\n"
         "Ti ho inviato un codice di 6 cifre.\n"
         "⏰ Hai 10 minuti e 5 tentativi.\n\n"
@@ -495,7 +521,21 @@ async def consent_verify_otp(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("⚠️ Il codice deve essere di 6 cifre. Riprova:")
         return CONSENT_OTP_VERIFY
     
-    result = verify_otp(user.id, otp_input)
+    # Tentativi sbagliati, scadenza e blocco gestiti in memoria: il database
+    # serve solo per il codice corretto (o sconosciuto a questa istanza)
+    check = otp_store.check(user.id, otp_input)
+    if check['status'] == OTP_WRONG:
+        result = {'success': False, 'error': f"Codice OTP errato. Tentativi rimanenti: {check['remaining']}"}
+    elif check['status'] == OTP_EXPIRED:
+        result = {'success': False, 'error': 'Codice OTP scaduto. Richiedi un nuovo codice.'}
+    elif check['status'] == OTP_LOCKED:
+        result = {'success': False, 'error': 'Troppi tentativi. Richiedi un nuovo codice.'}
+    else:
+        result = await asyncio.to_thread(verify_otp, user.id, otp_input)
+    
+    if check['final']:
+        action = 'verify_expired' if check['status'] == OTP_EXPIRED else 'verify_max_attempts'
+        await asyncio.to_thread(log_otp_event, user.id, action, False)
     
     if not result['success']:
         keyboard = InlineKeyboardMarkup([
@@ -514,35 +554,59 @@ async def consent_verify_otp(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("🔓 ABBONATI ORA", callback_data='subscribe')],
+        [InlineKeyboardButton("📄 Ricevuta Consenso", callback_data='consent_receipt')],
         [InlineKeyboardButton("🏠 Menu Principale", callback_data='back_to_menu')]
     ])
     
     await update.message.reply_text(confirmed_text, parse_mode='Markdown', reply_markup=keyboard)
     
+    # Ricevuta firmata generata e inviata in background
+    context.application.create_task(deliver_consent_receipt(context.bot, user.id), update=update)
+    
+    otp_store.clear(user.id)
     log_activity(user.id, 'consent_confirmed', f'Consenso #{result["consent_id"]} confermato')
     context.user_data.clear()
     return ConversationHandler.END
 
 
+async def deliver_consent_receipt(bot, user_id: int) -> bool:
+    """Invia all'utente la ricevuta del consenso confermato."""
+    try:
+        consent = await asyncio.to_thread(get_user_consent, user_id)
+        if not consent:
+            return False
+        await send_receipt(bot, user_id, consent)
+        return True
+    except Exception as e:
+        logger.error(f"Errore invio ricevuta consenso a {user_id}: {e}")
+        return False
+
+
 async def consent_resend_otp(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Rigenera OTP per consenso in corso."""
     query = update.callback_query
     await query.answer()
     user = update.effective_user
     
+    if not otp_store.can_issue(user.id):
+        await edit_message(query, "⏳ Hai richiesto troppi codici. Riprova tra un'ora.")
+        return CONSENT_OTP_VERIFY
+    
     result = regenerate_otp(user.id)
     
     if not result['success']:
-        await query.edit_message_text(f"❌ {result.get('error', 'Errore sconosciuto')}")
+        await edit_message(query, f"❌ {result.get('error', 'Errore sconosciuto')}")
         return CONSENT_OTP_VERIFY if query.data == 'resend_otp_conv' else ConversationHandler.END
     
+    otp_store.issue(user.id, result['otp_code'], result['expires_at'].timestamp())
+    
     await context.bot.send_message(
         chat_id=user.id,
         text=f"🔐 *NUOVO CODICE OTP*\n\n`{result['otp_code']}`\n\n⏰ Valido per 10 minuti.",
         parse_mode='Markdown'
     )
     
-    await query.edit_message_text("✅ Nuovo codice inviato! Inseriscilo qui sotto:", parse_mode='Markdown')
+    await edit_message(query, "✅ Nuovo codice inviato! Inseriscilo qui sotto:", parse_mode='Markdown')
     return CONSENT_OTP_VERIFY
 
 
@@ -551,7 +615,7 @@ async def cancel_consent(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     if query:
         await query.answer()
-        await query.edit_message_text("❌ Compilazione annullata. Usa /start quando vuoi riprendere.")
+        await edit_message(query, "❌ Compilazione annullata. Usa /start quando vuoi riprendere.")
     else:
         await update.message.reply_text("❌ Compilazione annullata. Usa /start quando vuoi riprendere.")
     context.user_data.clear()
@@ -566,23 +630,23 @@ async def consent_back_handlers(update: Update, context: ContextTypes.DEFAULT_TY
     if query.data == 'consent_back_name':
         context.user_data['consent'] = {}
         text = "📝 *Passaggio 1/5 - Nome e Cognome*\n\nInserisci il tuo *nome e cognome completo*.\n\n_Esempio: Mario Rossi_"
-        await query.edit_message_text(text, parse_mode='Markdown')
+        await edit_message(query, text, parse_mode='Markdown')
         return CONSENT_FULL_NAME
     
     elif query.data == 'consent_back_date':
         text = "📝 *Passaggio 2/5 - Data di Nascita*\n\nInserisci nel formato GG/MM/AAAA.\n\n_Esempio: 15/03/1990_"
-        await query.edit_message_text(text, parse_mode='Markdown')
+        await edit_message(query, text, parse_mode='Markdown')
         return CONSENT_BIRTH_DATE
     
     elif query.data == 'consent_back_place':
         text = "📝 *Passaggio 3/5 - Luogo di Nascita*\n\nInserisci città e provincia.\n\n_Esempio: Roma (RM)_"
-        await query.edit_message_text(text, parse_mode='Markdown')
+        await edit_message(query, text, parse_mode='Markdown')
         return CONSENT_BIRTH_PLACE
     
     elif query.data == 'consent_edit':
         text = "📝 *Passaggio 1/5 - Nome e Cognome*\n\nInserisci il tuo *nome e cognome completo*.\n\n_Esempio: Mario Rossi_"
         context.user_data['consent'] = {}
-        await query.edit_message_text(text, parse_mode='Markdown')
+        await edit_message(query, text, parse_mode='Markdown')
         return CONSENT_FULL_NAME
 
 
@@ -621,10 +685,104 @@ I dati raccolti sono trattati per gestione adesione e tutela legale. L'interessa
         [InlineKeyboardButton("⬅️ Indietro", callback_data='start_consent')]
     ])
     
-    await query.edit_message_text(doc_text, parse_mode='Markdown', reply_markup=keyboard)
+    await edit_message(query, doc_text, parse_mode='Markdown', reply_markup=keyboard)
     return CONSENT_START
 
 
+# =============================================================================
+# LAVORO DIFFERITO DEI PULSANTI
+# =============================================================================
+# Funzioni eseguite in background da run_deferred: sincrone (database, in un
+# thread) o asincrone quando chiamano Stripe (tramite stripe_client.arun).
+# Restituiscono (testo, tastiera) da mostrare al posto del segnaposto.
+
+async def subscribe_result(user_id: int) -> tuple:
+    """Pulsante 'subscribe': verifica i requisiti e crea il checkout Stripe."""
+    back_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]])
+    
+    if not await asyncio.to_thread(can_subscribe, user_id):
+        return "⚠️ Devi prima completare il consenso!", back_keyboard
+    
+    if await asyncio.to_thread(is_subscribed, user_id):
+        return "✅ Hai già un abbonamento attivo!", None
+    
+    checkout_url = await stripe_client.arun(get_checkout_url, user_id)
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("💳 Vai al Pagamento", url=checkout_url)],
+        [InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]
+    ])
+    return "💰 *Abbonamento Operazione Risveglio*\n\nPrezzo: *20€/mese*\n\nClicca per procedere:", keyboard
+
+
+async def manage_subscription_result(user_id: int) -> tuple:
+    """Pulsante 'manage_subscription': link al portale clienti Stripe."""
+    user_data = await asyncio.to_thread(get_user, user_id)
+    if not (user_data and user_data.get('stripe_customer_id')):
+        return "❌ Nessun abbonamento da gestire.", None
+    
+    portal_url = await stripe_client.arun(get_customer_portal_url, user_data['stripe_customer_id'])
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("⚙️ Gestisci su Stripe", url=portal_url)],
+        [InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]
+    ])
+    return (
+        "⚙️ *Gestione Abbonamento*\n\nDal portale Stripe puoi:\n• Aggiornare il metodo di pagamento\n• Vedere le fatture\n• Cancellare l'abbonamento",
+        keyboard
+    )
+
+
+def admin_panel_result(user_id: int) -> tuple:
+    """Pulsante 'admin_panel': statistiche generali."""
+    if not is_admin(user_id):
+        return "❌ Non autorizzato.", None
+    
+    stats = get_stats()
+    consent_stats = get_consent_stats()
+    text = (
+        "📊 *PANNELLO ADMIN*\n\n"
+        f"👥 Utenti: {stats['total_users']}\n"
+        f"✅ Abbonati: {stats['active_subscribers']}\n"
+        f"🆕 Nuovi (7gg): {stats['new_users_week']}\n"
+        f"⏳ In attesa: {stats['pending_users']}\n"
+        f"📝 Attesa consenso: {stats['awaiting_consent']}\n"
+        f"🎫 Ticket: {stats['open_tickets']}\n"
+        f"📋 Consensi: {consent_stats['total_confirmed']}\n"
+        f"💰 Entrate mese: €{stats['monthly_revenue']:.2f}\n\n"
+        "*Comandi:*\n/pending - Richieste\n/approva @user\n/rifiuta @user"
+    )
+    
+    if is_super_admin(user_id):
+        text += "\n\n*Super Admin:*\n/addadmin <id>\n/removeadmin <id>\n/listadmin"
+    
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Menu", callback_data='back_to_menu')]])
+    return text, keyboard
+
+
+def admin_pending_result() -> tuple:
+    """Pulsante 'admin_pending': elenco richieste in attesa."""
+    pending = get_pending_users()
+    if not pending:
+        return "✅ Nessuna richiesta in attesa!", None
+    
+    text = "⏳ *RICHIESTE IN ATTESA*\n\n"
+    for p in pending[:10]:
+        text += f"👤 {p['first_name']} (@{p['username'] or 'N/A'})\n   ID: `{p['user_id']}`\n\n"
+    text += "\nUsa /pending per gestirle."
+    return text, None
+
+
+def admin_tickets_result() -> tuple:
+    """Pulsante 'admin_tickets': elenco ticket aperti."""
+    tickets = get_open_tickets()
+    if not tickets:
+        return "✅ Nessun ticket aperto!", None
+    
+    text = "🎫 *TICKET APERTI*\n\n"
+    for t in tickets[:10]:
+        text += f"*#{t['ticket_id']}* - {t['category']}\n👤 @{t['username'] or t['first_name']}\n📝 {t['description'][:50]}...\n\n"
+    return text, None
+
+
 # =============================================================================
 # GESTIONE CALLBACK PRINCIPALI
 # =============================================================================
@@ -641,7 +799,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         set_pending(user.id)
         log_activity(user.id, 'access_request', 'Richiesta accesso inviata')
         
-        await query.edit_message_text(
+        await edit_message(query, 
             "✅ *Richiesta Inviata!*\n\n"
             "La tua richiesta è stata inviata agli amministratori.\n"
             "⏳ Riceverai una notifica quando sarà elaborata.",
@@ -672,34 +830,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("La tua richiesta è in lavorazione!", show_alert=True)
     
     elif data == 'subscribe':
-        if not can_subscribe(user.id):
-            await query.answer("Devi prima completare il consenso!", show_alert=True)
-            return
-        
-        if is_subscribed(user.id):
-            await query.edit_message_text("✅ Hai già un abbonamento attivo!")
-            return
-        
-        try:
-            checkout_url = create_checkout_session(user.id)
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("💳 Vai al Pagamento", url=checkout_url)],
-                [InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]
-            ])
-            await query.edit_message_text(
-                "💰 *Abbonamento Operazione Risveglio*\n\nPrezzo: *20€/mese*\n\nClicca per procedere:",
-                parse_mode='Markdown', reply_markup=keyboard
-            )
-        except Exception as e:
-            logger.error(f"Errore checkout: {e}")
-            await query.edit_message_text("❌ Errore. Riprova più tardi.")
+        await run_deferred(update, context, 'subscribe', functools.partial(subscribe_result, user.id))
     
     elif data == 'info':
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("🔑 RICHIEDI ACCESSO", callback_data='request_access')],
             [InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]
         ])
-        await query.edit_message_text(
+        await edit_message(query, 
             "🌟 *COS'È OPERAZIONE RISVEGLIO?*\n\n"
             "Community dedicata allo sviluppo e condivisione di esperienze "
             "nell'utilizzo di device quantistici per l'equilibrio personale.\n\n"
@@ -713,7 +851,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("📝 COMPILA ORA", callback_data='start_consent')],
             [InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]
         ])
-        await query.edit_message_text(
+        await edit_message(query, 
             "📋 *COS'È IL CONSENSO?*\n\n"
             "È una dichiarazione obbligatoria che include:\n\n"
             "• *Adesione volontaria* alla community\n"
@@ -742,10 +880,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text = "❌ Nessun consenso trovato."
         
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]])
-        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=keyboard)
+        await edit_message(query, text, parse_mode='Markdown', reply_markup=keyboard)
     
     elif data == 'enter_otp':
-        await query.edit_message_text(
+        await edit_message(query, 
             "🔐 *INSERISCI CODICE OTP*\n\n"
             "Scrivi il codice di 6 cifre che hai ricevuto:",
             parse_mode='Markdown'
@@ -753,20 +891,28 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return CONSENT_OTP_VERIFY
     
     elif data == 'resend_otp':
+        if not otp_store.can_issue(user.id):
+            await edit_message(query, "⏳ Hai richiesto troppi codici. Riprova tra un'ora.")
+            return
         result = regenerate_otp(user.id)
         if result['success']:
+            otp_store.issue(user.id, result['otp_code'], result['expires_at'].timestamp())
             await context.bot.send_message(
                 user.id,
                 f"🔐 *NUOVO CODICE OTP*\n\n`{result['otp_code']}`\n\n⏰ Valido per 10 minuti.",
                 parse_mode='Markdown'
             )
-            await query.edit_message_text(
+            await edit_message(query, 
                 "✅ Nuovo codice inviato!\n\nInseriscilo qui sotto:",
                 parse_mode='Markdown'
             )
             return CONSENT_OTP_VERIFY
         else:
-            await query.edit_message_text(f"❌ {result.get('error', 'Errore')}. Usa /start per riprovare.")
+            await edit_message(query, f"❌ {result.get('error', 'Errore')}. Usa /start per riprovare.")
+    
+    elif data == 'consent_receipt':
+        if not await deliver_consent_receipt(context.bot, user.id):
+            await query.message.reply_text("❌ Ricevuta non disponibile. Riprova più tardi.")
     
     elif data == 'my_status':
         sub_info = get_subscription_info(user.id)
@@ -779,26 +925,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text = f"❌ Nessun abbonamento attivo.\n\n📋 Approvato: {approved_text}\n📝 Consenso: {consent_text}"
         
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]])
-        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=keyboard)
+        await edit_message(query, text, parse_mode='Markdown', reply_markup=keyboard)
     
     elif data == 'manage_subscription':
-        user_data = get_user(user.id)
-        if user_data and user_data.get('stripe_customer_id'):
-            try:
-                portal_url = get_customer_portal_url(user_data['stripe_customer_id'])
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("⚙️ Gestisci su Stripe", url=portal_url)],
-                    [InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]
-                ])
-                await query.edit_message_text(
-                    "⚙️ *Gestione Abbonamento*\n\nDal portale Stripe puoi:\n• Aggiornare il metodo di pagamento\n• Vedere le fatture\n• Cancellare l'abbonamento",
-                    parse_mode='Markdown', reply_markup=keyboard
-                )
-            except Exception as e:
-                logger.error(f"Errore portale: {e}")
-                await query.edit_message_text("❌ Errore. Riprova più tardi.")
-        else:
-            await query.edit_message_text("❌ Nessun abbonamento da gestire.")
+        await run_deferred(update, context, 'manage_subscription', functools.partial(manage_subscription_result, user.id))
     
     elif data == 'support':
         keyboard = InlineKeyboardMarkup([
@@ -810,7 +940,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("🚪 Problemi Accesso", url=SUPPORT_BOT_LINK)],
             [InlineKeyboardButton("🔙 Indietro", callback_data='back_to_menu')]
         ])
-        await query.edit_message_text(
+        await edit_message(query, 
             "🎫 *SUPPORTO*\n\n*💳 Pagamenti/Abbonamento:*\nSeleziona un'opzione sotto.\n\n*🔧 Tecnico:*\nUsa il bot dedicato.",
             parse_mode='Markdown', reply_markup=keyboard
         )
@@ -821,7 +951,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == 'support_payment':
         context.user_data['support_category'] = 'payment'
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Annulla", callback_data='support')]])
-        await query.edit_message_text(
+        await edit_message(query, 
             "💳 *PROBLEMI DI PAGAMENTO*\n\nDescrivi il problema:\n• Quale errore vedi?\n• Quale carta usi?\n• Quando è successo?",
             parse_mode='Markdown', reply_markup=keyboard
         )
@@ -830,7 +960,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == 'support_subscription':
         context.user_data['support_category'] = 'subscription'
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Annulla", callback_data='support')]])
-        await query.edit_message_text(
+        await edit_message(query, 
             "⚙️ *PROBLEMI DI ABBONAMENTO*\n\nDescrivi il problema:\n• Rinnovo non funziona?\n• Abbonamento non riconosciuto?\n• Vuoi cancellare?",
             parse_mode='Markdown', reply_markup=keyboard
         )
@@ -854,39 +984,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text = MESSAGES['welcome_new']
         
         keyboard = get_main_keyboard(user_status, user.id)
-        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=keyboard)
-    
-    elif data == 'admin_separator':
-        await query.answer("🔐 Sezione Admin", show_alert=False)
-    
-    elif data == 'admin_panel':
-        if not is_admin(user.id):
-            await query.answer("Non autorizzato!", show_alert=True)
-            return
-        
-        stats = get_stats()
-        consent_stats = get_consent_stats()
-        text = (
-            "📊 *PANNELLO ADMIN*\n\n"
-            f"👥 Utenti: {stats['total_users']}\n"
-            f"✅ Abbonati: {stats['active_subscribers']}\n"
-            f"🆕 Nuovi (7gg): {stats['new_users_week']}\n"
-            f"⏳ In attesa: {stats['pending_users']}\n"
-            f"📝 Attesa consenso: {stats['awaiting_consent']}\n"
-            f"🎫 Ticket: {stats['open_tickets']}\n"
-            f"📋 Consensi: {consent_stats['total_confirmed']}\n"
-            f"💰 Entrate mese: €{stats['monthly_revenue']:.2f}\n\n"
-            "*Comandi:*\n/pending - Richieste\n/approva @user\n/rifiuta @user"
-        )
-        
-        if is_super_admin(user.id):
-            text += "\n\n*Super Admin:*\n/addadmin <id>\n/removeadmin <id>\n/listadmin"
-        
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Menu", callback_data='back_to_menu')]])
-        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=keyboard)
+        await edit_message(query, text, parse_mode='Markdown', reply_markup=keyboard)
     
     elif data == 'cancel':
-        await query.edit_message_text("❌ Operazione annullata.")
+        await edit_message(query, "❌ Operazione annullata.")
 
 
 # =============================================================================
@@ -1120,6 +1221,134 @@ async def listadmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode='Markdown')
 
 
+def revenue_bar(value: int, maximum: int, width: int = 12) -> str:
+    """Barra di testo proporzionale per i grafici nei messaggi."""
+    if not maximum:
+        return ''
+    return '█' * max(1 if value else 0, round(width * value / maximum))
+
+
+async def revenue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/entrate: entrate del mese, degli ultimi 12 mesi e degli ultimi 30 giorni."""
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Non autorizzato.")
+        return
+    
+    report = await asyncio.to_thread(get_revenue_report)
+    month = report['month']
+    
+    lines = [
+        "💰 *ENTRATE*\n",
+        f"Mese corrente: €{month['revenue'] / 100:.2f} "
+        f"({month['payments']} pagamenti, {month['failed_payments']} falliti)\n",
+        "*Ultimi 12 mesi*",
+    ]
+    top = max((m['revenue'] for m in report['months']), default=0)
+    for m in report['months']:
+        lines.append(f"`{m['month'].strftime('%m/%Y')}` {revenue_bar(m['revenue'], top)} €{m['revenue'] / 100:.0f}")
+    
+    lines.append("\n*Ultimi 30 giorni*")
+    top = max((d['revenue'] for d in report['daily']), default=0)
+    for d in report['daily']:
+        lines.append(f"`{d['day'].strftime('%d/%m')}` {revenue_bar(d['revenue'], top)} €{d['revenue'] / 100:.0f}")
+    
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/esporta <user_id|tutti> [jsonl|zip]: esportazione GDPR dei dati personali."""
+    user = update.effective_user
+    if not is_super_admin(user.id):
+        await update.message.reply_text("❌ Solo Super Admin.")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("❌ Uso: /esporta <user_id|tutti> [jsonl|zip]")
+        return
+    
+    target = context.args[0].lower()
+    if target != 'tutti' and not target.isdigit():
+        await update.message.reply_text("❌ Indica uno user_id numerico oppure 'tutti'.")
+        return
+    user_id = None if target == 'tutti' else int(target)
+    fmt = context.args[1].lower() if len(context.args) > 1 else ('zip' if user_id is None else 'jsonl')
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text("❌ Formato non valido: usa jsonl o zip.")
+        return
+    
+    await update.message.reply_text("📦 Esportazione in corso...")
+    
+    # Il file viene scritto su disco a blocchi e poi inviato
+    with tempfile.TemporaryFile() as f:
+        try:
+            counts = await asyncio.to_thread(write_export, f, fmt, user_id)
+        except Exception as e:
+            logger.error(f"Errore esportazione GDPR: {e}")
+            await update.message.reply_text("❌ Errore durante l'esportazione.")
+            return
+        
+        size = f.tell()
+        if size > TELEGRAM_MAX_UPLOAD_BYTES:
+            await update.message.reply_text(
+                f"❌ File troppo grande per Telegram ({size / 1024 / 1024:.0f} MB, massimo 50 MB).\n"
+                f"Usa la riga di comando: python gdpr_export.py --formato {fmt}"
+                + (f" --utente {user_id}" if user_id else "")
+            )
+            return
+        
+        f.seek(0)
+        summary = ", ".join(f"{table}: {count}" for table, count in counts.items())
+        try:
+            await context.bot.send_document(
+                update.effective_chat.id,
+                document=f,
+                filename=export_filename(fmt, user_id),
+                caption=f"📦 Esportazione dati\n{summary}",
+            )
+        except TelegramError as e:
+            logger.error(f"Errore invio esportazione GDPR: {e}")
+            await update.message.reply_text("❌ Esportazione completata ma invio del file non riuscito.")
+            return
+    
+    log_activity(user.id, 'gdpr_export', f"Esportazione {target} ({fmt})")
+
+
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/riconcilia [prova]: allinea gli abbonamenti del database a Stripe."""
+    user = update.effective_user
+    if not is_super_admin(user.id):
+        await update.message.reply_text("❌ Solo Super Admin.")
+        return
+    
+    dry_run = bool(context.args) and context.args[0].lower() == 'prova'
+    await update.message.reply_text("🔄 Riconciliazione in corso...")
+    
+    try:
+        report = await asyncio.to_thread(reconcile_subscriptions, dry_run)
+    except Exception as e:
+        logger.error(f"Errore riconciliazione: {e}")
+        await update.message.reply_text("❌ Errore durante la riconciliazione.")
+        return
+    
+    await update.message.reply_text(format_report(report))
+
+
+async def dbprofile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/dbprofilo [reset]: funzioni del database più pesanti e query lente."""
+    user = update.effective_user
+    if not is_super_admin(user.id):
+        await update.message.reply_text("❌ Solo Super Admin.")
+        return
+    
+    if context.args and context.args[0].lower() == 'reset':
+        db_profiler.reset()
+        await update.message.reply_text("✅ Statistiche del database azzerate.")
+        return
+    
+    await update.message.reply_text(db_profiler.format_report())
+
+
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gestisce callback admin."""
     query = update.callback_query
@@ -1129,35 +1358,21 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(user.id):
         return
     
-    if query.data == 'admin_pending':
-        pending = get_pending_users()
-        if not pending:
-            await query.edit_message_text("✅ Nessuna richiesta in attesa!")
-            return
-        
-        text = "⏳ *RICHIESTE IN ATTESA*\n\n"
-        for p in pending[:10]:
-            text += f"👤 {p['first_name']} (@{p['username'] or 'N/A'})\n   ID: `{p['user_id']}`\n\n"
-        text += "\nUsa /pending per gestirle."
-        await query.edit_message_text(text, parse_mode='Markdown')
+    if query.data == 'admin_panel':
+        await run_deferred(update, context, 'admin_panel', lambda: admin_panel_result(user.id))
+    
+    elif query.data == 'admin_pending':
+        await run_deferred(update, context, 'admin_pending', admin_pending_result)
     
     elif query.data == 'admin_tickets':
-        tickets = get_open_tickets()
-        if not tickets:
-            await query.edit_message_text("✅ Nessun ticket aperto!")
-            return
-        
-        text = "🎫 *TICKET APERTI*\n\n"
-        for t in tickets[:10]:
-            text += f"*#{t['ticket_id']}* - {t['category']}\n👤 @{t['username'] or t['first_name']}\n📝 {t['description'][:50]}...\n\n"
-        await query.edit_message_text(text, parse_mode='Markdown')
+        await run_deferred(update, context, 'admin_tickets', admin_tickets_result)
     
     elif query.data.startswith('admin_approve_'):
         target_id = int(query.data.replace('admin_approve_', ''))
         approve_user(target_id, user.id)
         log_activity(target_id, 'approved', f'Approvato da {user.id}')
         
-        await query.edit_message_text(f"✅ Utente `{target_id}` *APPROVATO*\n\nDa: @{user.username or user.first_name}", parse_mode='Markdown')
+        await edit_message(query, f"✅ Utente `{target_id}` *APPROVATO*\n\nDa: @{user.username or user.first_name}", parse_mode='Markdown')
         
         try:
             keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("📝 COMPILA CONSENSO", callback_data='start_consent')]])
@@ -1174,7 +1389,7 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reject_user(target_id, user.id)
         log_activity(target_id, 'rejected', f'Rifiutato da {user.id}')
         
-        await query.edit_message_text(f"❌ Utente `{target_id}` *RIFIUTATO*\n\nDa: @{user.username or user.first_name}", parse_mode='Markdown')
+        await edit_message(query, f"❌ Utente `{target_id}` *RIFIUTATO*\n\nDa: @{user.username or user.first_name}", parse_mode='Markdown')
         
         try:
             await context.bot.send_message(target_id, "❌ *RICHIESTA NON APPROVATA*\n\nContatta il supporto se ritieni sia un errore.", parse_mode='Markdown')
@@ -1183,7 +1398,7 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif query.data.startswith('ticket_take_'):
         ticket_id = int(query.data.replace('ticket_take_', ''))
-        await query.edit_message_text(query.message.text + f"\n\n✅ *Preso in carico da @{user.username or user.first_name}*", parse_mode='Markdown')
+        await edit_message(query, query.message.text + f"\n\n✅ *Preso in carico da @{user.username or user.first_name}*", parse_mode='Markdown')
         log_activity(user.id, 'ticket_take', f'Ticket #{ticket_id}')
     
     elif query.data.startswith('ticket_close_'):
@@ -1192,7 +1407,7 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             close_ticket(ticket_id)
         except:
             pass
-        await query.edit_message_text(query.message.text + f"\n\n✅ *RISOLTO da @{user.username or user.first_name}*", parse_mode='Markdown')
+        await edit_message(query, query.message.text + f"\n\n✅ *RISOLTO da @{user.username or user.first_name}*", parse_mode='Markdown')
         log_activity(user.id, 'ticket_close', f'Ticket #{ticket_id}')
 
 
@@ -1200,9 +1415,22 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # TASK SCHEDULATI
 # =============================================================================
 
-async def check_expiring_subscriptions(context: ContextTypes.DEFAULT_TYPE):
-    expiring = get_expiring_subscriptions(days=RENEWAL_REMINDER_DAYS)
+async def check_expiring_subscriptions(context: ContextTypes.DEFAULT_TYPE, shard: int = 0, shards: int = 1):
+    """
+    Promemoria di scadenza per una fetta di utenti. Restituisce (inviati, falliti).
+    Ogni promemoria viene prenotato nel registro notifiche prima dell'invio,
+    quindi una nuova esecuzione non invia mai doppioni.
+    """
+    expiring = await asyncio.to_thread(get_expiring_subscriptions, RENEWAL_REMINDER_DAYS, shard, shards)
+    periods = {user['user_id']: user['subscription_end'].isoformat() for user in expiring}
+    claimed = await asyncio.to_thread(
+        claim_notifications, NOTIFICATION_EXPIRING_REMINDER, list(periods.items())
+    )
+    
+    sent = failed = 0
     for user in expiring:
+        if user['user_id'] not in claimed:
+            continue
         try:
             end_date = user['subscription_end'].strftime('%d/%m/%Y')
             keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Rinnova", callback_data='subscribe')]])
@@ -1211,93 +1439,124 @@ async def check_expiring_subscriptions(context: ContextTypes.DEFAULT_TYPE):
                 f"⚠️ *Promemoria*\n\nIl tuo abbonamento scade il {end_date}. Rinnova!",
                 parse_mode='Markdown', reply_markup=keyboard
             )
+            sent += 1
         except Exception as e:
+            failed += 1
             logger.error(f"Errore promemoria {user['user_id']}: {e}")
+            await asyncio.to_thread(
+                release_notification, user['user_id'], NOTIFICATION_EXPIRING_REMINDER, periods[user['user_id']]
+            )
+    return sent, failed
 
 
-async def check_expired_subscriptions(context: ContextTypes.DEFAULT_TYPE):
-    expired = get_expired_subscriptions()
+async def check_expired_subscriptions(context: ContextTypes.DEFAULT_TYPE, shard: int = 0, shards: int = 1):
+    """Disattiva gli abbonamenti scaduti di una fetta di utenti. Restituisce (elaborati, falliti)."""
+    expired = await asyncio.to_thread(get_expired_subscriptions, shard, shards)
+    failed = 0
     for user in expired:
         try:
-            deactivate_subscription(user['user_id'])
+            await asyncio.to_thread(deactivate_subscription, user['user_id'])
             await context.bot.send_message(
                 user['user_id'],
                 MESSAGES['subscription_expired'].format(name=user['first_name'], end_date=user['subscription_end'].strftime('%d/%m/%Y')),
                 parse_mode='Markdown'
             )
         except Exception as e:
+            failed += 1
             logger.error(f"Errore disattivazione {user['user_id']}: {e}")
+    return len(expired) - failed, failed
 
 
-# =============================================================================
-# WEBHOOK SERVER
-# =============================================================================
-
-def run_webhook_server_sync():
-    async def handle_stripe_webhook(request):
-        payload = await request.read()
-        sig_header = request.headers.get('Stripe-Signature')
-        
-        logger.info("=== WEBHOOK STRIPE ===")
-        
-        try:
-            event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
-            logger.info(f"Evento: {event['type']}")
-        except ValueError as e:
-            logger.error(f"Payload non valido: {e}")
-            return web.Response(status=400)
-        except stripe.error.SignatureVerificationError as e:
-            logger.error(f"Firma non valida: {e}")
-            return web.Response(status=400)
-        
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object']
-            user_id = session.get('metadata', {}).get('telegram_user_id')
-            if user_id:
-                user_id = int(user_id)
-                activate_subscription(user_id, session.get('customer'), session.get('subscription'))
-                logger.info(f"✅ Abbonamento ATTIVATO per {user_id}")
-            else:
-                logger.error("telegram_user_id non trovato!")
-        
-        return web.Response(text='OK', status=200)
+# I task giornalieri sono distribuiti in fette su una finestra temporale
+expiring_reminders_job = ShardedJob(
+    'expiring_reminders', check_expiring_subscriptions,
+    shards=EXPIRING_JOB_SHARDS, window_minutes=EXPIRING_JOB_WINDOW_MINUTES,
+    should_run=lambda: leader.is_leader
+)
+expired_subscriptions_job = ShardedJob(
+    'expired_subscriptions', check_expired_subscriptions,
+    shards=EXPIRED_JOB_SHARDS, window_minutes=EXPIRED_JOB_WINDOW_MINUTES,
+    should_run=lambda: leader.is_leader
+)
 
-    async def health_check(request):
-        return web.Response(text='OK', status=200)
 
-    async def start_server():
-        app = web.Application()
-        app.router.add_post('/webhook/stripe', handle_stripe_webhook)
-        app.router.add_get('/health', health_check)
-        app.router.add_get('/', health_check)
-        
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', 8080)
-        await site.start()
-        logger.info("🌐 Webhook server su porta 8080")
-        
-        while True:
-            await asyncio.sleep(3600)
-    
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(start_server())
+async def reconcile_job(context):
+    """Riconciliazione notturna degli abbonamenti con Stripe."""
+    try:
+        report = await asyncio.to_thread(reconcile_subscriptions)
+    except Exception as e:
+        logger.error(f"Errore riconciliazione notturna: {e}")
+        return
+    if report['corrections']:
+        logger.warning(format_report(report))
 
 
 # =============================================================================
 # MAIN
 # =============================================================================
 
-def main():
-    init_db()
-    logger.info("Database inizializzato")
-    
-    webhook_thread = threading.Thread(target=run_webhook_server_sync, daemon=True)
-    webhook_thread.start()
-    logger.info("Webhook thread avviato")
-    
-    application = Application.builder().token(BOT_TOKEN).build()
+async def on_startup(application: Application):
+    """
+    Avvia il server webhook nello stesso event loop del bot e l'elezione
+    del leader; il leader riprende i task interrotti.
+    """
+    global webhook_runner
+    webhook_runner = await start_webhook_server(application, port=WEBHOOK_PORT)
+    application.create_task(asyncio.to_thread(warm_up_stripe))
+    
+    async def resume_jobs():
+        for job in (expiring_reminders_job, expired_subscriptions_job):
+            try:
+                await job.resume(application)
+            except Exception as e:
+                logger.error(f"Errore ripresa task {job.name}: {e}")
+    
+    leader.on_elected(resume_jobs)
+    await leader.start()
+
+
+async def on_stop(application: Application):
+    """
+    Completa il lavoro in sospeso quando il bot si ferma, finché il client
+    della Bot API è ancora aperto (approvazioni e messaggi in coda).
+    """
+    if webhook_runner:
+        await webhook_runner.cleanup()
+    await join_request_queue.shutdown()
+    for job in (expiring_reminders_job, expired_subscriptions_job):
+        job.cancel()
+    await leader.stop()
+
+
+async def on_shutdown(application: Application):
+    """Chiude le risorse locali dopo lo spegnimento del bot."""
+    shutdown_receipts()
+    close_pool()
+
+
+def build_application(base_url: str = None) -> Application:
+    """
+    Crea l'Application con tutti gli handler registrati, senza avviarla.
+    `base_url` sostituisce l'indirizzo della Bot API (simulazioni di carico).
+    """
+    # Update di utenti diversi in parallelo, stesso utente sempre in ordine
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Stesso pool di connessioni del client predefinito, con metriche per chiamata
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(PostgresPersistence(
+            update_interval=PERSISTENCE_UPDATE_INTERVAL,
+            flush_delay=PERSISTENCE_FLUSH_DELAY,
+        ))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder.base_url(base_url)
+    application = builder.build()
     
     # Conversation Handler per il Consenso
     consent_handler = ConversationHandler(
@@ -1345,6 +1604,8 @@ def main():
             CallbackQueryHandler(cancel_consent, pattern='^cancel_consent$'),
         ],
         allow_reentry=True,
+        name='consent_conversation',
+        persistent=True,
     )
     
     # Conversation Handler per Supporto
@@ -1356,6 +1617,8 @@ def main():
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel_support)],
+        name='support_conversation',
+        persistent=True,
     )
     
     # Registra handlers
@@ -1370,6 +1633,10 @@ def main():
     application.add_handler(CommandHandler('addadmin', addadmin_command))
     application.add_handler(CommandHandler('removeadmin', removeadmin_command))
     application.add_handler(CommandHandler('listadmin', listadmin_command))
+    application.add_handler(CommandHandler('riconcilia', reconcile_command))
+    application.add_handler(CommandHandler('entrate', revenue_command))
+    application.add_handler(CommandHandler('esporta', export_command))
+    application.add_handler(CommandHandler('dbprofilo', dbprofile_command))
     
     application.add_handler(consent_handler)
     application.add_handler(support_handler)
@@ -1380,10 +1647,22 @@ def main():
     
     application.add_handler(ChatJoinRequestHandler(handle_join_request))
     
-    # Scheduler
-    scheduler = AsyncIOScheduler(timezone='Europe/Rome')
-    scheduler.add_job(check_expiring_subscriptions, 'cron', hour=9, minute=0, args=[application])
-    scheduler.add_job(check_expired_subscriptions, 'cron', hour=0, minute=5, args=[application])
+    # Metriche per handler (durata, query, Telegram, Stripe) su /metrics
+    logger.info(f"Handler strumentati: {instrument_handlers(application)}")
+    return application
+
+
+def main():
+    init_db()
+    logger.info("Database inizializzato")
+    
+    application = build_application()
+    
+    # Scheduler (attivo su ogni replica, ma i task girano solo sul leader)
+    scheduler = AsyncIOScheduler(timezone=TIMEZONE)
+    scheduler.add_job(leader.guard(expiring_reminders_job.start, expiring_reminders_job.name), 'cron', hour=9, minute=0, args=[application])
+    scheduler.add_job(leader.guard(expired_subscriptions_job.start, expired_subscriptions_job.name), 'cron', hour=0, minute=5, args=[application])
+    scheduler.add_job(leader.guard(reconcile_job), 'cron', hour=RECONCILE_HOUR, minute=30, args=[application])
     scheduler.start()
     logger.info("Scheduler avviato")
     
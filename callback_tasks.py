@@ -0,0 +1,129 @@
+"""
+CALLBACK CON LAVORO DIFFERITO - OPERAZIONE RISVEGLIO
+=====================================================
+Alcuni pulsanti (abbonamento, portale Stripe, pannelli admin) richiedono
+query al database e chiamate a Stripe prima di poter rispondere. Per non
+lasciare l'utente con la rotellina e non occupare lo slot del handler:
+
+1. l'handler conferma subito la callback e il messaggio mostra un segnaposto;
+2. il lavoro pesante gira in un task in background, con timeout;
+3. al termine il messaggio viene modificato con il risultato.
+
+Per ogni ramo vengono registrate le latenze (metrica callback_branch_seconds).
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional, Tuple, Union
+
+from telegram import InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import ContextTypes
+
+import metrics
+from render_cache import edit_message, last_render, render_digest
+from config import CALLBACK_WORK_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Risultato di un lavoro differito: (testo, tastiera opzionale)
+CallbackResult = Tuple[str, Optional[InlineKeyboardMarkup]]
+
+PLACEHOLDER_TEXT = "⏳ Un momento..."
+TIMEOUT_TEXT = "⏱️ L'operazione sta richiedendo troppo tempo. Riprova tra poco."
+ERROR_TEXT = "❌ Errore. Riprova più tardi."
+
+# Messaggi con un lavoro differito in corso: (chat_id, message_id)
+_in_flight = set()
+
+
+async def run_deferred(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    branch: str,
+    work: Callable[[], Union[CallbackResult, Awaitable[CallbackResult]]],
+    timeout: float = CALLBACK_WORK_TIMEOUT,
+    placeholder: str = PLACEHOLDER_TEXT,
+):
+    """
+    Esegue `work` in background e aggiorna il messaggio della callback con
+    il risultato. `work` è una funzione sincrona (eseguita in un thread) o
+    una coroutine function (es. con Stripe tramite stripe_client.arun).
+
+    La callback deve essere già stata confermata dall'handler (query.answer()
+    in cima a ogni handler): qui non si risponde una seconda volta.
+    Se per lo stesso messaggio c'è già un lavoro in corso (doppio tocco),
+    la nuova richiesta viene ignorata.
+    """
+    query = update.callback_query
+    started = time.monotonic()
+
+    message = query.message
+    key = (message.chat_id, message.message_id) if message else None
+    if key in _in_flight:
+        metrics.inc('callback_deduplicated_total', branch=branch)
+        return
+    if key:
+        _in_flight.add(key)
+
+    try:
+        try:
+            await edit_message(query, placeholder)
+        except TelegramError as e:
+            # Anche errori di rete o RetryAfter: il lavoro parte comunque
+            logger.debug(f"Segnaposto non mostrato per {branch}: {e}")
+
+        metrics.observe('callback_ack_seconds', time.monotonic() - started, branch=branch)
+
+        # Contenuto effettivamente sullo schermo: se il segnaposto non è stato
+        # mostrato, è ancora quello precedente
+        shown_digest = last_render(*key) if key else render_digest(placeholder)
+        context.application.create_task(
+            _complete(query, key, branch, work, timeout, started, shown_digest),
+            update=update,
+        )
+    except BaseException:
+        # _complete non partito: il messaggio non resta bloccato come "in corso"
+        _in_flight.discard(key)
+        raise
+
+
+async def _run_work(work) -> CallbackResult:
+    # Lavoro asincrono (es. Stripe tramite stripe_client.arun) o sincrono in un thread
+    if asyncio.iscoroutinefunction(work):
+        return await work()
+    return await asyncio.to_thread(work)
+
+
+async def _complete(query, key, branch: str, work, timeout: float, started: float,
+                    shown_digest: Optional[str]):
+    outcome = 'ok'
+    work_started = time.monotonic()
+    try:
+        try:
+            text, keyboard = await asyncio.wait_for(_run_work(work), timeout)
+        except asyncio.TimeoutError:
+            # Il thread non si può interrompere: il risultato verrà ignorato
+            outcome = 'timeout'
+            logger.warning(f"Callback {branch}: timeout dopo {timeout}s")
+            text, keyboard = TIMEOUT_TEXT, None
+        except Exception as e:
+            outcome = 'error'
+            logger.error(f"Callback {branch}: errore {e}")
+            text, keyboard = ERROR_TEXT, None
+
+        metrics.observe('callback_work_seconds', time.monotonic() - work_started, branch=branch, outcome=outcome)
+
+        # Se nel frattempo l'utente ha cambiato schermata, non sovrascriverla
+        if key and last_render(*key) not in (None, shown_digest):
+            outcome = 'superseded'
+            return
+
+        try:
+            await edit_message(query, text, parse_mode='Markdown', reply_markup=keyboard)
+        except BadRequest as e:
+            logger.error(f"Callback {branch}: modifica messaggio fallita: {e}")
+    finally:
+        _in_flight.discard(key)
+        metrics.observe('callback_branch_seconds', time.monotonic() - started, branch=branch, outcome=outcome)
@@ -109,6 +109,14 @@ OTP_VALIDITY_MINUTES = 10
 # Numero massimo tentativi OTP
 OTP_MAX_ATTEMPTS = 5
 
+# Numero massimo di codici OTP inviati a un utente in un'ora
+OTP_MAX_CODES_PER_HOUR = int(os.getenv('OTP_MAX_CODES_PER_HOUR', 5))
+
+# Archivio dei codici OTP attivi: 'memory' (una sola istanza) oppure
+# 'sqlite' (file locale condiviso da più istanze sulla stessa macchina)
+OTP_STORE_BACKEND = os.getenv('OTP_STORE_BACKEND', 'memory')
+OTP_STORE_PATH = os.getenv('OTP_STORE_PATH', 'otp_store.sqlite3')
+
 # Titolare del trattamento dati
 DATA_CONTROLLER_NAME = "Francesco Cinquefiori"
 DATA_CONTROLLER_EMAIL = "gruppo.operazione.risveglio@gmail.com"
@@ -289,5 +297,120 @@ Inserendo il codice OTP, dichiaro di aver letto l'informativa privacy e presto i
 # Giorni di preavviso prima della scadenza abbonamento
 RENEWAL_REMINDER_DAYS = 3
 
-# Fuso orario per i report
+# Fuso orario per i report, lo scheduler e le chiavi dei task giornalieri
 TIMEZONE = 'Europe/Rome'
+
+# =============================================================================
+# PRESTAZIONI E CONCORRENZA
+# =============================================================================
+# Numero massimo di update Telegram elaborati in parallelo (utenti diversi).
+# Gli update dello stesso utente restano sempre in ordine.
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 64))
+
+# Persistenza conversazioni/user_data su PostgreSQL:
+# ogni quanti secondi il bot raccoglie le modifiche e dopo quanti secondi
+# le scrive in blocco sul database
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', 5))
+PERSISTENCE_FLUSH_DELAY = float(os.getenv('PERSISTENCE_FLUSH_DELAY', 1))
+
+# Richieste di accesso ai gruppi: finestra di raccolta (secondi), dimensione
+# massima di un blocco e numero di richieste gestite in parallelo
+JOIN_REQUEST_BATCH_WINDOW = float(os.getenv('JOIN_REQUEST_BATCH_WINDOW', 1))
+JOIN_REQUEST_MAX_BATCH = int(os.getenv('JOIN_REQUEST_MAX_BATCH', 200))
+JOIN_REQUEST_CONCURRENCY = int(os.getenv('JOIN_REQUEST_CONCURRENCY', 10))
+
+# Limite di chiamate al secondo verso Telegram per gli invii massivi
+TELEGRAM_RATE_LIMIT = float(os.getenv('TELEGRAM_RATE_LIMIT', 25))
+
+# Timeout (secondi) del lavoro differito dei pulsanti (Stripe, pannelli admin)
+CALLBACK_WORK_TIMEOUT = float(os.getenv('CALLBACK_WORK_TIMEOUT', 15))
+
+# Numero di messaggi di cui ricordare l'ultimo contenuto mostrato
+# (per saltare le modifiche che non cambiano nulla)
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', 10000))
+
+# Task giornalieri suddivisi in fette distribuite su una finestra temporale:
+# promemoria di scadenza (dalle 09:00) e disattivazione scaduti (dalle 00:05)
+EXPIRING_JOB_SHARDS = int(os.getenv('EXPIRING_JOB_SHARDS', 12))
+EXPIRING_JOB_WINDOW_MINUTES = float(os.getenv('EXPIRING_JOB_WINDOW_MINUTES', 60))
+EXPIRED_JOB_SHARDS = int(os.getenv('EXPIRED_JOB_SHARDS', 6))
+EXPIRED_JOB_WINDOW_MINUTES = float(os.getenv('EXPIRED_JOB_WINDOW_MINUTES', 30))
+
+# Elezione del leader tra repliche (advisory lock PostgreSQL):
+# identificativo del lock e intervallo di rinnovo/tentativo in secondi
+LEADER_LOCK_ID = int(os.getenv('LEADER_LOCK_ID', 727001))
+LEADER_RENEW_SECONDS = float(os.getenv('LEADER_RENEW_SECONDS', 5))
+# Secondi dopo cui PostgreSQL chiude la sessione del leader se non risponde
+# più (idle_session_timeout, applicato solo da PostgreSQL 14 in poi;
+# 0 = solo keepalive TCP lato server)
+LEADER_SESSION_TIMEOUT_SECONDS = float(os.getenv('LEADER_SESSION_TIMEOUT_SECONDS', 15))
+
+# Pool di connessioni PostgreSQL condiviso da handler, webhook e task:
+# connessioni inattive tenute aperte e dopo quanti secondi chiuderle
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_POOL_MAX_IDLE_SECONDS = float(os.getenv('DB_POOL_MAX_IDLE_SECONDS', 300))
+
+# Porta del server HTTP (webhook Stripe e health check)
+WEBHOOK_PORT = int(os.getenv('PORT', 8080))
+
+# Eventi Stripe: salvati dal webhook ed elaborati da un worker in background.
+# Eventi presi per giro, tentativi prima dello scarto, attesa tra i controlli,
+# durata della presa in carico e ritardo base dei nuovi tentativi (secondi)
+STRIPE_EVENT_BATCH_SIZE = int(os.getenv('STRIPE_EVENT_BATCH_SIZE', 20))
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.getenv('STRIPE_EVENT_MAX_ATTEMPTS', 8))
+STRIPE_EVENT_POLL_SECONDS = float(os.getenv('STRIPE_EVENT_POLL_SECONDS', 5))
+STRIPE_EVENT_LEASE_SECONDS = int(os.getenv('STRIPE_EVENT_LEASE_SECONDS', 300))
+STRIPE_EVENT_RETRY_SECONDS = float(os.getenv('STRIPE_EVENT_RETRY_SECONDS', 30))
+
+# Clienti Stripe di cui ricordare l'utente Telegram associato
+CUSTOMER_CACHE_SIZE = int(os.getenv('CUSTOMER_CACHE_SIZE', 10000))
+
+# Checkout Stripe: durata delle sessioni (minuti, minimo 30 per Stripe),
+# sessioni aperte da riusare e timeout della creazione (secondi)
+CHECKOUT_SESSION_TTL_MINUTES = max(30, int(os.getenv('CHECKOUT_SESSION_TTL_MINUTES', 60)))
+CHECKOUT_CACHE_SIZE = int(os.getenv('CHECKOUT_CACHE_SIZE', 10000))
+CHECKOUT_TIMEOUT = float(os.getenv('CHECKOUT_TIMEOUT', 10))
+
+# Client HTTP Stripe: chiamate contemporanee (= connessioni keep-alive),
+# timeout di rete (secondi) e nuovi tentativi automatici in caso di errore
+STRIPE_MAX_CONCURRENCY = int(os.getenv('STRIPE_MAX_CONCURRENCY', 10))
+STRIPE_TIMEOUT = float(os.getenv('STRIPE_TIMEOUT', 10))
+STRIPE_MAX_RETRIES = int(os.getenv('STRIPE_MAX_RETRIES', 2))
+
+# Indirizzo alternativo delle API Stripe (solo test e simulazioni di carico,
+# es. http://127.0.0.1:12111 con fake_stripe.py). Vuoto = api.stripe.com
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', '')
+
+# Per quanti secondi riusare un link al portale clienti Stripe
+# (Stripe li considera validi per pochi minuti)
+PORTAL_URL_TTL_SECONDS = float(os.getenv('PORTAL_URL_TTL_SECONDS', 240))
+
+# Riconciliazione notturna degli abbonamenti con Stripe (ora di avvio)
+RECONCILE_HOUR = int(os.getenv('RECONCILE_HOUR', 3))
+
+# Ricevute del consenso: chiave per i codici di verifica (default: token
+# del bot), processi dedicati alla generazione e ricevute tenute in memoria
+RECEIPT_SIGNING_KEY = os.getenv('RECEIPT_SIGNING_KEY') or BOT_TOKEN or ''
+RECEIPT_WORKERS = int(os.getenv('RECEIPT_WORKERS', 2))
+RECEIPT_CACHE_SIZE = int(os.getenv('RECEIPT_CACHE_SIZE', 1000))
+
+# Esportazioni dati: righe lette dal database e scritte per ogni blocco
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+
+# Esportazioni CSV con COPY (route /admin/export): token da inviare
+# nell'header Authorization (vuoto = route disattivata), righe per blocco
+# (ogni blocco è una transazione breve e un punto di ripresa) e livello
+# di compressione gzip (1 = più veloce)
+EXPORT_API_TOKEN = os.getenv('EXPORT_API_TOKEN', '')
+COPY_EXPORT_CHUNK_ROWS = int(os.getenv('COPY_EXPORT_CHUNK_ROWS', 100000))
+COPY_EXPORT_GZIP_LEVEL = int(os.getenv('COPY_EXPORT_GZIP_LEVEL', 1))
+
+# Metriche Prometheus su /metrics: token da inviare nell'header
+# Authorization (vuoto = endpoint disattivato)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Profilazione delle funzioni di database.py (comando /dbprofilo): attiva,
+# soglia delle query lente (millisecondi) e campioni per i percentili
+DB_PROFILING = os.getenv('DB_PROFILING', 'true').lower() in ('1', 'true', 'yes')
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 200))
+DB_PROFILE_SAMPLES = int(os.getenv('DB_PROFILE_SAMPLES', 1000))
@@ -6,19 +6,125 @@ Include il sistema di consenso/liberatoria con firma elettronica OTP.
 """
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, execute_values
 from datetime import datetime, timedelta
-from config import DATABASE_URL, SUPER_ADMIN_IDS
+from config import (
+    DATABASE_URL, SUPER_ADMIN_IDS, DB_POOL_SIZE, DB_POOL_MAX_IDLE_SECONDS,
+    OTP_VALIDITY_MINUTES, OTP_MAX_ATTEMPTS, CONSENT_DOCUMENT_VERSION
+)
+from receipts import document_hash
+import db_profiler
+import metrics
+import json
 import logging
+import queue
 import random
 import string
+import time
 
 logger = logging.getLogger(__name__)
 
+# Tipi di notifica registrati in notification_ledger
+NOTIFICATION_EXPIRING_REMINDER = 'expiring_reminder'
+
+
+# Connessioni inattive pronte per essere riusate: (connessione, restituita_il)
+_idle_connections = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+
+class InstrumentedCursor(RealDictCursor):
+    """
+    Cursore che registra tempo e numero di query nello scope delle metriche
+    e nel profilo della funzione in corso (con il log delle query lente).
+    """
+
+    def execute(self, query, vars=None):
+        started = time.monotonic()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, vars, time.monotonic() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.monotonic()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(query, None, time.monotonic() - started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.monotonic()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._record(sql, None, time.monotonic() - started)
+
+    def _record(self, query, vars, elapsed: float):
+        metrics.inc('db_queries_total')
+        metrics.record_call('db', elapsed)
+        db_profiler.record_query(query, vars, elapsed, self.rowcount)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    Connessione riutilizzabile: close() la restituisce al pool invece di
+    chiuderla. Se il pool è pieno o la connessione non è più utilizzabile,
+    viene chiusa davvero.
+    """
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                self.rollback()
+            _idle_connections.put_nowait((self, time.monotonic()))
+        except (queue.Full, psycopg2.Error):
+            self.discard()
+
+    def discard(self):
+        """Chiude davvero la connessione."""
+        super().close()
+
 
 def get_connection():
-    """Crea e restituisce una connessione al database."""
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    """
+    Restituisce una connessione al database, riusandone una del pool se
+    disponibile. Chiamare sempre conn.close() per restituirla.
+    Thread-safe: può essere usata da asyncio.to_thread e dai task schedulati.
+    """
+    started = time.monotonic()
+    try:
+        return _acquire_connection()
+    finally:
+        db_profiler.record_acquire(time.monotonic() - started)
+
+
+def _acquire_connection():
+    while True:
+        try:
+            conn, returned_at = _idle_connections.get_nowait()
+        except queue.Empty:
+            break
+        if conn.closed or time.monotonic() - returned_at > DB_POOL_MAX_IDLE_SECONDS:
+            conn.discard()
+            continue
+        return conn
+    
+    return psycopg2.connect(
+        DATABASE_URL, cursor_factory=InstrumentedCursor, connection_factory=PooledConnection
+    )
+
+
+def close_pool():
+    """Chiude tutte le connessioni inattive del pool (allo spegnimento)."""
+    while True:
+        try:
+            conn, _ = _idle_connections.get_nowait()
+        except queue.Empty:
+            return
+        conn.discard()
 
 
 def init_db():
@@ -80,6 +186,11 @@ def init_db():
         END $$;
     ''')
     
+    # Ricerca dell'utente dal cliente Stripe (webhook)
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_stripe_customer_id ON users(stripe_customer_id)
+    ''')
+    
     # ==========================================================================
     # NUOVA TABELLA: Consenso/Liberatoria con firma elettronica
     # ==========================================================================
@@ -178,6 +289,33 @@ def init_db():
         )
     ''')
     
+    # Tipo di pagamento: checkout, renewal (rinnovo), invoice (altre fatture)
+    cur.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS kind TEXT DEFAULT 'checkout'")
+    
+    # ==========================================================================
+    # TABELLA: Riepilogo giornaliero delle entrate (aggiornato a ogni pagamento)
+    # ==========================================================================
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS revenue_daily (
+            day DATE PRIMARY KEY,
+            revenue BIGINT DEFAULT 0,
+            payments INTEGER DEFAULT 0,
+            failed_payments INTEGER DEFAULT 0
+        )
+    ''')
+    
+    # Primo avvio: ricostruisci il riepilogo dai pagamenti già registrati
+    cur.execute('''
+        INSERT INTO revenue_daily (day, revenue, payments, failed_payments)
+        SELECT payment_date::date,
+               COALESCE(SUM(amount) FILTER (WHERE status = 'succeeded'), 0),
+               COUNT(*) FILTER (WHERE status = 'succeeded'),
+               COUNT(*) FILTER (WHERE status = 'failed')
+        FROM payments
+        WHERE NOT EXISTS (SELECT 1 FROM revenue_daily)
+        GROUP BY payment_date::date
+    ''')
+    
     # Tabella ticket supporto
     cur.execute('''
         CREATE TABLE IF NOT EXISTS support_tickets (
@@ -220,6 +358,81 @@ def init_db():
         )
     ''')
     
+    # ==========================================================================
+    # TABELLE: Persistenza bot (conversazioni in corso e user_data)
+    # ==========================================================================
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name TEXT NOT NULL,
+            conversation_key TEXT NOT NULL,
+            state JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, conversation_key)
+        )
+    ''')
+    
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL DEFAULT '{}'::jsonb,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # ==========================================================================
+    # TABELLA: Eventi Stripe ricevuti (idempotenza ed elaborazione asincrona)
+    # ==========================================================================
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS stripe_events (
+            event_id TEXT PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            locked_at TIMESTAMP,
+            processed_at TIMESTAMP
+        )
+    ''')
+    
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_stripe_events_queue
+        ON stripe_events (next_attempt_at)
+        WHERE status IN ('pending', 'processing')
+    ''')
+    
+    # ==========================================================================
+    # TABELLA: Registro notifiche inviate (una per utente, tipo e periodo)
+    # ==========================================================================
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS notification_ledger (
+            user_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            period TEXT NOT NULL,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, kind, period)
+        )
+    ''')
+    
+    # ==========================================================================
+    # TABELLA: Avanzamento dei task schedulati suddivisi in fette
+    # ==========================================================================
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS job_progress (
+            job_name TEXT NOT NULL,
+            run_key TEXT NOT NULL,
+            shard INTEGER NOT NULL,
+            shards INTEGER NOT NULL,
+            processed INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            planned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            PRIMARY KEY (job_name, run_key, shard)
+        )
+    ''')
+    
     conn.commit()
     conn.close()
     logger.info("Database inizializzato con successo")
@@ -240,11 +453,15 @@ def create_consent_record(
     birth_date: str,
     birth_place: str,
     residence: str,
+    document: str,
+    document_date: str,
     telegram_username: str = None,
     ip_address: str = None
 ) -> dict:
     """
     Crea un record di consenso e genera un OTP.
+    `document` è il testo mostrato all'utente (render_consent_document) e
+    `document_date` la data riportata: se ne salva l'hash così com'è.
     Restituisce il codice OTP generato.
     """
     conn = get_connection()
@@ -253,10 +470,8 @@ def create_consent_record(
     otp_code = generate_otp(6)
     otp_generated_at = datetime.now()
     
-    # Hash del documento per tracciabilità
-    import hashlib
-    document_content = f"CONSENSO_V1.0_{user_id}_{otp_generated_at.isoformat()}"
-    document_hash = hashlib.sha256(document_content.encode()).hexdigest()
+    # Hash del documento accettato (lo stesso testo riportato nella ricevuta)
+    doc_hash = document_hash(document)
     
     try:
         # Elimina eventuali record precedenti non confermati
@@ -270,13 +485,14 @@ def create_consent_record(
             INSERT INTO user_consents (
                 user_id, full_name, birth_date, birth_place, residence,
                 otp_code, otp_generated_at, telegram_user_id, telegram_username,
-                ip_address, document_hash
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ip_address, document_version, document_hash, consent_metadata
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             RETURNING consent_id
         ''', (
             user_id, full_name, birth_date, birth_place, residence,
             otp_code, otp_generated_at, user_id, telegram_username,
-            ip_address, document_hash
+            ip_address, CONSENT_DOCUMENT_VERSION, doc_hash,
+            json.dumps({'document_date': document_date})
         ))
         
         consent_id = cur.fetchone()['consent_id']
@@ -296,7 +512,7 @@ def create_consent_record(
             'success': True,
             'consent_id': consent_id,
             'otp_code': otp_code,
-            'expires_at': otp_generated_at + timedelta(minutes=10)
+            'expires_at': otp_generated_at + timedelta(minutes=OTP_VALIDITY_MINUTES)
         }
         
     except Exception as e:
@@ -309,106 +525,113 @@ def create_consent_record(
 def verify_otp(user_id: int, otp_input: str, ip_address: str = None) -> dict:
     """
     Verifica il codice OTP inserito dall'utente.
+    
+    Tutto avviene in un'unica istruzione: blocco del consenso in attesa,
+    controllo di scadenza e tentativi, incremento del contatore, conferma
+    (consenso e utente) e log. Due invii contemporanei non possono quindi
+    superare entrambi il limite di tentativi; Python interpreta solo l'esito.
     """
     conn = get_connection()
     cur = conn.cursor()
     
+    params = {
+        'user_id': user_id,
+        'otp': otp_input.strip(),
+        'ip': ip_address,
+        'now': datetime.now(),
+        'validity': OTP_VALIDITY_MINUTES,
+        'max_attempts': OTP_MAX_ATTEMPTS,
+    }
+    
     try:
-        # Recupera il record di consenso
-        cur.execute('''
-            SELECT * FROM user_consents 
-            WHERE user_id = %s AND is_confirmed = FALSE
-            ORDER BY created_at DESC LIMIT 1
-        ''', (user_id,))
-        
-        consent = cur.fetchone()
-        
-        if not consent:
-            conn.close()
-            return {'success': False, 'error': 'Nessun consenso in attesa trovato'}
-        
-        # Verifica scadenza OTP (10 minuti)
-        otp_generated = consent['otp_generated_at']
-        if datetime.now() - otp_generated > timedelta(minutes=10):
-            # Log tentativo fallito
-            cur.execute('''
-                INSERT INTO otp_log (user_id, otp_code, action, success, ip_address)
-                VALUES (%s, %s, 'verify_expired', FALSE, %s)
-            ''', (user_id, otp_input, ip_address))
-            conn.commit()
-            conn.close()
-            return {'success': False, 'error': 'Codice OTP scaduto. Richiedi un nuovo codice.'}
-        
-        # Verifica numero tentativi (max 5)
-        if consent['otp_attempts'] >= 5:
-            cur.execute('''
-                INSERT INTO otp_log (user_id, otp_code, action, success, ip_address)
-                VALUES (%s, %s, 'verify_max_attempts', FALSE, %s)
-            ''', (user_id, otp_input, ip_address))
-            conn.commit()
-            conn.close()
-            return {'success': False, 'error': 'Troppi tentativi. Richiedi un nuovo codice.'}
-        
-        # Incrementa tentativi
         cur.execute('''
-            UPDATE user_consents SET otp_attempts = otp_attempts + 1
-            WHERE consent_id = %s
-        ''', (consent['consent_id'],))
-        
-        # Verifica OTP
-        if otp_input.strip() != consent['otp_code']:
-            cur.execute('''
+            WITH target AS (
+                SELECT consent_id,
+                       otp_generated_at < %(now)s - %(validity)s * INTERVAL '1 minute' AS expired,
+                       otp_attempts >= %(max_attempts)s AS exhausted
+                FROM user_consents
+                WHERE user_id = %(user_id)s AND is_confirmed = FALSE
+                ORDER BY created_at DESC LIMIT 1
+                FOR UPDATE
+            ),
+            attempt AS (
+                UPDATE user_consents c SET
+                    otp_attempts = c.otp_attempts + 1,
+                    is_confirmed = (c.otp_code = %(otp)s),
+                    confirmed_at = CASE WHEN c.otp_code = %(otp)s THEN %(now)s END,
+                    otp_verified_at = CASE WHEN c.otp_code = %(otp)s THEN %(now)s END,
+                    ip_address = COALESCE(c.ip_address, %(ip)s)
+                FROM target t
+                WHERE c.consent_id = t.consent_id
+                AND NOT t.expired AND NOT t.exhausted
+                RETURNING c.consent_id, c.is_confirmed, c.otp_attempts, c.confirmed_at, c.full_name
+            ),
+            confirm_user AS (
+                UPDATE users SET
+                    consent_completed = TRUE,
+                    consent_completed_at = %(now)s
+                FROM attempt a
+                WHERE users.user_id = %(user_id)s AND a.is_confirmed
+            ),
+            log AS (
                 INSERT INTO otp_log (user_id, otp_code, action, success, ip_address)
-                VALUES (%s, %s, 'verify_wrong', FALSE, %s)
-            ''', (user_id, otp_input, ip_address))
-            conn.commit()
-            conn.close()
-            remaining = 5 - (consent['otp_attempts'] + 1)
-            return {'success': False, 'error': f'Codice OTP errato. Tentativi rimanenti: {remaining}'}
-        
-        # OTP corretto - conferma il consenso
-        confirmed_at = datetime.now()
-        
-        cur.execute('''
-            UPDATE user_consents SET 
-                is_confirmed = TRUE,
-                confirmed_at = %s,
-                otp_verified_at = %s,
-                ip_address = COALESCE(ip_address, %s)
-            WHERE consent_id = %s
-        ''', (confirmed_at, confirmed_at, ip_address, consent['consent_id']))
-        
-        # Aggiorna lo stato dell'utente
-        cur.execute('''
-            UPDATE users SET 
-                consent_completed = TRUE,
-                consent_completed_at = %s
-            WHERE user_id = %s
-        ''', (confirmed_at, user_id))
-        
-        # Log successo
-        cur.execute('''
-            INSERT INTO otp_log (user_id, otp_code, action, success, ip_address)
-            VALUES (%s, %s, 'verify_success', TRUE, %s)
-        ''', (user_id, otp_input, ip_address))
+                SELECT %(user_id)s, %(otp)s,
+                       CASE WHEN a.is_confirmed THEN 'verify_success'
+                            WHEN a.consent_id IS NOT NULL THEN 'verify_wrong'
+                            WHEN t.expired THEN 'verify_expired'
+                            ELSE 'verify_max_attempts' END,
+                       COALESCE(a.is_confirmed, FALSE), %(ip)s
+                FROM target t LEFT JOIN attempt a ON a.consent_id = t.consent_id
+            )
+            SELECT t.consent_id AS pending_id, t.expired, t.exhausted,
+                   a.consent_id, a.is_confirmed, a.otp_attempts, a.confirmed_at, a.full_name
+            FROM (SELECT 1) AS one
+            LEFT JOIN target t ON TRUE
+            LEFT JOIN attempt a ON TRUE
+        ''', params)
         
+        row = cur.fetchone()
         conn.commit()
         conn.close()
         
-        logger.info(f"Consenso confermato per utente {user_id}")
-        
-        return {
-            'success': True,
-            'consent_id': consent['consent_id'],
-            'confirmed_at': confirmed_at,
-            'full_name': consent['full_name']
-        }
-        
     except Exception as e:
         conn.rollback()
         conn.close()
         logger.error(f"Errore verifica OTP: {e}")
         return {'success': False, 'error': str(e)}
+    
+    if row['pending_id'] is None:
+        return {'success': False, 'error': 'Nessun consenso in attesa trovato'}
+    if row['expired']:
+        return {'success': False, 'error': 'Codice OTP scaduto. Richiedi un nuovo codice.'}
+    if row['exhausted']:
+        return {'success': False, 'error': 'Troppi tentativi. Richiedi un nuovo codice.'}
+    if not row['is_confirmed']:
+        remaining = OTP_MAX_ATTEMPTS - row['otp_attempts']
+        return {'success': False, 'error': f'Codice OTP errato. Tentativi rimanenti: {remaining}'}
+    
+    logger.info(f"Consenso confermato per utente {user_id}")
+    
+    return {
+        'success': True,
+        'consent_id': row['consent_id'],
+        'confirmed_at': row['confirmed_at'],
+        'full_name': row['full_name']
+    }
+
+
+def log_otp_event(user_id: int, action: str, success: bool, ip_address: str = None):
+    """Registra nel log OTP un esito finale (senza il codice inserito)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        INSERT INTO otp_log (user_id, action, success, ip_address)
+        VALUES (%s, %s, %s, %s)
+    ''', (user_id, action, success, ip_address))
+    
+    conn.commit()
+    conn.close()
 
 
 def get_user_consent(user_id: int) -> dict:
@@ -498,7 +721,7 @@ def regenerate_otp(user_id: int, ip_address: str = None) -> dict:
         return {
             'success': True,
             'otp_code': new_otp,
-            'expires_at': otp_generated_at + timedelta(minutes=10)
+            'expires_at': otp_generated_at + timedelta(minutes=OTP_VALIDITY_MINUTES)
         }
         
     except Exception as e:
@@ -692,6 +915,21 @@ def get_user(user_id: int) -> dict:
     return dict(result) if result else None
 
 
+def get_user_id_by_customer(stripe_customer_id: str) -> int:
+    """Restituisce l'utente associato a un cliente Stripe (None se sconosciuto)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute(
+        'SELECT user_id FROM users WHERE stripe_customer_id = %s LIMIT 1',
+        (stripe_customer_id,)
+    )
+    result = cur.fetchone()
+    
+    conn.close()
+    return result['user_id'] if result else None
+
+
 def is_subscribed(user_id: int) -> bool:
     """Verifica se un utente ha un abbonamento attivo."""
     user = get_user(user_id)
@@ -699,6 +937,11 @@ def is_subscribed(user_id: int) -> bool:
     if not user:
         return False
     
+    return is_subscription_active(user)
+
+
+def is_subscription_active(user: dict) -> bool:
+    """Verifica l'abbonamento a partire da una riga della tabella users già letta."""
     if user['subscription_status'] != 'active':
         return False
     
@@ -835,11 +1078,72 @@ def can_access_groups(user_id: int) -> bool:
     if not user:
         return False
     
+    return has_group_access(user)
+
+
+def has_group_access(user: dict) -> bool:
+    """Come can_access_groups, ma su una riga della tabella users già letta."""
     is_user_approved = user.get('approved', False)
     has_consent = user.get('consent_completed', False)
-    is_user_subscribed = is_subscribed(user_id)
+    is_user_subscribed = is_subscription_active(user)
+    
+    return bool(is_user_approved and has_consent and is_user_subscribed)
+
+
+def user_status_from_row(user: dict, has_pending_consent: bool = False) -> str:
+    """
+    Calcola lo stato di un utente (new, pending, rejected, awaiting_consent,
+    consent_pending_otp, subscribed, approved_not_subscribed) da una riga
+    della tabella users già letta.
+    """
+    if not user:
+        return 'new'
+    
+    status = user.get('subscription_status', 'inactive')
+    approved = user.get('approved', False)
+    consent_completed = user.get('consent_completed', False)
+    
+    if status == 'pending':
+        return 'pending'
+    if status == 'rejected':
+        return 'rejected'
     
-    return is_user_approved and has_consent and is_user_subscribed
+    if approved:
+        if not consent_completed:
+            if has_pending_consent:
+                return 'consent_pending_otp'
+            return 'awaiting_consent'
+        if is_subscription_active(user):
+            return 'subscribed'
+        return 'approved_not_subscribed'
+    return 'new'
+
+
+def get_users_for_join_requests(user_ids: list) -> dict:
+    """
+    Recupera in una sola query gli utenti di un blocco di richieste di accesso,
+    con l'indicazione di un eventuale consenso in attesa di OTP.
+    Restituisce {user_id: riga}; gli utenti sconosciuti non sono presenti.
+    """
+    if not user_ids:
+        return {}
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        SELECT u.*, EXISTS (
+            SELECT 1 FROM user_consents c
+            WHERE c.user_id = u.user_id AND c.is_confirmed = FALSE
+        ) AS has_pending_consent
+        FROM users u
+        WHERE u.user_id = ANY(%s)
+    ''', (list(user_ids),))
+    
+    results = cur.fetchall()
+    conn.close()
+    
+    return {r['user_id']: dict(r) for r in results}
 
 
 # =============================================================================
@@ -866,13 +1170,16 @@ def get_subscription_info(user_id: int) -> dict:
     }
 
 
-def activate_subscription(user_id: int, stripe_customer_id: str, stripe_subscription_id: str = None, days: int = 30):
-    """Attiva o rinnova l'abbonamento di un utente."""
-    conn = get_connection()
-    cur = conn.cursor()
-    
+def _activate_subscription(cur, user_id: int, stripe_customer_id: str,
+                           stripe_subscription_id: str = None, days: int = 30,
+                           period_end: int = None):
+    # Con period_end (timestamp Stripe) la scadenza coincide con la fine del
+    # periodo su Stripe, come la confronta la riconciliazione
     start_date = datetime.now().date()
-    end_date = start_date + timedelta(days=days)
+    if period_end:
+        end_date = datetime.fromtimestamp(period_end).date()
+    else:
+        end_date = start_date + timedelta(days=days)
     
     cur.execute('''
         UPDATE users SET 
@@ -885,39 +1192,65 @@ def activate_subscription(user_id: int, stripe_customer_id: str, stripe_subscrip
         WHERE user_id = %s
     ''', (start_date, end_date, stripe_customer_id, stripe_subscription_id, user_id))
     
+    return end_date
+
+
+def activate_subscription(user_id: int, stripe_customer_id: str, stripe_subscription_id: str = None, days: int = 30):
+    """Attiva o rinnova l'abbonamento di un utente."""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    end_date = _activate_subscription(cur, user_id, stripe_customer_id, stripe_subscription_id, days)
+    
     conn.commit()
     conn.close()
     logger.info(f"Abbonamento attivato per utente {user_id} fino a {end_date}")
 
 
+def _deactivate_subscription(cur, user_id: int):
+    cur.execute('''
+        UPDATE users SET subscription_status = 'expired'
+        WHERE user_id = %s
+    ''', (user_id,))
+
+
 def deactivate_subscription(user_id: int):
     """Disattiva l'abbonamento di un utente (ma resta approvato e con consenso!)."""
     conn = get_connection()
     cur = conn.cursor()
     
-    cur.execute('''
-        UPDATE users SET subscription_status = 'expired'
-        WHERE user_id = %s
-    ''', (user_id,))
+    _deactivate_subscription(cur, user_id)
     
     conn.commit()
     conn.close()
     logger.info(f"Abbonamento disattivato per utente {user_id}")
 
 
-def get_expiring_subscriptions(days: int = 3) -> list:
-    """Recupera gli utenti con abbonamento in scadenza nei prossimi X giorni."""
+def get_expiring_subscriptions(days: int = 3, shard: int = 0, shards: int = 1) -> list:
+    """
+    Recupera gli utenti con abbonamento in scadenza nei prossimi X giorni
+    che non hanno ancora ricevuto il promemoria per questa scadenza.
+    Con shards > 1 restituisce solo la fetta `shard` (user_id modulo shards).
+    """
     conn = get_connection()
     cur = conn.cursor()
     
     target_date = datetime.now().date() + timedelta(days=days)
     
+    # Anti-join sul registro notifiche: un solo promemoria per periodo
     cur.execute('''
-        SELECT * FROM users 
-        WHERE subscription_status = 'active' 
-        AND subscription_end <= %s
-        AND subscription_end >= CURRENT_DATE
-    ''', (target_date,))
+        SELECT u.* FROM users u
+        WHERE u.subscription_status = 'active' 
+        AND u.subscription_end <= %s
+        AND u.subscription_end >= CURRENT_DATE
+        AND MOD(u.user_id, %s) = %s
+        AND NOT EXISTS (
+            SELECT 1 FROM notification_ledger n
+            WHERE n.user_id = u.user_id
+            AND n.kind = %s
+            AND n.period = TO_CHAR(u.subscription_end, 'YYYY-MM-DD')
+        )
+    ''', (target_date, shards, shard, NOTIFICATION_EXPIRING_REMINDER))
     
     results = cur.fetchall()
     conn.close()
@@ -925,8 +1258,11 @@ def get_expiring_subscriptions(days: int = 3) -> list:
     return [dict(r) for r in results]
 
 
-def get_expired_subscriptions() -> list:
-    """Recupera gli utenti con abbonamento scaduto."""
+def get_expired_subscriptions(shard: int = 0, shards: int = 1) -> list:
+    """
+    Recupera gli utenti con abbonamento scaduto.
+    Con shards > 1 restituisce solo la fetta `shard` (user_id modulo shards).
+    """
     conn = get_connection()
     cur = conn.cursor()
     
@@ -934,7 +1270,8 @@ def get_expired_subscriptions() -> list:
         SELECT * FROM users 
         WHERE subscription_status = 'active' 
         AND subscription_end < CURRENT_DATE
-    ''')
+        AND MOD(user_id, %s) = %s
+    ''', (shards, shard))
     
     results = cur.fetchall()
     conn.close()
@@ -946,16 +1283,36 @@ def get_expired_subscriptions() -> list:
 # FUNZIONI PAGAMENTI
 # =============================================================================
 
-def record_payment(user_id: int, stripe_payment_id: str, amount: int, status: str):
-    """Registra un pagamento nel database."""
+def _record_payment(cur, user_id: int, stripe_payment_id: str, amount: int, status: str,
+                    kind: str = 'checkout', currency: str = 'eur'):
+    # Il riepilogo giornaliero viene aggiornato solo se il pagamento è nuovo
+    cur.execute('''
+        WITH inserted AS (
+            INSERT INTO payments (user_id, stripe_payment_id, amount, currency, status, kind)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (stripe_payment_id) DO NOTHING
+            RETURNING payment_date, amount, status
+        )
+        INSERT INTO revenue_daily (day, revenue, payments, failed_payments)
+        SELECT payment_date::date,
+               CASE WHEN status = 'succeeded' THEN amount ELSE 0 END,
+               CASE WHEN status = 'succeeded' THEN 1 ELSE 0 END,
+               CASE WHEN status = 'failed' THEN 1 ELSE 0 END
+        FROM inserted
+        ON CONFLICT (day) DO UPDATE SET
+            revenue = revenue_daily.revenue + EXCLUDED.revenue,
+            payments = revenue_daily.payments + EXCLUDED.payments,
+            failed_payments = revenue_daily.failed_payments + EXCLUDED.failed_payments
+    ''', (user_id, stripe_payment_id, amount, currency, status, kind))
+
+
+def record_payment(user_id: int, stripe_payment_id: str, amount: int, status: str,
+                   kind: str = 'checkout', currency: str = 'eur'):
+    """Registra un pagamento nel database (una sola volta per stripe_payment_id)."""
     conn = get_connection()
     cur = conn.cursor()
     
-    cur.execute('''
-        INSERT INTO payments (user_id, stripe_payment_id, amount, status)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (stripe_payment_id) DO UPDATE SET status = %s
-    ''', (user_id, stripe_payment_id, amount, status, status))
+    _record_payment(cur, user_id, stripe_payment_id, amount, status, kind, currency)
     
     conn.commit()
     conn.close()
@@ -1061,11 +1418,10 @@ def get_stats() -> dict:
     cur.execute("SELECT COUNT(*) as open FROM support_tickets WHERE status = 'open'")
     open_tickets = cur.fetchone()['open']
     
-    # Entrate del mese
+    # Entrate del mese (dal riepilogo giornaliero)
     cur.execute('''
-        SELECT COALESCE(SUM(amount), 0) as revenue FROM payments 
-        WHERE status = 'succeeded' 
-        AND payment_date >= DATE_TRUNC('month', CURRENT_DATE)
+        SELECT COALESCE(SUM(revenue), 0) as revenue FROM revenue_daily 
+        WHERE day >= DATE_TRUNC('month', CURRENT_DATE)
     ''')
     monthly_revenue = cur.fetchone()['revenue']
     
@@ -1112,3 +1468,438 @@ def log_activity(user_id: int, action: str, details: str = None):
     
     conn.commit()
     conn.close()
+
+
+# =============================================================================
+# FUNZIONI PERSISTENZA BOT (ConversationHandler e user_data)
+# =============================================================================
+
+def load_conversations(name: str) -> dict:
+    """Recupera tutte le conversazioni in corso di un ConversationHandler."""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        SELECT conversation_key, state FROM bot_conversations
+        WHERE name = %s
+    ''', (name,))
+    
+    results = cur.fetchall()
+    conn.close()
+    
+    return {r['conversation_key']: r['state'] for r in results}
+
+
+def load_user_data(user_id: int) -> dict:
+    """Recupera lo user_data salvato di un utente (None se assente)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('SELECT data FROM bot_user_data WHERE user_id = %s', (user_id,))
+    result = cur.fetchone()
+    
+    conn.close()
+    return result['data'] if result else None
+
+
+def save_bot_persistence(user_data: dict, conversations: dict):
+    """
+    Salva in un'unica transazione le modifiche accumulate dalla persistenza.
+    
+    Args:
+        user_data: {user_id: JSON serializzato, oppure None per eliminare}
+        conversations: {(name, conversation_key): JSON dello stato,
+            oppure None per eliminare una conversazione terminata}
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    user_upserts = [(uid, data) for uid, data in user_data.items() if data is not None]
+    user_deletes = [uid for uid, data in user_data.items() if data is None]
+    conv_upserts = [(n, k, state) for (n, k), state in conversations.items() if state is not None]
+    conv_deletes = [(n, k) for (n, k), state in conversations.items() if state is None]
+    
+    try:
+        if user_upserts:
+            execute_values(cur, '''
+                INSERT INTO bot_user_data (user_id, data) VALUES %s
+                ON CONFLICT (user_id) DO UPDATE SET
+                    data = EXCLUDED.data,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', user_upserts, template='(%s, %s::jsonb)')
+        
+        if user_deletes:
+            cur.execute('DELETE FROM bot_user_data WHERE user_id = ANY(%s)', (user_deletes,))
+        
+        if conv_upserts:
+            execute_values(cur, '''
+                INSERT INTO bot_conversations (name, conversation_key, state) VALUES %s
+                ON CONFLICT (name, conversation_key) DO UPDATE SET
+                    state = EXCLUDED.state,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', conv_upserts, template='(%s, %s, %s::jsonb)')
+        
+        if conv_deletes:
+            execute_values(cur, '''
+                DELETE FROM bot_conversations c
+                USING (VALUES %s) AS d(name, conversation_key)
+                WHERE c.name = d.name AND c.conversation_key = d.conversation_key
+            ''', conv_deletes)
+        
+        conn.commit()
+        conn.close()
+        
+    except Exception as e:
+        conn.rollback()
+        conn.close()
+        logger.error(f"Errore salvataggio persistenza: {e}")
+        raise
+
+
+# =============================================================================
+# FUNZIONI AVANZAMENTO TASK SCHEDULATI
+# =============================================================================
+
+def plan_job_shards(job_name: str, run_key: str, shards: int) -> list:
+    """
+    Registra l'esecuzione `run_key` di un task suddiviso in `shards` fette
+    (se non già registrata) e restituisce le fette non ancora completate.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    execute_values(cur, '''
+        INSERT INTO job_progress (job_name, run_key, shard, shards) VALUES %s
+        ON CONFLICT (job_name, run_key, shard) DO NOTHING
+    ''', [(job_name, run_key, shard, shards) for shard in range(shards)])
+    
+    cur.execute('''
+        SELECT shard FROM job_progress
+        WHERE job_name = %s AND run_key = %s AND completed_at IS NULL
+        ORDER BY shard
+    ''', (job_name, run_key))
+    
+    results = cur.fetchall()
+    conn.commit()
+    conn.close()
+    
+    return [r['shard'] for r in results]
+
+
+def get_incomplete_job_shards(job_name: str, run_key: str) -> list:
+    """Fette già pianificate ma non completate (es. dopo un riavvio)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        SELECT shard FROM job_progress
+        WHERE job_name = %s AND run_key = %s AND completed_at IS NULL
+        ORDER BY shard
+    ''', (job_name, run_key))
+    
+    results = cur.fetchall()
+    conn.close()
+    
+    return [r['shard'] for r in results]
+
+
+def complete_job_shard(job_name: str, run_key: str, shard: int, processed: int, failed: int):
+    """Segna come completata una fetta di un task schedulato."""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        UPDATE job_progress SET
+            processed = %s,
+            failed = %s,
+            completed_at = CURRENT_TIMESTAMP
+        WHERE job_name = %s AND run_key = %s AND shard = %s
+    ''', (processed, failed, job_name, run_key, shard))
+    
+    conn.commit()
+    conn.close()
+
+
+# =============================================================================
+# FUNZIONI REGISTRO NOTIFICHE
+# =============================================================================
+
+def claim_notifications(kind: str, recipients: list) -> set:
+    """
+    Prenota l'invio di una notifica per una lista di (user_id, periodo).
+    Restituisce gli user_id effettivamente prenotati: quelli già presenti
+    nel registro (notifica già inviata) vengono esclusi.
+    """
+    if not recipients:
+        return set()
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    rows = execute_values(cur, '''
+        INSERT INTO notification_ledger (user_id, kind, period) VALUES %s
+        ON CONFLICT (user_id, kind, period) DO NOTHING
+        RETURNING user_id
+    ''', [(user_id, kind, period) for user_id, period in recipients], fetch=True)
+    
+    conn.commit()
+    conn.close()
+    
+    return {r['user_id'] for r in rows}
+
+
+def release_notification(user_id: int, kind: str, period: str):
+    """Annulla una prenotazione se l'invio è fallito (sarà ritentato)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        DELETE FROM notification_ledger
+        WHERE user_id = %s AND kind = %s AND period = %s
+    ''', (user_id, kind, period))
+    
+    conn.commit()
+    conn.close()
+
+
+# =============================================================================
+# FUNZIONI EVENTI STRIPE
+# =============================================================================
+# Stati: pending (da elaborare), processing (preso da un worker),
+# done (elaborato), dead (scartato dopo troppi tentativi)
+
+def store_stripe_event(event_id: str, event_type: str, payload: str) -> bool:
+    """
+    Salva un evento ricevuto dal webhook. Restituisce False se l'evento
+    era già stato ricevuto (consegna ripetuta da Stripe).
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        INSERT INTO stripe_events (event_id, event_type, payload)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (event_id) DO NOTHING
+        RETURNING event_id
+    ''', (event_id, event_type, payload))
+    
+    inserted = cur.fetchone() is not None
+    conn.commit()
+    conn.close()
+    return inserted
+
+
+def claim_stripe_events(limit: int = 20, lease_seconds: int = 300) -> list:
+    """
+    Prende in carico fino a `limit` eventi da elaborare. Gli eventi rimasti
+    in 'processing' oltre `lease_seconds` (worker caduto) vengono ripresi.
+    Più worker possono lavorare in parallelo (SKIP LOCKED).
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        UPDATE stripe_events SET
+            status = 'processing',
+            attempts = attempts + 1,
+            locked_at = NOW()
+        WHERE event_id IN (
+            SELECT event_id FROM stripe_events
+            WHERE (status = 'pending' AND next_attempt_at <= NOW())
+            OR (status = 'processing' AND locked_at < NOW() - %s * INTERVAL '1 second')
+            ORDER BY received_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING event_id, event_type, payload, attempts
+    ''', (lease_seconds, limit))
+    
+    events = cur.fetchall()
+    conn.commit()
+    conn.close()
+    return events
+
+
+def apply_stripe_event(event_id: str, action: str, user_id: int, details: dict):
+    """
+    Applica gli effetti di un evento Stripe e lo segna come elaborato nella
+    stessa transazione: un evento produce i suoi effetti una sola volta,
+    anche se due worker lo elaborano in parallelo.
+    Restituisce la nuova scadenza per attivazioni/rinnovi, None altrimenti;
+    solleva LookupError se l'evento era già stato elaborato.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute('''
+            UPDATE stripe_events SET
+                status = 'done',
+                processed_at = NOW(),
+                last_error = NULL
+            WHERE event_id = %s AND status = 'processing'
+            RETURNING event_id
+        ''', (event_id,))
+        
+        if cur.fetchone() is None:
+            conn.rollback()
+            raise LookupError(f"Evento {event_id} già elaborato")
+        
+        end_date = None
+        if action == 'activate_subscription':
+            end_date = _activate_subscription(
+                cur, user_id, details['customer_id'], details.get('subscription_id')
+            )
+            _record_payment(
+                cur, user_id, event_id, details['amount_total'], 'succeeded',
+                'checkout', details.get('currency', 'eur')
+            )
+        elif action == 'renew_subscription':
+            end_date = _activate_subscription(
+                cur, user_id, details.get('customer_id', ''), details.get('subscription_id'),
+                period_end=details.get('period_end')
+            )
+            # La prima fattura è già registrata dal checkout
+            if details.get('billing_reason') != 'subscription_create':
+                kind = 'renewal' if details.get('billing_reason') == 'subscription_cycle' else 'invoice'
+                _record_payment(
+                    cur, user_id, event_id, details['amount'], 'succeeded',
+                    kind, details.get('currency', 'eur')
+                )
+        elif action == 'payment_failed' and user_id:
+            _record_payment(
+                cur, user_id, event_id, details.get('amount', 0), 'failed',
+                'renewal', details.get('currency', 'eur')
+            )
+        elif action == 'cancel_subscription':
+            _deactivate_subscription(cur, user_id)
+        
+        conn.commit()
+        return end_date
+    finally:
+        conn.close()
+
+
+def fail_stripe_event(event_id: str, error: str, max_attempts: int, retry_delay: float) -> str:
+    """
+    Registra un errore di elaborazione: l'evento torna in coda dopo
+    `retry_delay` secondi oppure, superati i tentativi, viene scartato ('dead').
+    Restituisce il nuovo stato.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        UPDATE stripe_events SET
+            status = CASE WHEN attempts >= %s THEN 'dead' ELSE 'pending' END,
+            last_error = %s,
+            next_attempt_at = NOW() + %s * INTERVAL '1 second',
+            locked_at = NULL
+        WHERE event_id = %s AND status = 'processing'
+        RETURNING status
+    ''', (max_attempts, error[:1000], retry_delay, event_id))
+    
+    row = cur.fetchone()
+    conn.commit()
+    conn.close()
+    return row['status'] if row else 'done'
+
+
+# =============================================================================
+# FUNZIONI RICONCILIAZIONE ABBONAMENTI
+# =============================================================================
+
+def get_billing_snapshot() -> list:
+    """Stato locale degli abbonamenti di tutti gli utenti con un cliente Stripe."""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        SELECT user_id, stripe_customer_id, stripe_subscription_id,
+               subscription_status, subscription_end
+        FROM users
+        WHERE stripe_customer_id IS NOT NULL AND stripe_customer_id <> ''
+    ''')
+    results = cur.fetchall()
+    
+    conn.close()
+    return results
+
+
+def apply_subscription_corrections(corrections: list) -> int:
+    """
+    Applica in un'unica UPDATE una lista di correzioni
+    (user_id, subscription_status, subscription_end, stripe_subscription_id).
+    Restituisce il numero di utenti aggiornati.
+    """
+    if not corrections:
+        return 0
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    execute_values(cur, '''
+        UPDATE users u SET
+            subscription_status = v.status,
+            subscription_end = v.subscription_end,
+            stripe_subscription_id = v.subscription_id
+        FROM (VALUES %s) AS v(user_id, status, subscription_end, subscription_id)
+        WHERE u.user_id = v.user_id
+    ''', corrections, template='(%s::bigint, %s, %s::date, %s)', page_size=len(corrections))
+    
+    updated = cur.rowcount
+    conn.commit()
+    conn.close()
+    return updated
+
+
+# =============================================================================
+# FUNZIONI REPORT ENTRATE
+# =============================================================================
+
+def get_revenue_report(days: int = 30) -> dict:
+    """
+    Entrate dal riepilogo giornaliero: mese corrente, ultimi 12 mesi
+    (per mese) e ultimi `days` giorni (per giorno). Importi in centesimi.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        SELECT COALESCE(SUM(revenue), 0) AS revenue,
+               COALESCE(SUM(payments), 0) AS payments,
+               COALESCE(SUM(failed_payments), 0) AS failed_payments
+        FROM revenue_daily
+        WHERE day >= DATE_TRUNC('month', CURRENT_DATE)
+    ''')
+    month = cur.fetchone()
+    
+    cur.execute('''
+        SELECT DATE_TRUNC('month', day)::date AS month,
+               SUM(revenue) AS revenue, SUM(payments) AS payments
+        FROM revenue_daily
+        WHERE day >= DATE_TRUNC('month', CURRENT_DATE) - INTERVAL '11 months'
+        GROUP BY 1
+        ORDER BY 1
+    ''')
+    months = cur.fetchall()
+    
+    cur.execute('''
+        SELECT day, revenue, payments, failed_payments
+        FROM revenue_daily
+        WHERE day > CURRENT_DATE - %s
+        ORDER BY day
+    ''', (days,))
+    daily = cur.fetchall()
+    
+    conn.close()
+    
+    return {
+        'month': month,
+        'months': months,
+        'daily': daily,
+    }
+
+
+# Profilazione di tutte le funzioni pubbliche (deve restare in fondo al modulo)
+db_profiler.instrument_module(globals(), __name__, exclude=('get_connection', 'close_pool', 'generate_otp'))
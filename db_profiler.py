@@ -0,0 +1,240 @@
+"""
+PROFILAZIONE DATABASE - OPERAZIONE RISVEGLIO
+=============================================
+Misura ogni funzione pubblica di database.py (get_user, log_activity, ...):
+
+- numero di chiamate ed errori;
+- latenza p50/p95/p99 (sugli ultimi DB_PROFILE_SAMPLES campioni);
+- query eseguite e righe restituite o modificate (rowcount);
+- tempo per ottenere la connessione dal pool.
+
+Le query più lente di DB_SLOW_QUERY_MS finiscono nel log delle query lente
+(logger e ultime voci in memoria) con i parametri oscurati: si vedono solo
+i tipi, mai i valori (nomi, date di nascita, codici OTP). Anche i valori
+già inseriti nel testo SQL (execute_values, mogrify) diventano ?.
+
+Il comando admin /dbprofilo mostra le funzioni che pesano di più.
+"""
+
+import contextvars
+import functools
+import logging
+import re
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import metrics
+from config import DB_PROFILING, DB_SLOW_QUERY_MS, DB_PROFILE_SAMPLES
+
+logger = logging.getLogger(__name__)
+
+# Query lente tenute in memoria per il comando admin
+SLOW_QUERY_HISTORY = 50
+# Lunghezza massima del testo della query nel log
+MAX_QUERY_LENGTH = 300
+
+metrics.set_buckets('db_function_queries', metrics.COUNT_BUCKETS)
+
+# Funzione di database.py in esecuzione (anche nei thread di asyncio.to_thread)
+_current: contextvars.ContextVar[Optional['FunctionStats']] = contextvars.ContextVar(
+    'db_profiler_function', default=None
+)
+
+_lock = threading.Lock()
+_stats = {}
+_slow_queries = deque(maxlen=SLOW_QUERY_HISTORY)
+
+
+class FunctionStats:
+    """Statistiche cumulative di una funzione di database.py."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.queries = 0
+        self.rows = 0
+        self.acquire_seconds = 0.0
+        self.samples = deque(maxlen=DB_PROFILE_SAMPLES)
+
+    def percentile(self, q: float) -> float:
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _stats_for(name: str) -> FunctionStats:
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = FunctionStats(name)
+        return stats
+
+
+def profile(func):
+    """Avvolge una funzione di database.py con la raccolta delle statistiche."""
+    stats = _stats_for(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Chiamate annidate (una funzione pubblica che ne usa un'altra):
+        # query e connessioni vanno alla funzione più interna
+        token = _current.set(stats)
+        started = time.monotonic()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            _current.reset(token)
+            with _lock:
+                stats.calls += 1
+                stats.errors += failed
+                stats.total_seconds += elapsed
+                stats.samples.append(elapsed)
+            metrics.observe('db_function_seconds', elapsed, function=stats.name)
+
+    wrapper._profiled = True
+    return wrapper
+
+
+def instrument_module(namespace: dict, module_name: str, exclude=()) -> int:
+    """
+    Sostituisce nel namespace del modulo le funzioni pubbliche definite nel
+    modulo stesso con la versione profilata. Restituisce quante ne ha avvolte.
+    """
+    if not DB_PROFILING:
+        return 0
+    count = 0
+    for name, value in list(namespace.items()):
+        if (name.startswith('_') or name in exclude or not callable(value) or isinstance(value, type)
+                or getattr(value, '__module__', None) != module_name or getattr(value, '_profiled', False)):
+            continue
+        namespace[name] = profile(value)
+        count += 1
+    return count
+
+
+def record_acquire(seconds: float):
+    """Tempo per ottenere una connessione (chiamata da get_connection)."""
+    metrics.observe('db_acquire_seconds', seconds)
+    stats = _current.get()
+    if stats is not None:
+        with _lock:
+            stats.acquire_seconds += seconds
+
+
+def _redact(params) -> str:
+    if params is None:
+        return '-'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f"{k}: <{type(v).__name__}>" for k, v in params.items()) + '}'
+    if isinstance(params, (list, tuple)):
+        return '(' + ', '.join(f"<{type(v).__name__}>" for v in params) + ')'
+    return f"<{type(params).__name__}>"
+
+
+# Letterali nel testo SQL (stringhe e numeri): execute_values e mogrify
+# inseriscono i valori nella query, che quindi non arrivano come parametri
+_STRING_LITERAL = re.compile(r"[EeBbXx]?'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?(?![\w.])")
+
+
+def _redact_query(text: str) -> str:
+    """Testo della query senza valori: letterali sostituiti da ?."""
+    text = _STRING_LITERAL.sub('?', text)
+    return _NUMBER_LITERAL.sub('?', text)
+
+
+def record_query(query, params, seconds: float, rowcount: int):
+    """Registra una query (chiamata dal cursore di database.py)."""
+    stats = _current.get()
+    if stats is not None:
+        with _lock:
+            stats.queries += 1
+            stats.rows += max(rowcount, 0)
+
+    if seconds * 1000 < DB_SLOW_QUERY_MS:
+        return
+    text = query.decode('utf-8', 'replace') if isinstance(query, bytes) else str(query)
+    entry = {
+        'at': time.time(),
+        'function': stats.name if stats else '-',
+        'ms': round(seconds * 1000, 1),
+        'query': re.sub(r'\s+', ' ', _redact_query(text)).strip()[:MAX_QUERY_LENGTH],
+        'params': _redact(params),
+    }
+    _slow_queries.append(entry)
+    metrics.inc('db_slow_queries_total', function=entry['function'])
+    logger.warning(
+        f"Query lenta ({entry['ms']} ms) in {entry['function']}: {entry['query']} "
+        f"parametri {entry['params']}"
+    )
+
+
+def report(limit: int = 10) -> list:
+    """Funzioni ordinate per tempo totale sul database (le più pesanti prima)."""
+    with _lock:
+        rows = [
+            {
+                'function': s.name,
+                'calls': s.calls,
+                'errors': s.errors,
+                'total_seconds': s.total_seconds,
+                'p50_ms': s.percentile(0.5) * 1000,
+                'p95_ms': s.percentile(0.95) * 1000,
+                'p99_ms': s.percentile(0.99) * 1000,
+                'queries_per_call': s.queries / s.calls,
+                'rows_per_call': s.rows / s.calls,
+                'acquire_ms': s.acquire_seconds / s.calls * 1000,
+            }
+            for s in _stats.values() if s.calls
+        ]
+    rows.sort(key=lambda r: r['total_seconds'], reverse=True)
+    return rows[:limit]
+
+
+def slow_queries(limit: int = 5) -> list:
+    """Ultime query lente (le più recenti prima)."""
+    return list(_slow_queries)[::-1][:limit]
+
+
+def reset():
+    """Azzera statistiche e log delle query lente."""
+    with _lock:
+        for stats in _stats.values():
+            stats.__init__(stats.name)
+        _slow_queries.clear()
+
+
+def format_report(limit: int = 10) -> str:
+    """Report leggibile (testo semplice) per il comando admin."""
+    rows = report(limit)
+    if not rows:
+        return "📊 Nessuna chiamata al database registrata."
+
+    lines = ["📊 FUNZIONI DATABASE (per tempo totale)", ""]
+    for r in rows:
+        lines.append(
+            f"{r['function']}: {r['calls']} chiamate, {r['total_seconds']:.1f}s totali"
+            + (f", {r['errors']} errori" if r['errors'] else "")
+        )
+        lines.append(
+            f"  p50/p95/p99 {r['p50_ms']:.0f}/{r['p95_ms']:.0f}/{r['p99_ms']:.0f} ms, "
+            f"{r['queries_per_call']:.1f} query e {r['rows_per_call']:.1f} righe per chiamata, "
+            f"connessione {r['acquire_ms']:.1f} ms"
+        )
+
+    slow = slow_queries()
+    if slow:
+        lines += ["", f"🐢 QUERY LENTE (oltre {DB_SLOW_QUERY_MS} ms)"]
+        for q in slow:
+            lines.append(f"{q['function']} {q['ms']} ms: {q['query'][:120]}")
+    return "\n".join(lines)
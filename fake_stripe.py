@@ -0,0 +1,217 @@
+"""
+STRIPE FINTO - OPERAZIONE RISVEGLIO
+====================================
+Server HTTP locale che risponde come le API Stripe usate dal bot, per le
+simulazioni di carico (load_simulation.py, webhook_loadgen.py):
+
+- POST /v1/checkout/sessions         sessione di checkout
+- POST /v1/billing_portal/sessions   link al portale clienti
+- GET  /v1/customers/{id}            cliente (con metadata.telegram_user_id)
+- GET  /v1/subscriptions             elenco abbonamenti (vuoto)
+
+Con STRIPE_API_BASE=http://127.0.0.1:<porta> la libreria stripe parla con
+questo server invece che con api.stripe.com. Contiene anche la firma degli
+eventi webhook (come fa Stripe) e la costruzione di eventi sintetici.
+
+Per avviarlo da solo: python fake_stripe.py --porta 12111
+"""
+
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import time
+import uuid
+from typing import Optional
+
+from aiohttp import web
+
+# Chiavi dell'app aiohttp
+CUSTOMERS_KEY = 'fake_stripe_customers'
+LATENCY_KEY = 'fake_stripe_latency'
+CALLS_KEY = 'fake_stripe_calls'
+
+_ids = itertools.count(1)
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}_sim{next(_ids)}{uuid.uuid4().hex[:8]}"
+
+
+def _error(status: int, message: str, code: str = 'resource_missing'):
+    return web.json_response(
+        {'error': {'type': 'invalid_request_error', 'code': code, 'message': message}},
+        status=status
+    )
+
+
+def _metadata(form) -> dict:
+    """Estrae metadata[...] da un corpo application/x-www-form-urlencoded."""
+    return {k[len('metadata['):-1]: v for k, v in form.items() if k.startswith('metadata[')}
+
+
+async def _delay(request, name: str):
+    request.app[CALLS_KEY][name] = request.app[CALLS_KEY].get(name, 0) + 1
+    if request.app[LATENCY_KEY]:
+        await asyncio.sleep(request.app[LATENCY_KEY])
+
+
+async def create_checkout_session(request):
+    await _delay(request, 'checkout.sessions.create')
+    form = await request.post()
+    session_id = _new_id('cs')
+    return web.json_response({
+        'id': session_id,
+        'object': 'checkout.session',
+        'mode': form.get('mode', 'subscription'),
+        'status': 'open',
+        'url': f"https://checkout.example.test/pay/{session_id}",
+        'expires_at': int(form.get('expires_at') or time.time() + 3600),
+        'customer': None,
+        'metadata': _metadata(form),
+    })
+
+
+async def create_portal_session(request):
+    await _delay(request, 'billing_portal.sessions.create')
+    form = await request.post()
+    session_id = _new_id('bps')
+    return web.json_response({
+        'id': session_id,
+        'object': 'billing_portal.session',
+        'customer': form.get('customer'),
+        'url': f"https://billing.example.test/session/{session_id}",
+    })
+
+
+async def retrieve_customer(request):
+    await _delay(request, 'customers.retrieve')
+    customer = request.app[CUSTOMERS_KEY].get(request.match_info['customer_id'])
+    if customer is None:
+        return _error(404, f"No such customer: '{request.match_info['customer_id']}'")
+    return web.json_response(customer)
+
+
+async def list_subscriptions(request):
+    await _delay(request, 'subscriptions.list')
+    return web.json_response({'object': 'list', 'url': '/v1/subscriptions', 'has_more': False, 'data': []})
+
+
+async def root(request):
+    return web.Response(text='fake stripe')
+
+
+def register_customer(app, customer_id: str, user_id: Optional[int]) -> dict:
+    """Registra un cliente (metadata.telegram_user_id = user_id, se presente)."""
+    customer = {
+        'id': customer_id,
+        'object': 'customer',
+        'metadata': {'telegram_user_id': str(user_id)} if user_id else {},
+    }
+    app[CUSTOMERS_KEY][customer_id] = customer
+    return customer
+
+
+def create_app(latency: float = 0.0) -> web.Application:
+    """App aiohttp del server finto; `latency` simula il tempo di risposta (secondi)."""
+    app = web.Application()
+    app[CUSTOMERS_KEY] = {}
+    app[LATENCY_KEY] = latency
+    app[CALLS_KEY] = {}
+    app.router.add_post('/v1/checkout/sessions', create_checkout_session)
+    app.router.add_post('/v1/billing_portal/sessions', create_portal_session)
+    app.router.add_get('/v1/customers/{customer_id}', retrieve_customer)
+    app.router.add_get('/v1/subscriptions', list_subscriptions)
+    app.router.add_route('*', '/', root)
+    return app
+
+
+async def start_server(app: web.Application, port: int, host: str = '127.0.0.1') -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# =============================================================================
+# EVENTI WEBHOOK SINTETICI
+# =============================================================================
+
+def sign_payload(payload: bytes, secret: str, timestamp: Optional[int] = None) -> str:
+    """Header Stripe-Signature per il payload (schema v1, come Stripe)."""
+    timestamp = timestamp or int(time.time())
+    signed = f"{timestamp}.".encode() + payload
+    signature = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def build_event(event_type: str, data: dict, event_id: Optional[str] = None) -> dict:
+    """Evento Stripe con l'oggetto `data` (stessa struttura inviata da Stripe)."""
+    return {
+        'id': event_id or _new_id('evt'),
+        'object': 'event',
+        'api_version': '2023-10-16',
+        'created': int(time.time()),
+        'livemode': False,
+        'pending_webhooks': 1,
+        'type': event_type,
+        'data': {'object': data},
+    }
+
+
+def checkout_completed(user_id: int, customer_id: str, amount: int = 2000) -> dict:
+    return build_event('checkout.session.completed', {
+        'id': _new_id('cs'),
+        'object': 'checkout.session',
+        'mode': 'subscription',
+        'customer': customer_id,
+        'subscription': _new_id('sub'),
+        'amount_total': amount,
+        'currency': 'eur',
+        'metadata': {'telegram_user_id': str(user_id)},
+    })
+
+
+def invoice_event(event_type: str, customer_id: str, amount: int = 2000,
+                  billing_reason: str = 'subscription_cycle') -> dict:
+    """invoice.payment_succeeded o invoice.payment_failed."""
+    return build_event(event_type, {
+        'id': _new_id('in'),
+        'object': 'invoice',
+        'customer': customer_id,
+        'subscription': _new_id('sub'),
+        'amount_paid': amount if event_type == 'invoice.payment_succeeded' else 0,
+        'amount_due': amount,
+        'attempt_count': 1,
+        'currency': 'eur',
+        'billing_reason': billing_reason,
+        'lines': {'object': 'list', 'data': [{
+            'object': 'line_item',
+            'period': {'start': int(time.time()), 'end': int(time.time()) + 30 * 86400},
+        }]},
+    })
+
+
+def subscription_deleted(customer_id: str) -> dict:
+    return build_event('customer.subscription.deleted', {
+        'id': _new_id('sub'),
+        'object': 'subscription',
+        'customer': customer_id,
+        'status': 'canceled',
+    })
+
+
+def encode_event(event: dict) -> bytes:
+    return json.dumps(event).encode('utf-8')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Server Stripe finto per le simulazioni")
+    parser.add_argument('--porta', type=int, default=12111)
+    parser.add_argument('--latenza', type=float, default=0.0, help="latenza simulata in millisecondi")
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.latenza / 1000), host='127.0.0.1', port=args.porta)
@@ -0,0 +1,134 @@
+"""
+ESPORTAZIONE DATI PERSONALI (GDPR) - OPERAZIONE RISVEGLIO
+==========================================================
+L'informativa privacy garantisce all'interessato l'accesso ai propri dati.
+Questo modulo esporta i dati di un utente, o di tutti gli utenti, da:
+users, user_consents, payments, support_tickets, activity_log, otp_log.
+
+Formati:
+- jsonl: una riga per record, {"table": ..., "record": {...}};
+- zip: un file JSONL per tabella dentro un archivio zip.
+
+Le righe arrivano dal database con cursori lato server e vengono scritte
+a blocchi: la memoria usata resta costante anche esportando tutta la base.
+Tutte le tabelle sono lette in un'unica transazione REPEATABLE READ, quindi
+l'esportazione è una fotografia coerente della base. I codici OTP non
+vengono mai esportati.
+
+Uso da riga di comando:
+
+    python gdpr_export.py --utente 123456789 --formato zip --output dati.zip
+    python gdpr_export.py --formato jsonl --output tutti.jsonl
+"""
+
+import json
+import logging
+import zipfile
+from typing import BinaryIO, Dict, Optional
+
+from config import EXPORT_CHUNK_SIZE
+from database import get_connection
+
+logger = logging.getLogger(__name__)
+
+# Tabelle esportate, nell'ordine, e colonne escluse
+EXPORT_TABLES = ('users', 'user_consents', 'payments', 'support_tickets', 'activity_log', 'otp_log')
+EXCLUDED_COLUMNS = {
+    'user_consents': {'otp_code'},
+    'otp_log': {'otp_code'},
+}
+
+FORMATS = ('jsonl', 'zip')
+
+
+def iter_table(conn, table: str, user_id: Optional[int] = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Restituisce blocchi di record di una tabella (di un utente o di tutti)
+    letti con un cursore lato server, nella transazione corrente di `conn`.
+    """
+    # Cursore con nome = cursore lato server: le righe arrivano a blocchi
+    cur = conn.cursor(name=f'gdpr_export_{table}')
+    cur.itersize = chunk_size
+    try:
+        if user_id is None:
+            cur.execute(f'SELECT * FROM {table} ORDER BY user_id')
+        else:
+            cur.execute(f'SELECT * FROM {table} WHERE user_id = %s', (user_id,))
+
+        excluded = EXCLUDED_COLUMNS.get(table, set())
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [{k: v for k, v in row.items() if k not in excluded} for row in rows]
+    finally:
+        cur.close()
+
+
+def _encode(records: list, table: Optional[str] = None) -> bytes:
+    if table is None:
+        lines = (json.dumps(r, default=str, ensure_ascii=False) for r in records)
+    else:
+        lines = (json.dumps({'table': table, 'record': r}, default=str, ensure_ascii=False) for r in records)
+    return ''.join(line + '\n' for line in lines).encode('utf-8')
+
+
+def write_export(out: BinaryIO, fmt: str = 'jsonl', user_id: Optional[int] = None) -> Dict[str, int]:
+    """
+    Scrive l'esportazione su `out` (file binario) e restituisce il numero
+    di record esportati per tabella.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Formato non supportato: {fmt}")
+
+    counts = {}
+    conn = get_connection()
+    archive = zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) if fmt == 'zip' else None
+    try:
+        # Un'unica fotografia per tutte le tabelle (sola lettura)
+        conn.cursor().execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        for table in EXPORT_TABLES:
+            counts[table] = 0
+            if archive is not None:
+                with archive.open(f'{table}.jsonl', 'w', force_zip64=True) as member:
+                    for chunk in iter_table(conn, table, user_id):
+                        member.write(_encode(chunk))
+                        counts[table] += len(chunk)
+            else:
+                for chunk in iter_table(conn, table, user_id):
+                    out.write(_encode(chunk, table))
+                    counts[table] += len(chunk)
+    finally:
+        if archive is not None:
+            archive.close()
+        conn.rollback()
+        conn.close()
+
+    logger.info(
+        f"Esportazione GDPR ({'utente ' + str(user_id) if user_id else 'tutti gli utenti'}, {fmt}): "
+        f"{sum(counts.values())} record"
+    )
+    return counts
+
+
+def export_filename(fmt: str, user_id: Optional[int] = None) -> str:
+    return f"dati_{user_id if user_id else 'tutti'}.{fmt}"
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Esportazione GDPR dei dati personali")
+    parser.add_argument('--utente', type=int, help="user_id da esportare (default: tutti)")
+    parser.add_argument('--formato', choices=FORMATS, default='jsonl')
+    parser.add_argument('--output', help="file di destinazione")
+    args = parser.parse_args()
+
+    path = args.output or export_filename(args.formato, args.utente)
+    with open(path, 'wb') as f:
+        counts = write_export(f, args.formato, args.utente)
+    for table, count in counts.items():
+        print(f"{table}: {count}")
+    print(f"Esportazione salvata in {path}")
@@ -0,0 +1,110 @@
+"""
+METRICHE PER HANDLER - OPERAZIONE RISVEGLIO
+============================================
+Misura ogni handler registrato nel bot, compresi stati e fallback dei
+ConversationHandler (consenso, supporto):
+
+- handler_seconds: durata complessiva;
+- handler_db_queries / handler_db_seconds: query eseguite e tempo sul database;
+- handler_telegram_seconds: tempo speso nelle chiamate alla Bot API;
+- handler_stripe_seconds: tempo speso nelle chiamate a Stripe.
+
+Le etichette sono il nome della funzione (handler) e il prefisso dei dati
+della callback (data, es. admin_approve per admin_approve_123).
+Le metriche sono esposte su /metrics dal server aiohttp (webhook.py).
+"""
+
+import functools
+import re
+import time
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, BaseHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+import metrics
+
+# Tipi di chiamata esterna registrati nello scope
+CALL_KINDS = ('db', 'telegram', 'stripe')
+
+# Lunghezza massima del prefisso della callback (limita le etichette)
+MAX_DATA_PREFIX = 32
+
+metrics.set_buckets('handler_db_queries', metrics.COUNT_BUCKETS)
+
+
+def callback_prefix(update: object) -> str:
+    """Prefisso dei dati della callback, senza gli ID numerici finali."""
+    if not isinstance(update, Update) or not update.callback_query:
+        return ''
+    data = update.callback_query.data or ''
+    return re.sub(r'(_-?\d+)+$', '', data)[:MAX_DATA_PREFIX]
+
+
+def instrument_callback(callback, name: str = None):
+    """Avvolge la callback di un handler con la misura delle metriche."""
+    if getattr(callback, '_instrumented', False):
+        return callback
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        labels = {'handler': name, 'data': callback_prefix(update)}
+        started = time.monotonic()
+        outcome = 'ok'
+        with metrics.scope() as scope:
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                raise
+            except Exception:
+                outcome = 'error'
+                raise
+            finally:
+                metrics.observe('handler_seconds', time.monotonic() - started, outcome=outcome, **labels)
+                metrics.observe('handler_db_queries', scope.calls.get('db', 0), **labels)
+                for kind in CALL_KINDS:
+                    metrics.observe(f'handler_{kind}_seconds', scope.seconds.get(kind, 0.0), **labels)
+
+    wrapper._instrumented = True
+    return wrapper
+
+
+def _instrument_handler(handler: BaseHandler) -> int:
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        return sum(_instrument_handler(h) for h in nested)
+
+    handler.callback = instrument_callback(handler.callback)
+    return 1
+
+
+def instrument_handlers(application) -> int:
+    """
+    Strumenta tutti gli handler già registrati (da chiamare dopo l'ultimo
+    add_handler). Restituisce quante callback sono state avvolte.
+    """
+    return sum(
+        _instrument_handler(handler)
+        for handlers in application.handlers.values()
+        for handler in handlers
+    )
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """Client HTTP della Bot API che misura ogni chiamata (per metodo)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        started = time.monotonic()
+        outcome = 'ok'
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.observe('telegram_api_seconds', elapsed, method=url.rsplit('/', 1)[-1], outcome=outcome)
+            metrics.record_call('telegram', elapsed)
@@ -0,0 +1,165 @@
+"""
+CODA RICHIESTE DI ACCESSO AI GRUPPI - OPERAZIONE RISVEGLIO
+===========================================================
+Dopo un annuncio arrivano centinaia di richieste di accesso (biblioteca,
+salotto, brainstorming) in pochi secondi. Invece di gestirle una per una,
+le richieste vengono raccolte in una breve finestra temporale e risolte
+in blocco:
+
+1. una sola query al database per tutti gli utenti del blocco;
+2. approvazioni, rifiuti e messaggi privati inviati in parallelo,
+   con un limite di concorrenza e di richieste al secondo verso Telegram.
+"""
+
+import asyncio
+import logging
+import time
+from typing import List, Optional
+
+from telegram import ChatJoinRequest
+
+from database import get_users_for_join_requests, has_group_access, user_status_from_row
+
+logger = logging.getLogger(__name__)
+
+# Motivazioni del rifiuto in base allo stato dell'utente
+DECLINE_REASONS = {
+    'new': "Non hai ancora richiesto l'accesso. Scrivi /start al bot.",
+    'pending': "La tua richiesta è ancora in attesa di approvazione.",
+    'rejected': "La tua richiesta non è stata approvata.",
+    'awaiting_consent': "Devi completare il modulo di consenso. Scrivi /start.",
+    'consent_pending_otp': "Devi confermare il consenso con OTP. Scrivi /start.",
+    'approved_not_subscribed': "Devi completare l'abbonamento. Scrivi /start."
+}
+
+
+class RateLimiter:
+    """Limita le chiamate a `rate` al secondo, distanziandole in modo uniforme."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._next_slot = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class JoinRequestQueue:
+    """
+    Coda interna delle richieste di accesso.
+
+    Le richieste vengono accumulate per `window` secondi (o fino a
+    `max_batch` elementi) e poi elaborate tutte insieme.
+    """
+
+    def __init__(self, window: float = 1.0, max_batch: int = 200,
+                 concurrency: int = 10, rate_per_second: float = 25):
+        self.window = window
+        self.max_batch = max_batch
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate_per_second)
+
+        self._pending: List[ChatJoinRequest] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._batches = set()
+
+    def enqueue(self, join_request: ChatJoinRequest):
+        """Aggiunge una richiesta alla coda (non bloccante)."""
+        self._pending.append(join_request)
+
+        if len(self._pending) >= self.max_batch:
+            self._start_batch()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._wait_window())
+
+    async def _wait_window(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        self._start_batch()
+
+    def _start_batch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._process_batch(batch))
+        # Mantieni un riferimento finché il blocco non è completato
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _process_batch(self, batch: List[ChatJoinRequest]):
+        started = time.monotonic()
+        user_ids = {req.from_user.id for req in batch}
+
+        try:
+            users = await asyncio.to_thread(get_users_for_join_requests, list(user_ids))
+        except Exception as e:
+            # Senza database non si può decidere: le richieste restano in
+            # sospeso su Telegram e potranno essere gestite manualmente
+            logger.error(f"Errore lettura utenti per {len(batch)} richieste di accesso: {e}")
+            return
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(req: ChatJoinRequest):
+            async with semaphore:
+                await self._dispatch(req, users.get(req.from_user.id))
+
+        await asyncio.gather(*(run(req) for req in batch))
+
+        logger.info(
+            f"Blocco di {len(batch)} richieste di accesso ({len(user_ids)} utenti) "
+            f"elaborato in {time.monotonic() - started:.2f}s"
+        )
+
+    async def _dispatch(self, join_request: ChatJoinRequest, user: Optional[dict]):
+        """Approva o rifiuta una singola richiesta e avvisa l'utente."""
+        user_id = join_request.from_user.id
+        chat = join_request.chat
+        bot = join_request.get_bot()
+
+        if user and has_group_access(user):
+            try:
+                await self.rate_limiter.acquire()
+                await join_request.approve()
+                logger.info(f"Utente {user_id} approvato per {chat.title}")
+            except Exception as e:
+                logger.error(f"Errore approvazione {user_id} per {chat.title}: {e}")
+                return
+            try:
+                await self.rate_limiter.acquire()
+                await bot.send_message(user_id, f"✅ *Accesso Approvato!*\n\nBenvenuto in *{chat.title}*!", parse_mode='Markdown')
+            except Exception as e:
+                logger.error(f"Errore notifica: {e}")
+        else:
+            try:
+                await self.rate_limiter.acquire()
+                await join_request.decline()
+            except Exception as e:
+                logger.error(f"Errore rifiuto {user_id} per {chat.title}: {e}")
+                return
+            user_status = user_status_from_row(user, user.get('has_pending_consent', False)) if user else 'new'
+            try:
+                await self.rate_limiter.acquire()
+                await bot.send_message(user_id, f"❌ *Accesso Negato*\n\n{DECLINE_REASONS.get(user_status, 'Scrivi /start per info.')}", parse_mode='Markdown')
+            except Exception as e:
+                logger.error(f"Errore notifica rifiuto: {e}")
+
+    async def shutdown(self):
+        """Elabora le richieste rimaste in coda e attende i blocchi in corso."""
+        self._start_batch()
+        if self._batches:
+            await asyncio.gather(*self._batches, return_exceptions=True)
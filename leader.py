@@ -0,0 +1,174 @@
+"""
+ELEZIONE DEL LEADER TRA REPLICHE - OPERAZIONE RISVEGLIO
+========================================================
+Con più istanze del bot attive, i task schedulati (promemoria, scadenze)
+devono girare su una sola replica. Il leader è la replica che detiene un
+advisory lock di PostgreSQL su una connessione dedicata:
+
+- il lock è legato alla sessione: se il processo muore o la connessione
+  cade, PostgreSQL lo rilascia e un'altra replica lo acquisisce al giro
+  successivo. Keepalive TCP e idle_session_timeout impostati lato server
+  fanno chiudere in pochi secondi anche la sessione di un leader bloccato
+  o irraggiungibile (failover in pochi secondi);
+- il leader rinnova periodicamente il proprio "lease" verificando la
+  connessione: se non ci riesce entro il tempo previsto, smette subito
+  di comportarsi da leader.
+"""
+
+import asyncio
+import functools
+import logging
+from typing import Awaitable, Callable, List, Optional
+
+import psycopg2
+
+import metrics
+from config import DATABASE_URL, LEADER_SESSION_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """Elezione del leader tramite pg_try_advisory_lock."""
+
+    def __init__(self, lock_id: int, renew_interval: float = 5,
+                 session_timeout: float = LEADER_SESSION_TIMEOUT_SECONDS):
+        self.lock_id = lock_id
+        self.renew_interval = renew_interval
+        self.session_timeout = session_timeout
+        self.is_leader = False
+
+        self._conn = None
+        self._task: Optional[asyncio.Task] = None
+        self._on_elected: List[Callable[[], Awaitable[None]]] = []
+
+    def on_elected(self, callback: Callable[[], Awaitable[None]]):
+        """Registra una coroutine da eseguire quando questa replica diventa leader."""
+        self._on_elected.append(callback)
+
+    def guard(self, func, name: str = None):
+        """
+        Decoratore per i task schedulati: esegue func solo sul leader.
+        `name` etichetta la metrica (i metodi start dei job hanno lo stesso nome).
+        """
+        job = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not self.is_leader:
+                metrics.inc('leader_skipped_jobs_total', job=job)
+                return None
+            return await func(*args, **kwargs)
+        return wrapper
+
+    async def start(self):
+        metrics.set_gauge('leader_is_leader', 0)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Rilascia il lock (se detenuto) e chiude la connessione dedicata."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        conn, self._conn = self._conn, None
+        await asyncio.to_thread(self._close, conn, self.is_leader)
+        if self.is_leader:
+            self._set_leader(False)
+
+    # -------------------------------------------------------------------------
+    # Interni
+    # -------------------------------------------------------------------------
+
+    async def _run(self):
+        while True:
+            try:
+                # Il lease vale un intervallo: se il controllo non risponde in
+                # tempo, questa replica non può più considerarsi leader
+                held = await asyncio.wait_for(
+                    asyncio.to_thread(self._check_or_acquire), self.renew_interval
+                )
+            except asyncio.TimeoutError:
+                logger.warning("Leader: controllo del lock scaduto")
+                held = False
+                # La connessione potrebbe essere bloccata: chiudila in background
+                conn, self._conn = self._conn, None
+                asyncio.get_running_loop().run_in_executor(None, self._close, conn, False)
+            except Exception as e:
+                logger.error(f"Leader: errore connessione al database: {e}")
+                held = False
+                conn, self._conn = self._conn, None
+                await asyncio.to_thread(self._close, conn, False)
+
+            if held != self.is_leader:
+                self._set_leader(held)
+                if held:
+                    await self._run_elected_callbacks()
+
+            await asyncio.sleep(self.renew_interval)
+
+    def _check_or_acquire(self) -> bool:
+        """Eseguito in un thread: rinnova il lease o tenta di acquisire il lock."""
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(
+                DATABASE_URL,
+                connect_timeout=max(1, int(self.renew_interval)),
+                keepalives=1, keepalives_idle=5, keepalives_interval=2, keepalives_count=2,
+                # Keepalive TCP lato server (supportati da tutte le versioni)
+                options='-c tcp_keepalives_idle=5 -c tcp_keepalives_interval=2 -c tcp_keepalives_count=2',
+                application_name='risveglio-leader',
+            )
+            self._conn.autocommit = True
+            self._set_session_timeout(self._conn)
+
+        cur = self._conn.cursor()
+        if self.is_leader:
+            # Il lock di sessione resta nostro finché la connessione è viva
+            cur.execute('SELECT 1')
+            cur.fetchone()
+            return True
+
+        cur.execute('SELECT pg_try_advisory_lock(%s)', (self.lock_id,))
+        return bool(cur.fetchone()[0])
+
+    def _set_session_timeout(self, conn):
+        """
+        Limite lato server della sessione: senza, PostgreSQL tiene il lock di
+        un leader morto o isolato finché non scade il suo keepalive TCP (ore).
+        Il leader interroga la connessione ogni renew_interval, quindi una
+        sessione inattiva più a lungo di session_timeout è abbandonata.
+        idle_session_timeout esiste da PostgreSQL 14: sulle versioni
+        precedenti restano solo i keepalive.
+        """
+        if self.session_timeout <= 0 or conn.server_version < 140000:
+            return
+        timeout_ms = int(max(self.session_timeout, 2 * self.renew_interval) * 1000)
+        conn.cursor().execute('SET idle_session_timeout = %s', (timeout_ms,))
+
+    def _close(self, conn, unlock: bool):
+        """Chiude una connessione dedicata, rilasciando prima il lock se richiesto."""
+        if conn is None or conn.closed:
+            return
+        try:
+            if unlock:
+                conn.cursor().execute('SELECT pg_advisory_unlock(%s)', (self.lock_id,))
+        except Exception:
+            pass
+        finally:
+            conn.close()
+
+    def _set_leader(self, value: bool):
+        self.is_leader = value
+        metrics.set_gauge('leader_is_leader', 1 if value else 0)
+        if value:
+            metrics.inc('leader_acquisitions_total')
+            logger.info("Leader: questa replica è ora il leader dei task schedulati")
+        else:
+            metrics.inc('leader_handoffs_total')
+            logger.warning("Leader: leadership persa, i task schedulati passano a un'altra replica")
+
+    async def _run_elected_callbacks(self):
+        for callback in self._on_elected:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error(f"Leader: errore nel callback di elezione: {e}")
@@ -0,0 +1,534 @@
+"""
+SIMULAZIONE DI CARICO - OPERAZIONE RISVEGLIO
+=============================================
+Esegue i veri handler del bot (bot.build_application) con migliaia di
+utenti simulati, contro:
+
+- una Bot API finta (server aiohttp locale che registra i messaggi);
+- Stripe finto (fake_stripe.py, tramite STRIPE_API_BASE);
+- un database PostgreSQL locale dedicato (MAI quello di produzione).
+
+Ogni utente percorre i flussi in ordine, una fase alla volta:
+
+    accesso       /start e richiesta di accesso
+    approvazione  approvazione da parte dell'admin
+    consenso      i passaggi del consenso fino alla verifica OTP
+    checkout      /abbonati (sessione di checkout Stripe)
+    attivazione   webhook checkout.session.completed firmato, fino alla
+                  notifica di pagamento all'utente
+    gruppo        richiesta di accesso a un gruppo, fino all'approvazione
+
+Per ogni flusso riporta throughput, percentili di latenza (p50/p95/p99)
+e query al database per flusso. Se un flusso supera il budget (p95, query,
+errori) il processo termina con codice 1, così la CI segnala la regressione.
+
+Uso:
+
+    python load_simulation.py --database-url postgresql://localhost/risveglio_sim --utenti 2000
+    python load_simulation.py --database-url ... --budget budget.json
+    python load_simulation.py --database-url ... --salva-budget budget.json
+
+Le query dell'attivazione sono quelle del worker dei webhook; le scritture
+della persistenza (ogni PERSISTENCE_UPDATE_INTERVAL) finiscono nella fase
+in cui avvengono.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Optional
+
+from aiohttp import ClientSession, web
+from telegram import Update
+
+import fake_stripe
+
+logger = logging.getLogger(__name__)
+
+FLOWS = ('accesso', 'approvazione', 'consenso', 'checkout', 'attivazione', 'gruppo')
+
+# Budget predefiniti per flusso (latenza p95 in ms, query per flusso,
+# quota di flussi falliti). Da tarare con --salva-budget sull'hardware della CI.
+DEFAULT_BUDGETS = {
+    'accesso': {'p95_ms': 500, 'queries': 15, 'failure_rate': 0.0},
+    'approvazione': {'p95_ms': 500, 'queries': 12, 'failure_rate': 0.0},
+    'consenso': {'p95_ms': 3000, 'queries': 40, 'failure_rate': 0.0},
+    'checkout': {'p95_ms': 1000, 'queries': 12, 'failure_rate': 0.0},
+    'attivazione': {'p95_ms': 5000, 'queries': 20, 'failure_rate': 0.0},
+    'gruppo': {'p95_ms': 5000, 'queries': 5, 'failure_rate': 0.0},
+}
+
+# Margine applicato ai risultati quando si salva un nuovo budget
+BUDGET_MARGIN = 1.5
+
+# ID degli utenti simulati (fuori dall'intervallo degli ID Telegram reali)
+SIM_USER_BASE = 7_000_000_000_000
+
+# Attesa massima per eventi asincroni (webhook, richieste di accesso)
+EVENT_TIMEOUT = 30
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Simulazione', 'username': 'simulazione_bot'}
+OTP_PATTERN = re.compile(r'`(\d{6})`')
+JOIN_CHAT = {'id': -1001000000001, 'type': 'supergroup', 'title': 'Biblioteca Digitale'}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# =============================================================================
+# BOT API FINTA
+# =============================================================================
+
+class FakeBotAPI:
+    """
+    Risponde alle chiamate della Bot API come Telegram e registra i
+    parametri di ogni chiamata per destinatario (chat_id o user_id).
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._events = defaultdict(list)
+        self._waiters = defaultdict(list)
+        self._message_ids = itertools.count(1000)
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = {k: v for k, v in (await request.post()).items() if isinstance(v, str)}
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        key = (method, params.get('user_id') or params.get('chat_id'))
+        self._events[key].append(params)
+        for waiter in self._waiters.pop(key, []):
+            if not waiter.done():
+                waiter.set_result(params)
+
+        return web.json_response({'ok': True, 'result': self._result(method, params)})
+
+    def _result(self, method: str, params: dict):
+        if method == 'getMe':
+            return dict(BOT_USER, can_join_groups=True, can_read_all_group_messages=False,
+                        supports_inline_queries=False)
+        if method in ('sendMessage', 'editMessageText', 'sendDocument', 'editMessageReplyMarkup'):
+            return {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        return True
+
+    def events(self, method: str, chat_id: int) -> list:
+        return self._events.get((method, str(chat_id)), [])
+
+    def find(self, method: str, chat_id: int, predicate: Callable[[dict], bool]) -> Optional[dict]:
+        return next((p for p in reversed(self.events(method, chat_id)) if predicate(p)), None)
+
+    async def wait(self, method: str, chat_id: int, predicate: Callable[[dict], bool] = lambda p: True,
+                   timeout: float = EVENT_TIMEOUT) -> dict:
+        """Attende una chiamata `method` verso chat_id che soddisfi `predicate`."""
+        deadline = time.monotonic() + timeout
+        while True:
+            found = self.find(method, chat_id, predicate)
+            if found is not None:
+                return found
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters[(method, str(chat_id))].append(waiter)
+            await asyncio.wait_for(waiter, max(0.0, deadline - time.monotonic()))
+
+    def reset(self):
+        self._events.clear()
+
+
+# =============================================================================
+# SIMULAZIONE
+# =============================================================================
+
+class Simulation:
+    """Esegue i flussi per tutti gli utenti e raccoglie le misure."""
+
+    def __init__(self, application, fake_api: FakeBotAPI, stripe_app, webhook_url: str,
+                 webhook_secret: str, users: list, admin_id: int, concurrency: int):
+        self.application = application
+        self.fake_api = fake_api
+        self.stripe_app = stripe_app
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.users = users
+        self.admin_id = admin_id
+        self.concurrency = concurrency
+        self.handler_errors = 0
+        self.http: Optional[ClientSession] = None
+        self._update_ids = itertools.count(1)
+        self.results = {}
+
+    async def on_error(self, update, context):
+        self.handler_errors += 1
+        logger.debug(f"Errore handler: {context.error}")
+
+    # Update sintetici
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        n = user_id - SIM_USER_BASE
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Utente', 'last_name': f'Simulato{n}',
+                'username': f'sim_{n}', 'language_code': 'it'}
+
+    def _update(self, payload: dict) -> Update:
+        payload['update_id'] = next(self._update_ids)
+        return Update.de_json(payload, self.application.bot)
+
+    def message(self, user_id: int, text: str) -> Update:
+        message = {
+            'message_id': next(self._update_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self._update({'message': message})
+
+    def callback(self, user_id: int, data: str) -> Update:
+        return self._update({'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': self._user(user_id) if user_id != self.admin_id else
+            {'id': user_id, 'is_bot': False, 'first_name': 'Admin'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': next(self._update_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': 'menu',
+            },
+        }})
+
+    def join_request(self, user_id: int) -> Update:
+        return self._update({'chat_join_request': {
+            'chat': JOIN_CHAT,
+            'from': self._user(user_id),
+            'user_chat_id': user_id,
+            'date': int(time.time()),
+        }})
+
+    async def send(self, steps: dict, step: str, update: Update):
+        """Elabora un update come farebbe il polling e misura il passaggio."""
+        started = time.monotonic()
+        await self.application.update_processor.process_update(
+            update, self.application.process_update(update)
+        )
+        steps[step].append(time.monotonic() - started)
+
+    # Flussi
+
+    async def flow_accesso(self, user_id: int, steps: dict) -> bool:
+        await self.send(steps, 'start', self.message(user_id, '/start'))
+        await self.send(steps, 'request_access', self.callback(user_id, 'request_access'))
+        return self.fake_api.find('editMessageText', user_id, lambda p: 'Richiesta Inviata' in p.get('text', '')) is not None
+
+    async def flow_approvazione(self, user_id: int, steps: dict) -> bool:
+        await self.send(steps, 'admin_approve', self.callback(self.admin_id, f'admin_approve_{user_id}'))
+        return self.fake_api.find('sendMessage', user_id, lambda p: 'RICHIESTA APPROVATA' in p.get('text', '')) is not None
+
+    async def flow_consenso(self, user_id: int, steps: dict) -> bool:
+        n = user_id - SIM_USER_BASE
+        await self.send(steps, 'start_consent', self.callback(user_id, 'start_consent'))
+        await self.send(steps, 'consent_begin', self.callback(user_id, 'consent_begin'))
+        await self.send(steps, 'full_name', self.message(user_id, f'Utente Simulato{n}'))
+        await self.send(steps, 'birth_date', self.message(user_id, '15/03/1990'))
+        await self.send(steps, 'birth_place', self.message(user_id, 'Roma (RM)'))
+        await self.send(steps, 'residence', self.message(user_id, f'Via Roma {n}, 00100 Roma (RM)'))
+        await self.send(steps, 'consent_confirm', self.callback(user_id, 'consent_confirm'))
+
+        otp = self.fake_api.find('sendMessage', user_id, lambda p: bool(OTP_PATTERN.search(p.get('text', ''))))
+        if otp is None:
+            return False
+        await self.send(steps, 'otp', self.message(user_id, OTP_PATTERN.search(otp['text']).group(1)))
+        return self.fake_api.find('sendMessage', user_id, lambda p: 'consent_receipt' in p.get('reply_markup', '')) is not None
+
+    async def flow_checkout(self, user_id: int, steps: dict) -> bool:
+        await self.send(steps, 'abbonati', self.message(user_id, '/abbonati'))
+        return self.fake_api.find('sendMessage', user_id, lambda p: 'checkout.example.test' in p.get('reply_markup', '')) is not None
+
+    async def flow_attivazione(self, user_id: int, steps: dict) -> bool:
+        customer_id = f"cus_sim_{user_id}"
+        fake_stripe.register_customer(self.stripe_app, customer_id, user_id)
+        payload = fake_stripe.encode_event(fake_stripe.checkout_completed(user_id, customer_id))
+
+        started = time.monotonic()
+        async with self.http.post(self.webhook_url, data=payload, headers={
+            'Stripe-Signature': fake_stripe.sign_payload(payload, self.webhook_secret),
+            'Content-Type': 'application/json',
+        }) as response:
+            steps['webhook'].append(time.monotonic() - started)
+            if response.status != 200:
+                return False
+        await self.fake_api.wait('sendMessage', user_id, lambda p: 'Pagamento Completato' in p.get('text', ''))
+        steps['notifica'].append(time.monotonic() - started)
+        return True
+
+    async def flow_gruppo(self, user_id: int, steps: dict) -> bool:
+        started = time.monotonic()
+        await self.send(steps, 'join_request', self.join_request(user_id))
+        await self.fake_api.wait('approveChatJoinRequest', user_id)
+        steps['approvazione_gruppo'].append(time.monotonic() - started)
+        return True
+
+    # Fasi
+
+    async def run_phase(self, flow: str):
+        import metrics
+
+        run_flow = getattr(self, f'flow_{flow}')
+        steps = defaultdict(list)
+        latencies = []
+        failed = 0
+        slots = asyncio.Semaphore(self.concurrency)
+        self.fake_api.reset()
+
+        async def one(user_id: int):
+            nonlocal failed
+            async with slots:
+                started = time.monotonic()
+                try:
+                    ok = await run_flow(user_id, steps)
+                except Exception as e:
+                    logger.debug(f"Flusso {flow} fallito per {user_id}: {e!r}")
+                    ok = False
+                latencies.append(time.monotonic() - started)
+                failed += not ok
+
+        queries_before = metrics.snapshot()['counters'].get('db_queries_total', 0)
+        started = time.monotonic()
+        await asyncio.gather(*(one(user_id) for user_id in self.users))
+        seconds = time.monotonic() - started
+        queries = metrics.snapshot()['counters'].get('db_queries_total', 0) - queries_before
+
+        self.results[flow] = {
+            'users': len(self.users),
+            'failed': failed,
+            'failure_rate': failed / len(self.users),
+            'seconds': round(seconds, 2),
+            'throughput': round(len(self.users) / seconds, 1) if seconds else 0.0,
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+            'queries': round(queries / len(self.users), 1),
+            'steps': {name: round(percentile(values, 0.95) * 1000, 1) for name, values in steps.items()},
+        }
+        logger.info(f"Fase {flow}: {self.results[flow]['throughput']} flussi/s, {failed} falliti")
+
+    async def run(self, flows=FLOWS) -> dict:
+        self.http = ClientSession()
+        try:
+            for flow in flows:
+                await self.run_phase(flow)
+        finally:
+            await self.http.close()
+        return self.results
+
+
+# =============================================================================
+# DATABASE, BUDGET E REPORT
+# =============================================================================
+
+def cleanup_simulated_users(get_connection):
+    """Elimina i dati degli utenti simulati lasciati da esecuzioni precedenti."""
+    conn = get_connection()
+    cur = conn.cursor()
+    for table in ('activity_log', 'otp_log', 'user_consents', 'payments', 'support_tickets',
+                  'notification_ledger', 'bot_user_data', 'users'):
+        cur.execute(f'DELETE FROM {table} WHERE user_id >= %s', (SIM_USER_BASE,))
+    cur.execute('''
+        DELETE FROM bot_conversations
+        WHERE (conversation_key::jsonb->>0)::bigint >= %s
+    ''', (SIM_USER_BASE,))
+    conn.commit()
+    conn.close()
+
+
+def check_budgets(results: dict, budgets: dict) -> list:
+    """Restituisce le violazioni del budget (lista vuota = tutto nei limiti)."""
+    violations = []
+    for flow, result in results.items():
+        budget = budgets.get(flow, {})
+        for metric in ('p95_ms', 'queries', 'failure_rate'):
+            if metric in budget and result[metric] > budget[metric]:
+                violations.append(f"{flow}: {metric} {result[metric]} oltre il budget {budget[metric]}")
+    return violations
+
+
+def budgets_from_results(results: dict) -> dict:
+    """Nuovo budget dai risultati attuali, con margine."""
+    return {
+        flow: {
+            'p95_ms': round(r['p95_ms'] * BUDGET_MARGIN, 1),
+            'queries': round(r['queries'] * BUDGET_MARGIN, 1),
+            'failure_rate': 0.0,
+        }
+        for flow, r in results.items()
+    }
+
+
+def format_results(results: dict, handler_errors: int = 0) -> str:
+    header = f"{'flusso':<13}{'utenti':>7}{'falliti':>8}{'flussi/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'query':>7}"
+    lines = [header, '-' * len(header)]
+    for flow, r in results.items():
+        lines.append(
+            f"{flow:<13}{r['users']:>7}{r['failed']:>8}{r['throughput']:>10}"
+            f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{r['queries']:>7}"
+        )
+    lines.append("")
+    for flow, r in results.items():
+        steps = ', '.join(f"{name} {ms}" for name, ms in r['steps'].items())
+        lines.append(f"{flow} (p95 per passaggio, ms): {steps}")
+    if handler_errors:
+        lines.append(f"\nErrori negli handler: {handler_errors}")
+    return "\n".join(lines)
+
+
+# =============================================================================
+# AVVIO
+# =============================================================================
+
+def configure_environment(args, ports: dict):
+    """
+    Variabili d'ambiente della simulazione: vanno impostate prima di
+    importare config (che le legge all'import). Segreti sempre finti.
+    """
+    os.environ.update({
+        'DATABASE_URL': args.database_url,
+        'BOT_TOKEN': '123456789:SIMULAZIONE',
+        'STRIPE_SECRET_KEY': 'sk_test_simulazione',
+        'STRIPE_WEBHOOK_SECRET': 'whsec_simulazione',
+        'STRIPE_API_BASE': f"http://127.0.0.1:{ports['stripe']}",
+        'STRIPE_MAX_RETRIES': '0',
+        'PORT': str(ports['webhook']),
+        'TELEGRAM_RATE_LIMIT': '0',
+        'OTP_STORE_BACKEND': 'memory',
+    })
+
+
+async def simulate(args, ports: dict) -> tuple:
+    # Moduli del bot importati solo dopo configure_environment()
+    import bot
+    from config import SUPER_ADMIN_IDS, STRIPE_WEBHOOK_SECRET
+    from database import init_db, get_connection, close_pool
+    from webhook import start_server
+
+    await asyncio.to_thread(init_db)
+    await asyncio.to_thread(cleanup_simulated_users, get_connection)
+
+    fake_api = FakeBotAPI(args.latenza_telegram / 1000)
+    api_runner = web.AppRunner(fake_api.app)
+    await api_runner.setup()
+    await web.TCPSite(api_runner, '127.0.0.1', ports['telegram']).start()
+
+    stripe_app = fake_stripe.create_app(args.latenza_stripe / 1000)
+    stripe_runner = await fake_stripe.start_server(stripe_app, ports['stripe'])
+
+    application = bot.build_application(base_url=f"http://127.0.0.1:{ports['telegram']}/bot")
+    users = [SIM_USER_BASE + i for i in range(1, args.utenti + 1)]
+    simulation = Simulation(
+        application, fake_api, stripe_app,
+        webhook_url=f"http://127.0.0.1:{ports['webhook']}/webhook/stripe",
+        webhook_secret=STRIPE_WEBHOOK_SECRET,
+        users=users, admin_id=SUPER_ADMIN_IDS[0], concurrency=args.concorrenza,
+    )
+    application.add_error_handler(simulation.on_error)
+
+    await application.initialize()
+    await application.start()
+    webhook_runner = await start_server(application, port=ports['webhook'], host='127.0.0.1')
+    try:
+        results = await simulation.run(args.flussi)
+    finally:
+        await webhook_runner.cleanup()
+        await bot.join_request_queue.shutdown()
+        await application.stop()
+        await application.shutdown()
+        bot.shutdown_receipts()
+        await stripe_runner.cleanup()
+        await api_runner.cleanup()
+        close_pool()
+
+    return results, simulation.handler_errors
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Simulazione di carico end-to-end del bot")
+    parser.add_argument('--database-url', default=os.getenv('SIM_DATABASE_URL'),
+                        help="PostgreSQL dedicato alla simulazione (default: SIM_DATABASE_URL)")
+    parser.add_argument('--utenti', type=int, default=1000)
+    parser.add_argument('--concorrenza', type=int, default=100, help="utenti simulati contemporanei")
+    parser.add_argument('--flussi', nargs='+', choices=FLOWS, default=list(FLOWS))
+    parser.add_argument('--latenza-telegram', type=float, default=0.0, help="latenza simulata della Bot API (ms)")
+    parser.add_argument('--latenza-stripe', type=float, default=0.0, help="latenza simulata di Stripe (ms)")
+    parser.add_argument('--budget', help="file JSON con i budget per flusso")
+    parser.add_argument('--salva-budget', help="salva un nuovo budget dai risultati in questo file")
+    parser.add_argument('--json', help="salva i risultati in questo file JSON")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    if not args.database_url:
+        parser.error("serve --database-url (o SIM_DATABASE_URL): usare un database dedicato")
+
+    ports = {'telegram': free_port(), 'stripe': free_port(), 'webhook': free_port()}
+    configure_environment(args, ports)
+    results, handler_errors = asyncio.run(simulate(args, ports))
+
+    print(format_results(results, handler_errors))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'results': results, 'handler_errors': handler_errors}, f, indent=2)
+    if args.salva_budget:
+        with open(args.salva_budget, 'w') as f:
+            json.dump(budgets_from_results(results), f, indent=2)
+        print(f"\nBudget salvato in {args.salva_budget}")
+
+    budgets = DEFAULT_BUDGETS
+    if args.budget:
+        with open(args.budget) as f:
+            budgets = json.load(f)
+    violations = check_budgets(results, budgets)
+    if handler_errors:
+        violations.append(f"{handler_errors} errori negli handler")
+    if violations:
+        print("\n❌ BUDGET SUPERATO")
+        for violation in violations:
+            print(f"• {violation}")
+        return 1
+    print("\n✅ Tutti i flussi nei budget")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
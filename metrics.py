@@ -0,0 +1,207 @@
+"""
+METRICHE IN MEMORIA - OPERAZIONE RISVEGLIO
+===========================================
+Registro minimale di contatori, gauge e istogrammi, condiviso da tutti i
+moduli del bot. Le metriche sono identificate da un nome e da etichette
+(es. branch='subscribe').
+
+Con scope() si misura un'unità di lavoro (es. un handler): database,
+Telegram e Stripe registrano con record_call() tempo e numero di chiamate
+nello scope attivo, anche dai thread di asyncio.to_thread.
+
+render_prometheus() produce il formato testuale di Prometheus (/metrics).
+"""
+
+import bisect
+import contextlib
+import contextvars
+import threading
+from typing import Dict, Optional, Tuple
+
+# Limiti superiori (secondi) dei bucket degli istogrammi di latenza
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Bucket per conteggi (es. query per handler)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, tuple], float] = {}
+_gauges: Dict[Tuple[str, tuple], float] = {}
+_histograms: Dict[Tuple[str, tuple], 'Histogram'] = {}
+# Bucket specifici per nome di istogramma
+_buckets: Dict[str, tuple] = {}
+
+
+class Histogram:
+    """Istogramma a bucket cumulativi (compatibile con il formato Prometheus)."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # ultimo = +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Stima del quantile q (0-1) dal limite superiore del bucket."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+def _key(name: str, labels: dict) -> Tuple[str, tuple]:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, amount: float = 1, **labels):
+    """Incrementa un contatore."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name: str, value: float, **labels):
+    """Imposta il valore di un gauge."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def set_buckets(name: str, buckets):
+    """Imposta i bucket di un istogramma (prima della prima osservazione)."""
+    _buckets[name] = tuple(buckets)
+
+
+def observe(name: str, value: float, **labels):
+    """Registra un valore (tipicamente una durata in secondi) in un istogramma."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(_buckets.get(name, DEFAULT_BUCKETS))
+        histogram.observe(value)
+
+
+def snapshot() -> dict:
+    """Copia leggibile di tutte le metriche (per log e comandi admin)."""
+    with _lock:
+        return {
+            'counters': {_format(k): v for k, v in _counters.items()},
+            'gauges': {_format(k): v for k, v in _gauges.items()},
+            'histograms': {
+                _format(k): {
+                    'count': h.count,
+                    'sum': h.sum,
+                    'p50': h.quantile(0.5),
+                    'p95': h.quantile(0.95),
+                    'p99': h.quantile(0.99),
+                }
+                for k, h in _histograms.items()
+            },
+        }
+
+
+def _format(key: Tuple[str, tuple]) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+# =============================================================================
+# SCOPE (chiamate esterne di un'unità di lavoro)
+# =============================================================================
+
+class Scope:
+    """Numero di chiamate e tempo totale per tipo (db, telegram, stripe)."""
+
+    def __init__(self):
+        self.calls: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, seconds: float):
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.seconds[kind] = self.seconds.get(kind, 0.0) + seconds
+
+
+_scope: contextvars.ContextVar[Optional[Scope]] = contextvars.ContextVar('metrics_scope', default=None)
+
+
+@contextlib.contextmanager
+def scope():
+    """Apre uno scope: le chiamate registrate al suo interno finiscono qui."""
+    current = Scope()
+    token = _scope.set(current)
+    try:
+        yield current
+    finally:
+        _scope.reset(token)
+
+
+def record_call(kind: str, seconds: float):
+    """Registra una chiamata esterna nello scope attivo (se c'è)."""
+    current = _scope.get()
+    if current is not None:
+        current.add(kind, seconds)
+
+
+# =============================================================================
+# FORMATO PROMETHEUS
+# =============================================================================
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name: str, labels: tuple, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return name
+    return name + '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def render_prometheus() -> str:
+    """Tutte le metriche nel formato testuale di Prometheus (versione 0.0.4)."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted(
+            ((k, (h.buckets, list(h.counts), h.count, h.sum)) for k, h in _histograms.items()),
+            key=lambda item: item[0]
+        )
+
+    lines = []
+    typed = set()
+
+    def declare(name: str, kind: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        declare(name, 'counter')
+        lines.append(f"{_series(name, labels)} {value}")
+    for (name, labels), value in gauges:
+        declare(name, 'gauge')
+        lines.append(f"{_series(name, labels)} {value}")
+    for (name, labels), (buckets, counts, count, total) in histograms:
+        declare(name, 'histogram')
+        cumulative = 0
+        for limit, c in zip(buckets, counts):
+            cumulative += c
+            lines.append(f"{_series(name + '_bucket', labels, (('le', format(limit, 'g')),))} {cumulative}")
+        lines.append(f"{_series(name + '_bucket', labels, (('le', '+Inf'),))} {count}")
+        lines.append(f"{_series(name + '_sum', labels)} {total}")
+        lines.append(f"{_series(name + '_count', labels)} {count}")
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,217 @@
+"""
+ARCHIVIO OTP - OPERAZIONE RISVEGLIO
+====================================
+Tiene fuori dal database il ciclo di vita dei codici OTP del consenso:
+scadenza, conteggio dei tentativi e blocco dei tentativi a raffica.
+
+- I tentativi sbagliati non scrivono nulla sul database.
+- Il database viene interrogato solo quando il codice coincide (per la
+  conferma definitiva) o quando il codice non è noto a questo archivio
+  (es. dopo un riavvio).
+- Nel registro otp_log finiscono solo gli esiti finali (blocco, scadenza).
+
+Backend disponibili (OTP_STORE_BACKEND):
+- memory: mappa in memoria con scadenza, per una sola istanza del bot;
+- sqlite: file SQLite locale (OTP_STORE_PATH) condiviso da più istanze
+  sulla stessa macchina.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+import metrics
+from config import (
+    OTP_MAX_ATTEMPTS, OTP_MAX_CODES_PER_HOUR, OTP_STORE_BACKEND, OTP_STORE_PATH, BOT_TOKEN
+)
+
+logger = logging.getLogger(__name__)
+
+# Funzione di aggiornamento: valore attuale (o None) -> nuovo valore (None = elimina)
+Updater = Callable[[Optional[dict]], Optional[dict]]
+
+# Esiti di OTPStore.check()
+MATCH = 'match'
+WRONG = 'wrong'
+EXPIRED = 'expired'
+LOCKED = 'locked'
+UNKNOWN = 'unknown'
+
+
+# =============================================================================
+# BACKEND
+# =============================================================================
+
+class MemoryBackend:
+    """Mappa chiave -> valore in memoria, con scadenza delle voci."""
+
+    def __init__(self):
+        self._data = {}  # chiave -> (valore, scadenza time.time())
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def update(self, key: str, func: Updater, ttl: float) -> Optional[dict]:
+        """Legge, modifica e salva una voce in modo atomico. Restituisce il nuovo valore."""
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            current = entry[0] if entry and entry[1] > now else None
+            value = func(current)
+            if value is None:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = (value, now + ttl)
+            self._purge(now)
+            return value
+
+    def _purge(self, now: float):
+        # Pulizia occasionale delle voci scadute
+        self._writes += 1
+        if self._writes % 100 == 0:
+            for key in [k for k, (_, expires) in self._data.items() if expires <= now]:
+                del self._data[key]
+
+
+class SQLiteBackend:
+    """Archivio chiave -> valore su file SQLite locale, condivisibile tra processi."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS otp_store ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def update(self, key: str, func: Updater, ttl: float) -> Optional[dict]:
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT value FROM otp_store WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            value = func(json.loads(row[0]) if row else None)
+            if value is None:
+                conn.execute('DELETE FROM otp_store WHERE key = ?', (key,))
+            else:
+                conn.execute(
+                    'INSERT OR REPLACE INTO otp_store (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(value), now + ttl)
+                )
+            conn.execute('DELETE FROM otp_store WHERE expires_at <= ?', (now,))
+            conn.execute('COMMIT')
+            return value
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+
+# =============================================================================
+# ARCHIVIO OTP
+# =============================================================================
+
+class OTPStore:
+    """Codici OTP attivi, tentativi e limite di codici emessi per utente."""
+
+    # Finestra per il limite di codici emessi (secondi)
+    ISSUE_WINDOW = 3600
+
+    def __init__(self, backend, max_attempts: int = OTP_MAX_ATTEMPTS,
+                 max_codes_per_hour: int = OTP_MAX_CODES_PER_HOUR):
+        self.backend = backend
+        self.max_attempts = max_attempts
+        self.max_codes_per_hour = max_codes_per_hour
+
+    @staticmethod
+    def _digest(user_id: int, code: str) -> str:
+        # Nell'archivio non finisce mai il codice in chiaro
+        return hmac.new((BOT_TOKEN or '').encode(), f"{user_id}:{code}".encode(), hashlib.sha256).hexdigest()
+
+    def can_issue(self, user_id: int) -> bool:
+        """Registra l'emissione di un nuovo codice se il limite orario lo consente."""
+        allowed = []
+
+        def count(value):
+            issued = [t for t in (value or {}).get('issued', []) if t > time.time() - self.ISSUE_WINDOW]
+            allowed.append(len(issued) < self.max_codes_per_hour)
+            if allowed[0]:
+                issued.append(time.time())
+            return {'issued': issued}
+
+        self.backend.update(f"otp_issued:{user_id}", count, self.ISSUE_WINDOW)
+        if not allowed[0]:
+            metrics.inc('otp_throttled_total')
+        return allowed[0]
+
+    def issue(self, user_id: int, code: str, expires_at: float):
+        """Memorizza il nuovo codice dell'utente (sostituisce il precedente)."""
+        # La voce resta anche dopo la scadenza per rispondere "scaduto" senza database
+        ttl = max(0.0, expires_at - time.time()) + self.ISSUE_WINDOW
+        self.backend.update(
+            f"otp:{user_id}",
+            lambda _: {'digest': self._digest(user_id, code), 'expires_at': expires_at, 'attempts': 0},
+            ttl
+        )
+
+    def check(self, user_id: int, code: str) -> dict:
+        """
+        Verifica un codice senza toccare il database.
+        Restituisce {'status': MATCH|WRONG|EXPIRED|LOCKED|UNKNOWN, 'remaining': int,
+        'final': bool}; final=True la prima volta che si arriva a un esito definitivo
+        (da registrare nel log di audit).
+        """
+        outcome = {'status': UNKNOWN, 'remaining': 0, 'final': False}
+
+        def attempt(value):
+            if value is None:
+                return None
+            if value['expires_at'] <= time.time():
+                outcome.update(status=EXPIRED, final=not value.get('closed'))
+                return dict(value, closed=True)
+            if value['attempts'] >= self.max_attempts:
+                outcome.update(status=LOCKED)
+                return value
+
+            attempts = value['attempts'] + 1
+            if hmac.compare_digest(value['digest'], self._digest(user_id, code)):
+                outcome.update(status=MATCH)
+            else:
+                outcome.update(
+                    status=WRONG if attempts < self.max_attempts else LOCKED,
+                    remaining=self.max_attempts - attempts,
+                    final=attempts >= self.max_attempts,
+                )
+            return dict(value, attempts=attempts)
+
+        self.backend.update(f"otp:{user_id}", attempt, ttl=self.ISSUE_WINDOW)
+        metrics.inc('otp_checks_total', outcome=outcome['status'])
+        return outcome
+
+    def clear(self, user_id: int):
+        """Elimina il codice dell'utente (consenso confermato o annullato)."""
+        self.backend.update(f"otp:{user_id}", lambda _: None, ttl=0)
+
+
+def create_backend(name: str = OTP_STORE_BACKEND):
+    if name == 'sqlite':
+        return SQLiteBackend(OTP_STORE_PATH)
+    if name != 'memory':
+        logger.warning(f"Backend OTP sconosciuto '{name}', uso la memoria")
+    return MemoryBackend()
+
+
+otp_store = OTPStore(create_backend())
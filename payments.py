@@ -5,16 +5,70 @@ Questo modulo gestisce tutti i pagamenti tramite Stripe.
 """
 
 import stripe
-from config import STRIPE_SECRET_KEY, STRIPE_PRICE_ID, STRIPE_WEBHOOK_SECRET
+from config import (
+    STRIPE_SECRET_KEY, STRIPE_PRICE_ID, STRIPE_WEBHOOK_SECRET, CUSTOMER_CACHE_SIZE,
+    CHECKOUT_SESSION_TTL_MINUTES, CHECKOUT_CACHE_SIZE, PORTAL_URL_TTL_SECONDS
+)
+from cache import LRUCache
+from database import get_user_id_by_customer
+import stripe_client
+import metrics
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
-# Configura la chiave API di Stripe
-stripe.api_key = STRIPE_SECRET_KEY
+# customer_id Stripe -> user_id Telegram
+_customer_users = LRUCache(maxsize=CUSTOMER_CACHE_SIZE)
 
+# user_id -> URL della sessione di checkout ancora aperta
+_checkout_urls = LRUCache(maxsize=CHECKOUT_CACHE_SIZE)
+# customer_id -> URL del portale clienti ancora valido
+_portal_urls = LRUCache(maxsize=CHECKOUT_CACHE_SIZE, ttl=PORTAL_URL_TTL_SECONDS)
+# Una sola sessione in creazione per chiave (utente o cliente): lock suddivisi
+_session_locks = [threading.Lock() for _ in range(64)]
+# Margine (secondi) prima della scadenza oltre il quale non riusare la sessione
+CHECKOUT_EXPIRY_MARGIN = 120
 
-def create_checkout_session(user_id: int, user_email: str = None) -> str:
+
+def get_checkout_url(user_id: int, user_email: str = None) -> str:
+    """
+    Restituisce l'URL di checkout dell'utente, riusando la sessione ancora
+    aperta se esiste. Tocchi ripetuti (anche in parallelo) creano al
+    massimo una sessione Stripe. Funzione bloccante: dal codice asincrono
+    usarla con stripe_client.arun.
+    """
+    url = _checkout_urls.get(user_id)
+    if url:
+        metrics.inc('stripe_checkout_total', source='cache')
+        return url
+    
+    with _lock_for(user_id):
+        # Nel frattempo un'altra richiesta potrebbe averla già creata
+        url = _checkout_urls.get(user_id)
+        if url:
+            metrics.inc('stripe_checkout_total', source='cache')
+            return url
+        
+        session = create_checkout_session(user_id, user_email)
+        metrics.inc('stripe_checkout_total', source='stripe')
+        ttl = session.expires_at - time.time() - CHECKOUT_EXPIRY_MARGIN
+        if ttl > 0:
+            _checkout_urls.set(user_id, session.url, ttl=ttl)
+        return session.url
+
+
+def _lock_for(key) -> threading.Lock:
+    return _session_locks[hash(key) % len(_session_locks)]
+
+
+def forget_checkout(user_id: int):
+    """Dimentica la sessione di checkout dell'utente (es. pagamento completato)."""
+    _checkout_urls.pop(user_id)
+
+
+def create_checkout_session(user_id: int, user_email: str = None) -> stripe.checkout.Session:
     """
     Crea una sessione di checkout Stripe e restituisce l'URL per il pagamento.
     
@@ -23,7 +77,7 @@ def create_checkout_session(user_id: int, user_email: str = None) -> str:
         user_email: Email dell'utente (opzionale)
     
     Returns:
-        URL della pagina di checkout Stripe
+        Sessione di checkout Stripe (session.url è la pagina di pagamento)
     """
     logger.info(f"=== DEBUG CHECKOUT ===")
     logger.info(f"User ID: {user_id}")
@@ -32,7 +86,8 @@ def create_checkout_session(user_id: int, user_email: str = None) -> str:
     logger.info(f"======================")
     
     try:
-        session = stripe.checkout.Session.create(
+        session = stripe_client.call(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=[{
                 'price': STRIPE_PRICE_ID,
@@ -47,10 +102,11 @@ def create_checkout_session(user_id: int, user_email: str = None) -> str:
             customer_email=user_email,
             allow_promotion_codes=True,
             billing_address_collection='auto',
+            expires_at=int(time.time()) + CHECKOUT_SESSION_TTL_MINUTES * 60,
         )
         
         logger.info(f"Checkout session creata per utente {user_id}: {session.id}")
-        return session.url
+        return session
         
     except stripe.error.StripeError as e:
         logger.error(f"=== ERRORE STRIPE ===")
@@ -63,7 +119,8 @@ def create_checkout_session(user_id: int, user_email: str = None) -> str:
 def create_customer(user_id: int, email: str, name: str = None) -> str:
     """Crea un cliente Stripe e restituisce il customer_id."""
     try:
-        customer = stripe.Customer.create(
+        customer = stripe_client.call(
+            stripe.Customer.create,
             email=email,
             name=name,
             metadata={
@@ -79,12 +136,36 @@ def create_customer(user_id: int, email: str, name: str = None) -> str:
 
 
 def get_customer_portal_url(customer_id: str) -> str:
+    """
+    Restituisce un link al portale clienti Stripe dove l'utente può gestire
+    il proprio abbonamento, riusando quello creato da poco se ancora valido.
+    Tocchi ripetuti (anche in parallelo) creano al massimo una sessione.
+    """
+    url = _portal_urls.get(customer_id)
+    if url:
+        metrics.inc('stripe_portal_total', source='cache')
+        return url
+    
+    with _lock_for(customer_id):
+        url = _portal_urls.get(customer_id)
+        if url:
+            metrics.inc('stripe_portal_total', source='cache')
+            return url
+        
+        url = create_customer_portal_url(customer_id)
+        metrics.inc('stripe_portal_total', source='stripe')
+        _portal_urls.set(customer_id, url)
+        return url
+
+
+def create_customer_portal_url(customer_id: str) -> str:
     """
     Crea un link al portale clienti Stripe dove l'utente può gestire
     il proprio abbonamento.
     """
     try:
-        session = stripe.billing_portal.Session.create(
+        session = stripe_client.call(
+            stripe.billing_portal.Session.create,
             customer=customer_id,
             return_url='https://t.me/OperazioneRisveglioBot',
         )
@@ -98,7 +179,7 @@ def get_customer_portal_url(customer_id: str) -> str:
 def cancel_subscription(subscription_id: str) -> bool:
     """Cancella un abbonamento Stripe."""
     try:
-        stripe.Subscription.delete(subscription_id)
+        stripe_client.call(stripe.Subscription.delete, subscription_id)
         logger.info(f"Abbonamento {subscription_id} cancellato")
         return True
         
@@ -110,7 +191,7 @@ def cancel_subscription(subscription_id: str) -> bool:
 def get_subscription_status(subscription_id: str) -> dict:
     """Recupera lo stato di un abbonamento."""
     try:
-        subscription = stripe.Subscription.retrieve(subscription_id)
+        subscription = stripe_client.call(stripe.Subscription.retrieve, subscription_id)
         return {
             'status': subscription.status,
             'current_period_end': subscription.current_period_end,
@@ -122,6 +203,35 @@ def get_subscription_status(subscription_id: str) -> dict:
         return None
 
 
+def remember_customer(customer_id: str, user_id: int):
+    """Memorizza l'associazione cliente Stripe -> utente (es. dopo un checkout)."""
+    if customer_id and user_id:
+        _customer_users.set(customer_id, user_id)
+
+
+def get_user_id_for_customer(customer_id: str) -> int:
+    """
+    Restituisce l'utente Telegram di un cliente Stripe: prima dalla cache,
+    poi dal database (users.stripe_customer_id) e solo come ultima
+    possibilità dai metadata del cliente su Stripe. 0 se sconosciuto.
+    """
+    user_id = _customer_users.get(customer_id)
+    if user_id is not None:
+        metrics.inc('stripe_customer_lookup_total', source='cache')
+        return user_id
+    
+    user_id = get_user_id_by_customer(customer_id)
+    if user_id is not None:
+        metrics.inc('stripe_customer_lookup_total', source='database')
+    else:
+        metrics.inc('stripe_customer_lookup_total', source='stripe')
+        customer = stripe_client.call(stripe.Customer.retrieve, customer_id)
+        user_id = int(customer.metadata.get('telegram_user_id', 0))
+    
+    remember_customer(customer_id, user_id)
+    return user_id
+
+
 def verify_webhook_signature(payload: bytes, sig_header: str) -> dict:
     """Verifica la firma del webhook Stripe."""
     try:
@@ -138,6 +248,19 @@ def verify_webhook_signature(payload: bytes, sig_header: str) -> dict:
         raise
 
 
+def _invoice_period_end(invoice: dict):
+    """
+    Fine del periodo pagato dalla fattura (timestamp), dalla riga
+    dell'abbonamento. invoice.period_end è invece la fine del periodo
+    precedente, quindi non va usato.
+    """
+    for line in (invoice.get('lines') or {}).get('data', []):
+        period_end = (line.get('period') or {}).get('end')
+        if period_end:
+            return period_end
+    return None
+
+
 def handle_webhook_event(event: dict) -> dict:
     """Gestisce gli eventi webhook di Stripe."""
     event_type = event['type']
@@ -156,33 +279,39 @@ def handle_webhook_event(event: dict) -> dict:
             'customer_id': data['customer'],
             'subscription_id': data.get('subscription'),
             'amount_total': data['amount_total'],
+            'currency': data.get('currency', 'eur'),
         }
+        remember_customer(data['customer'], result['user_id'])
+        forget_checkout(result['user_id'])
         logger.info(f"Checkout completato per utente {result['user_id']}")
     
     elif event_type == 'invoice.payment_succeeded':
         if data.get('subscription'):
             result['action'] = 'renew_subscription'
-            customer = stripe.Customer.retrieve(data['customer'])
-            result['user_id'] = int(customer.metadata.get('telegram_user_id', 0))
+            result['user_id'] = get_user_id_for_customer(data['customer'])
             result['details'] = {
+                'customer_id': data['customer'],
                 'amount': data['amount_paid'],
+                'currency': data.get('currency', 'eur'),
+                'billing_reason': data.get('billing_reason'),
                 'subscription_id': data['subscription'],
+                'period_end': _invoice_period_end(data),
             }
             logger.info(f"Rinnovo riuscito per utente {result['user_id']}")
     
     elif event_type == 'invoice.payment_failed':
-        customer = stripe.Customer.retrieve(data['customer'])
         result['action'] = 'payment_failed'
-        result['user_id'] = int(customer.metadata.get('telegram_user_id', 0))
+        result['user_id'] = get_user_id_for_customer(data['customer'])
         result['details'] = {
             'attempt_count': data.get('attempt_count', 1),
+            'amount': data.get('amount_due', 0),
+            'currency': data.get('currency', 'eur'),
         }
         logger.warning(f"Pagamento fallito per utente {result['user_id']}")
     
     elif event_type == 'customer.subscription.deleted':
-        customer = stripe.Customer.retrieve(data['customer'])
         result['action'] = 'cancel_subscription'
-        result['user_id'] = int(customer.metadata.get('telegram_user_id', 0))
+        result['user_id'] = get_user_id_for_customer(data['customer'])
         logger.info(f"Abbonamento cancellato per utente {result['user_id']}")
     
     return result
@@ -0,0 +1,193 @@
+"""
+PERSISTENZA POSTGRESQL - OPERAZIONE RISVEGLIO
+==============================================
+Backend di persistenza per python-telegram-bot basato sul database esistente.
+Salva lo stato dei ConversationHandler (consenso e supporto) e lo user_data
+degli utenti, così un riavvio o una seconda istanza non perdono i moduli
+in compilazione.
+
+- Scrittura differita (write-behind): le modifiche vengono accumulate e
+  salvate in blocco in un'unica transazione.
+- Dirty tracking: vengono scritti solo user_data effettivamente cambiati
+  rispetto all'ultimo salvataggio.
+- Caricamento pigro: lo user_data di un utente viene letto dal database
+  solo al suo primo update, non all'avvio.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import load_conversations, load_user_data, save_bot_persistence
+
+logger = logging.getLogger(__name__)
+
+
+def _serialize(data) -> str:
+    """Serializzazione canonica (chiavi ordinate) per confrontare le versioni."""
+    return json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+
+
+class PostgresPersistence(BasePersistence):
+    """
+    Persistenza su PostgreSQL per conversazioni e user_data.
+    chat_data, bot_data e callback_data non sono usati dal bot e non
+    vengono salvati.
+    """
+
+    def __init__(self, update_interval: float = 5, flush_delay: float = 1.0):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+        self.flush_delay = flush_delay
+
+        # Utenti il cui user_data è già stato letto dal database
+        self._loaded_users = set()
+        # Ultima versione salvata (serializzata) dello user_data di ogni utente
+        self._flushed_user_data: Dict[int, str] = {}
+
+        # Modifiche in attesa di scrittura
+        self._dirty_user_data: Dict[int, Optional[str]] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], Optional[str]] = {}
+
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    # -------------------------------------------------------------------------
+    # Lettura
+    # -------------------------------------------------------------------------
+
+    async def get_user_data(self) -> dict:
+        # Caricamento pigro: niente all'avvio, vedi refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded_users:
+            return
+
+        stored = await asyncio.to_thread(load_user_data, user_id)
+        self._loaded_users.add(user_id)
+
+        if stored:
+            user_data.update(stored)
+            self._flushed_user_data[user_id] = _serialize(stored)
+
+    async def get_conversations(self, name: str) -> dict:
+        # Le conversazioni terminate vengono eliminate, quindi qui ci sono
+        # solo i moduli effettivamente in corso.
+        stored = await asyncio.to_thread(load_conversations, name)
+        conversations = {tuple(json.loads(key)): state for key, state in stored.items()}
+        logger.info(f"Persistenza: {len(conversations)} conversazioni '{name}' ripristinate")
+        return conversations
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    # -------------------------------------------------------------------------
+    # Scrittura (differita)
+    # -------------------------------------------------------------------------
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        serialized = _serialize(data) if data else None
+
+        # Dirty tracking: salta se identico all'ultima versione salvata
+        if serialized == self._flushed_user_data.get(user_id):
+            self._dirty_user_data.pop(user_id, None)
+            return
+
+        self._dirty_user_data[user_id] = serialized
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._dirty_user_data[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        conv_key = json.dumps(list(key))
+        self._dirty_conversations[(name, conv_key)] = (
+            json.dumps(new_state) if new_state is not None else None
+        )
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Chiamato allo spegnimento: scrive subito tutto ciò che è in sospeso."""
+        # Non si cancella il task differito: potrebbe essere a metà di un
+        # salvataggio. Il lock serializza le due scritture.
+        await self._flush()
+
+    # -------------------------------------------------------------------------
+    # Interni
+    # -------------------------------------------------------------------------
+
+    def _schedule_flush(self) -> None:
+        """Programma un salvataggio in blocco dopo flush_delay secondi."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        while not await self._flush():
+            # Database non raggiungibile: riprova finché non va a buon fine
+            await asyncio.sleep(max(self.flush_delay, 5))
+
+    async def _flush(self) -> bool:
+        """Scrive le modifiche in sospeso. Restituisce False se il salvataggio fallisce."""
+        async with self._flush_lock:
+            if not self._dirty_user_data and not self._dirty_conversations:
+                return True
+
+            user_data, self._dirty_user_data = self._dirty_user_data, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+
+            try:
+                await asyncio.to_thread(save_bot_persistence, user_data, conversations)
+            except Exception as e:
+                logger.error(f"Persistenza: salvataggio fallito, nuovo tentativo a breve: {e}")
+                # Rimetti in coda senza sovrascrivere modifiche più recenti
+                for uid, data in user_data.items():
+                    self._dirty_user_data.setdefault(uid, data)
+                for key, state in conversations.items():
+                    self._dirty_conversations.setdefault(key, state)
+                return False
+
+            for uid, data in user_data.items():
+                if data is None:
+                    self._flushed_user_data.pop(uid, None)
+                else:
+                    self._flushed_user_data[uid] = data
+
+            logger.debug(
+                f"Persistenza: salvati {len(user_data)} user_data e "
+                f"{len(conversations)} conversazioni"
+            )
+            return True
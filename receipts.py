@@ -0,0 +1,184 @@
+"""
+RICEVUTE DEL CONSENSO - OPERAZIONE RISVEGLIO
+=============================================
+Dopo la conferma OTP l'utente riceve una ricevuta firmata del consenso:
+
+- il documento completo, ricostruito con i dati inseriti (lo stesso testo
+  di cui create_consent_record salva l'hash SHA-256 in document_hash);
+- i dati della firma (consenso, data di conferma, versione, hash);
+- un codice di verifica HMAC, controllabile con verify_code().
+
+La generazione gira in un pool di processi per non bloccare il bot e il
+risultato viene memorizzato per (consent_id, versione del documento).
+La ricevuta viene inviata come file di testo con send_document.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import io
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Optional, Tuple
+
+import metrics
+from cache import LRUCache
+from config import (
+    MESSAGES, CONSENT_DOCUMENT_VERSION, RECEIPT_SIGNING_KEY, RECEIPT_WORKERS, RECEIPT_CACHE_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+# Formato della data riportata nel documento
+DOCUMENT_DATE_FORMAT = '%d/%m/%Y %H:%M'
+
+# Segni Markdown del modello; i segnaposto {campo} vengono lasciati intatti
+_MARKDOWN = re.compile(r'(\{[^{}]*\})|[*_`]')
+
+# (consent_id, versione) -> (nome file, contenuto, codice di verifica)
+_receipts = LRUCache(maxsize=RECEIPT_CACHE_SIZE)
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+# =============================================================================
+# DOCUMENTO E FIRMA (funzioni pure, eseguite anche nei processi del pool)
+# =============================================================================
+
+def render_consent_document(full_name: str, birth_date, birth_place: str,
+                            residence: str, document_date: str) -> str:
+    """
+    Testo completo del consenso. La formattazione Markdown viene tolta solo
+    dal modello: i dati inseriti dall'utente restano invariati.
+    """
+    if isinstance(birth_date, (date, datetime)):
+        birth_date = birth_date.strftime('%d/%m/%Y')
+    template = _MARKDOWN.sub(lambda m: m.group(1) or '', MESSAGES['consent_document'])
+    text = template.format(
+        full_name=full_name,
+        birth_place=birth_place,
+        birth_date=birth_date,
+        residence=residence,
+        date=document_date,
+    )
+    return text.strip()
+
+
+def document_hash(text: str) -> str:
+    """Hash SHA-256 del documento."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def verification_code(consent_id: int, version: str, doc_hash: str, confirmed_at: datetime) -> str:
+    """Codice di verifica della ricevuta (HMAC-SHA256, 16 caratteri)."""
+    message = f"{consent_id}:{version}:{doc_hash}:{confirmed_at.isoformat()}"
+    digest = hmac.new(RECEIPT_SIGNING_KEY.encode(), message.encode(), hashlib.sha256).hexdigest()
+    code = digest[:16].upper()
+    return '-'.join(code[i:i + 4] for i in range(0, 16, 4))
+
+
+def _receipt_document(consent: dict) -> str:
+    """Documento di un consenso salvato, ricostruito con la data registrata."""
+    metadata = consent.get('consent_metadata') or {}
+    return render_consent_document(
+        consent['full_name'], consent['birth_date'], consent['birth_place'],
+        consent['residence'],
+        metadata.get('document_date') or consent['otp_generated_at'].strftime(DOCUMENT_DATE_FORMAT),
+    )
+
+
+def _signed_fields(consent: dict, document: str) -> Tuple[str, str]:
+    """
+    (versione, hash) firmati dal codice di verifica: l'hash salvato nel
+    database, quello del documento ricostruito solo se manca. Ricevuta e
+    verify_code() usano sempre gli stessi valori.
+    """
+    version = consent.get('document_version') or CONSENT_DOCUMENT_VERSION
+    return version, consent.get('document_hash') or document_hash(document)
+
+
+def verify_code(consent: dict, code: str) -> bool:
+    """Verifica che un codice corrisponda al consenso confermato."""
+    if not consent.get('confirmed_at'):
+        return False
+    document = _receipt_document(consent) if not consent.get('document_hash') else ''
+    version, doc_hash = _signed_fields(consent, document)
+    expected = verification_code(consent['consent_id'], version, doc_hash, consent['confirmed_at'])
+    return hmac.compare_digest(expected, code.strip().upper())
+
+
+def build_receipt(consent: dict) -> Tuple[str, bytes, str]:
+    """Genera la ricevuta di un consenso confermato: (nome file, contenuto, codice)."""
+    document = _receipt_document(consent)
+    version, doc_hash = _signed_fields(consent, document)
+    if doc_hash != document_hash(document):
+        # Consensi precedenti all'hash del documento completo
+        logger.warning(f"Hash del consenso #{consent['consent_id']} diverso dal documento ricostruito")
+
+    code = verification_code(consent['consent_id'], version, doc_hash, consent['confirmed_at'])
+    username = f"@{consent['telegram_username']}" if consent.get('telegram_username') else '-'
+
+    receipt = "\n".join([
+        "RICEVUTA DI CONSENSO - OPERAZIONE RISVEGLIO",
+        "=" * 44,
+        "",
+        document,
+        "",
+        "=" * 44,
+        "DATI DELLA FIRMA ELETTRONICA",
+        f"Consenso n.: {consent['consent_id']}",
+        f"Utente Telegram: {consent['telegram_user_id']} ({username})",
+        f"Confermato il: {consent['confirmed_at'].strftime('%d/%m/%Y %H:%M:%S')}",
+        "Metodo: codice OTP inviato via Telegram",
+        f"Versione documento: {version}",
+        f"Hash SHA-256 documento: {doc_hash}",
+        f"Codice di verifica: {code}",
+        "",
+    ])
+    return f"consenso_{consent['consent_id']}.txt", receipt.encode('utf-8'), code
+
+
+# =============================================================================
+# GENERAZIONE E INVIO
+# =============================================================================
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=RECEIPT_WORKERS)
+    return _executor
+
+
+async def generate_receipt(consent: dict) -> Tuple[str, bytes, str]:
+    """Ricevuta del consenso, generata nel pool di processi (o dalla cache)."""
+    key = (consent['consent_id'], consent.get('document_version') or CONSENT_DOCUMENT_VERSION)
+    receipt = _receipts.get(key)
+    if receipt is not None:
+        metrics.inc('consent_receipts_total', source='cache')
+        return receipt
+
+    loop = asyncio.get_running_loop()
+    receipt = await loop.run_in_executor(_get_executor(), build_receipt, dict(consent))
+    _receipts.set(key, receipt)
+    metrics.inc('consent_receipts_total', source='generated')
+    return receipt
+
+
+async def send_receipt(bot, chat_id: int, consent: dict):
+    """Invia la ricevuta del consenso come documento."""
+    filename, content, code = await generate_receipt(consent)
+    await bot.send_document(
+        chat_id,
+        document=io.BytesIO(content),
+        filename=filename,
+        caption=f"📄 Ricevuta del consenso n. {consent['consent_id']}\n🔐 Codice di verifica: {code}",
+    )
+
+
+def shutdown():
+    """Chiude il pool di processi (allo spegnimento del bot)."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
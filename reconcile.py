@@ -0,0 +1,167 @@
+"""
+RICONCILIAZIONE ABBONAMENTI - OPERAZIONE RISVEGLIO
+===================================================
+Se un webhook Stripe va perso, stato e scadenza degli abbonamenti nel
+database smettono di coincidere con Stripe. La riconciliazione:
+
+1. scorre tutti gli abbonamenti Stripe a pagine da 100 (Subscription.list);
+2. li confronta in memoria con gli utenti che hanno un cliente Stripe;
+3. applica tutte le correzioni con un'unica UPDATE;
+4. restituisce un report (anche in modalità prova, senza modifiche).
+
+Gira ogni notte sulla replica leader, con il comando /riconcilia oppure:
+
+    python reconcile.py [--prova]
+"""
+
+import logging
+import time
+from datetime import datetime
+
+import stripe
+
+import stripe_client
+from database import get_billing_snapshot, apply_subscription_corrections
+
+logger = logging.getLogger(__name__)
+
+# Stati Stripe per cui l'abbonamento locale deve essere attivo
+# (past_due: Stripe sta ritentando il pagamento, vale fino a fine periodo)
+ACTIVE_STRIPE_STATUSES = ('active', 'trialing', 'past_due')
+
+# Stati locali che la riconciliazione può modificare
+RECONCILABLE_STATUSES = ('active', 'expired', 'inactive')
+
+# Differenza massima tollerata tra scadenza locale e fine periodo Stripe
+# (fuso orario, checkout attivati prima della fattura con il periodo)
+END_DATE_TOLERANCE_DAYS = 3
+
+# Quante correzioni riportare nel dettaglio
+REPORT_SAMPLE_SIZE = 20
+
+
+def fetch_stripe_subscriptions() -> dict:
+    """
+    Scorre tutti gli abbonamenti Stripe (una chiamata ogni 100) e restituisce
+    per ogni cliente l'abbonamento più rilevante: uno attivo se esiste,
+    altrimenti quello con il periodo più recente.
+    """
+    by_customer = {}
+    params = {'status': 'all', 'limit': 100}
+
+    while True:
+        page = stripe_client.call(stripe.Subscription.list, **params)
+        for sub in page.data:
+            current = by_customer.get(sub.customer)
+            if current is None or _rank(sub) > _rank(current):
+                by_customer[sub.customer] = sub
+        if not page.has_more:
+            return by_customer
+        params['starting_after'] = page.data[-1].id
+
+
+def _rank(sub) -> tuple:
+    return (sub.status in ACTIVE_STRIPE_STATUSES, sub.current_period_end or 0)
+
+
+def diff_subscriptions(users: list, stripe_subs: dict) -> tuple:
+    """
+    Confronta gli utenti locali con gli abbonamenti Stripe.
+    Restituisce (correzioni, clienti senza abbonamento su Stripe).
+    """
+    corrections = []
+    missing = []
+
+    for user in users:
+        if user['subscription_status'] not in RECONCILABLE_STATUSES:
+            continue
+
+        sub = stripe_subs.get(user['stripe_customer_id'])
+        if sub is None:
+            missing.append(user['user_id'])
+            continue
+
+        if sub.status in ACTIVE_STRIPE_STATUSES:
+            status = 'active'
+            end = datetime.fromtimestamp(sub.current_period_end).date()
+        else:
+            status = 'expired'
+            end = user['subscription_end']
+
+        local_end = user['subscription_end']
+        end_matches = end == local_end or (
+            end is not None and local_end is not None
+            and abs((end - local_end).days) <= END_DATE_TOLERANCE_DAYS
+        )
+        if (status, sub.id) != (user['subscription_status'], user['stripe_subscription_id']) or not end_matches:
+            corrections.append((user['user_id'], status, end, sub.id))
+
+    return corrections, missing
+
+
+def reconcile_subscriptions(dry_run: bool = False) -> dict:
+    """Esegue la riconciliazione completa e restituisce il report."""
+    started = time.monotonic()
+
+    stripe_subs = fetch_stripe_subscriptions()
+    users = get_billing_snapshot()
+    corrections, missing = diff_subscriptions(users, stripe_subs)
+
+    local = {u['user_id']: u for u in users}
+    updated = 0 if dry_run else apply_subscription_corrections(corrections)
+
+    report = {
+        'dry_run': dry_run,
+        'stripe_subscriptions': len(stripe_subs),
+        'local_users': len(users),
+        'corrections': len(corrections),
+        'updated': updated,
+        'activated': sum(1 for c in corrections if c[1] == 'active' and local[c[0]]['subscription_status'] != 'active'),
+        'expired': sum(1 for c in corrections if c[1] == 'expired' and local[c[0]]['subscription_status'] == 'active'),
+        'missing_in_stripe': len(missing),
+        'sample': [
+            {
+                'user_id': user_id,
+                'status': (local[user_id]['subscription_status'], status),
+                'subscription_end': (local[user_id]['subscription_end'], end),
+            }
+            for user_id, status, end, _ in corrections[:REPORT_SAMPLE_SIZE]
+        ],
+        'seconds': round(time.monotonic() - started, 2),
+    }
+
+    logger.info(
+        f"Riconciliazione{' (prova)' if dry_run else ''}: "
+        f"{report['corrections']} correzioni su {report['local_users']} utenti, "
+        f"{report['stripe_subscriptions']} abbonamenti Stripe in {report['seconds']}s"
+    )
+    return report
+
+
+def format_report(report: dict) -> str:
+    """Report leggibile (testo semplice) per admin e riga di comando."""
+    lines = [
+        "🔄 RICONCILIAZIONE ABBONAMENTI" + (" (PROVA)" if report['dry_run'] else ""),
+        "",
+        f"Abbonamenti Stripe: {report['stripe_subscriptions']}",
+        f"Utenti con cliente Stripe: {report['local_users']}",
+        f"Correzioni: {report['corrections']} (applicate: {report['updated']})",
+        f"• riattivati: {report['activated']}",
+        f"• scaduti: {report['expired']}",
+        f"Clienti senza abbonamento su Stripe: {report['missing_in_stripe']}",
+        f"Durata: {report['seconds']}s",
+    ]
+    if report['sample']:
+        lines.append("")
+        for item in report['sample']:
+            old_status, new_status = item['status']
+            old_end, new_end = item['subscription_end']
+            lines.append(f"{item['user_id']}: {old_status} → {new_status}, {old_end} → {new_end}")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    print(format_report(reconcile_subscriptions(dry_run='--prova' in sys.argv[1:])))
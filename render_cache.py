@@ -0,0 +1,77 @@
+"""
+MODIFICHE MESSAGGI SOLO SE CAMBIATI - OPERAZIONE RISVEGLIO
+===========================================================
+Ricorda un hash dell'ultimo contenuto mostrato per ogni messaggio
+(chat_id, message_id) e salta le chiamate edit_message_text che non
+cambierebbero nulla (doppi tocchi, "Indietro" o "Il Mio Stato" premuti
+di nuovo), evitando anche l'errore "message is not modified".
+
+IMPORTANTE: tutte le modifiche ai messaggi delle callback devono passare
+da edit_message(), altrimenti l'hash memorizzato non sarebbe più affidabile.
+"""
+
+import hashlib
+import json
+import logging
+from typing import Optional
+
+from telegram import CallbackQuery, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+import metrics
+from cache import LRUCache
+from config import RENDER_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# (chat_id, message_id) -> hash dell'ultimo contenuto mostrato
+_rendered = LRUCache(maxsize=RENDER_CACHE_SIZE)
+
+
+def render_digest(text: str, parse_mode: Optional[str] = None,
+                  reply_markup: Optional[InlineKeyboardMarkup] = None) -> str:
+    """Hash del contenuto di un messaggio (testo, formattazione e tastiera)."""
+    payload = json.dumps(
+        [text, parse_mode, reply_markup.to_dict() if reply_markup else None],
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def last_render(chat_id: int, message_id: int) -> Optional[str]:
+    """Hash dell'ultimo contenuto mostrato nel messaggio (None se sconosciuto)."""
+    return _rendered.get((chat_id, message_id))
+
+
+async def edit_message(query: CallbackQuery, text: str, parse_mode: Optional[str] = None,
+                       reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+    """
+    Modifica il messaggio della callback solo se il contenuto è diverso
+    da quello già mostrato. Restituisce True se il messaggio è stato modificato.
+    """
+    message = query.message
+    if message is None:
+        # Messaggi inline: nessun identificativo stabile, modifica sempre
+        await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+        return True
+
+    key = (message.chat_id, message.message_id)
+    digest = render_digest(text, parse_mode, reply_markup)
+
+    if _rendered.get(key) == digest:
+        metrics.inc('message_edit_skipped_total')
+        return False
+
+    try:
+        await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            raise
+        # Contenuto già identico (es. messaggio inviato con reply_text)
+        metrics.inc('message_edit_not_modified_total')
+        _rendered.set(key, digest)
+        return False
+
+    _rendered.set(key, digest)
+    metrics.inc('message_edit_total')
+    return True
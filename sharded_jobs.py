@@ -0,0 +1,126 @@
+"""
+TASK SCHEDULATI SUDDIVISI IN FETTE - OPERAZIONE RISVEGLIO
+==========================================================
+I task giornalieri (promemoria di scadenza, disattivazione abbonamenti
+scaduti) non vengono più eseguiti in un'unica raffica: gli utenti sono
+divisi in fette (user_id modulo N) elaborate a intervalli regolari
+all'interno di una finestra temporale configurabile.
+
+L'avanzamento di ogni fetta è salvato nella tabella job_progress, così
+dopo un riavvio vengono riprese solo le fette non ancora completate.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import metrics
+from config import TIMEZONE
+from database import plan_job_shards, get_incomplete_job_shards, complete_job_shard
+
+logger = logging.getLogger(__name__)
+
+# Funzione che elabora una fetta: (context, shard, shards) -> (elaborati, falliti)
+ShardProcessor = Callable[[object, int, int], Awaitable[Tuple[int, int]]]
+
+
+class ShardedJob:
+    """Task schedulato eseguito in `shards` fette distribuite su `window_minutes`."""
+
+    def __init__(self, name: str, process_shard: ShardProcessor,
+                 shards: int = 1, window_minutes: float = 0,
+                 should_run: Optional[Callable[[], bool]] = None):
+        self.name = name
+        self.process_shard = process_shard
+        # Controllato prima di ogni fetta (es. questa replica è ancora leader?)
+        self.should_run = should_run
+        self.shards = max(1, shards)
+        self.window_seconds = max(0.0, window_minutes * 60)
+        self._tasks = set()
+        # Fette già pianificate in questo processo: (run_key, shard)
+        self._scheduled = set()
+
+    @staticmethod
+    def run_key() -> str:
+        """
+        Identificativo dell'esecuzione: una al giorno, nel fuso orario dello
+        scheduler (su un server in UTC il giro delle 00:05 avrebbe la data
+        del giorno prima, e resume() cercherebbe la chiave sbagliata).
+        """
+        return datetime.now(ZoneInfo(TIMEZONE)).date().isoformat()
+
+    async def start(self, context):
+        """Avvio dal cron: pianifica tutte le fette non ancora completate oggi."""
+        run_key = self.run_key()
+        pending = await asyncio.to_thread(plan_job_shards, self.name, run_key, self.shards)
+        self._schedule(context, run_key, pending)
+
+    async def resume(self, context):
+        """Riprende le fette rimaste in sospeso dall'esecuzione di oggi."""
+        run_key = self.run_key()
+        pending = await asyncio.to_thread(get_incomplete_job_shards, self.name, run_key)
+        if pending:
+            logger.info(f"Task {self.name}: riprendo {len(pending)} fette in sospeso ({run_key})")
+            self._schedule(context, run_key, pending)
+
+    def _schedule(self, context, run_key: str, pending: list):
+        # Evita doppioni se la stessa replica riprende fette ancora in attesa
+        pending = [shard for shard in pending if (run_key, shard) not in self._scheduled]
+        if not pending:
+            logger.info(f"Task {self.name}: nessuna fetta da elaborare ({run_key})")
+            return
+
+        step = self.window_seconds / len(pending)
+        for i, shard in enumerate(pending):
+            self._scheduled.add((run_key, shard))
+            task = asyncio.create_task(self._run_shard(context, run_key, shard, delay=i * step))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        logger.info(
+            f"Task {self.name}: {len(pending)} fette pianificate in "
+            f"{self.window_seconds / 60:.0f} minuti ({run_key})"
+        )
+
+    async def _run_shard(self, context, run_key: str, shard: int, delay: float):
+        try:
+            await self._process(context, run_key, shard, delay)
+        finally:
+            self._scheduled.discard((run_key, shard))
+
+    async def _process(self, context, run_key: str, shard: int, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.should_run and not self.should_run():
+            # La fetta resta incompleta: la riprenderà la replica leader
+            logger.info(f"Task {self.name}: fetta {shard} saltata (replica non leader)")
+            return
+
+        started = time.monotonic()
+        try:
+            processed, failed = await self.process_shard(context, shard, self.shards)
+        except Exception as e:
+            # La fetta resta incompleta e verrà ripresa al prossimo avvio
+            logger.error(f"Task {self.name}: errore nella fetta {shard}/{self.shards}: {e}")
+            metrics.inc('scheduled_shard_errors_total', job=self.name)
+            return
+
+        elapsed = time.monotonic() - started
+        await asyncio.to_thread(complete_job_shard, self.name, run_key, shard, processed, failed)
+
+        metrics.observe('scheduled_shard_seconds', elapsed, job=self.name)
+        metrics.inc('scheduled_shard_processed_total', processed, job=self.name)
+        metrics.inc('scheduled_shard_failed_total', failed, job=self.name)
+        logger.info(
+            f"Task {self.name}: fetta {shard + 1}/{self.shards} completata in {elapsed:.2f}s "
+            f"({processed} elaborati, {failed} falliti)"
+        )
+
+    def cancel(self):
+        """Annulla le fette ancora in attesa (restano da riprendere)."""
+        for task in list(self._tasks):
+            task.cancel()
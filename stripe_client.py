@@ -0,0 +1,107 @@
+"""
+CLIENT HTTP STRIPE - OPERAZIONE RISVEGLIO
+==========================================
+Configura la libreria stripe con un unico client HTTP condiviso:
+
+- una sola requests.Session con pool di connessioni keep-alive verso
+  api.stripe.com (niente handshake TLS a ogni pagamento);
+- timeout di rete e nuovi tentativi automatici della libreria stripe
+  (attesa esponenziale con jitter);
+- un limite alle chiamate contemporanee, così un picco di pagamenti non
+  occupa tutti i thread del bot.
+
+Tutte le chiamate API di payments.py e reconcile.py passano da call().
+Dal codice asincrono si usano acall() (una chiamata API) e arun() (una
+funzione bloccante di payments.py): il limite di concorrenza vale già
+nell'event loop, così un picco di pagamenti non occupa i thread del
+pool predefinito che servono anche al database.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Optional
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+
+import metrics
+from config import (
+    STRIPE_SECRET_KEY, STRIPE_MAX_CONCURRENCY, STRIPE_TIMEOUT, STRIPE_MAX_RETRIES, STRIPE_API_BASE
+)
+
+logger = logging.getLogger(__name__)
+
+# Configura la chiave API di Stripe
+stripe.api_key = STRIPE_SECRET_KEY
+if STRIPE_API_BASE:
+    # Server Stripe finto (fake_stripe.py) per test e simulazioni
+    stripe.api_base = STRIPE_API_BASE
+
+# Sessione condivisa da tutti i thread: le connessioni restano aperte e
+# vengono riusate (una per chiamata contemporanea al massimo)
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_MAX_CONCURRENCY))
+
+stripe.default_http_client = stripe.http_client.RequestsClient(timeout=STRIPE_TIMEOUT, session=_session)
+stripe.max_network_retries = STRIPE_MAX_RETRIES
+
+_slots = threading.BoundedSemaphore(STRIPE_MAX_CONCURRENCY)
+# Stesso limite per il codice asincrono: chi aspetta resta nell'event loop
+# invece di bloccare un thread (creato al primo uso, nel loop del bot)
+_async_slots: Optional[asyncio.Semaphore] = None
+
+
+def _call_name(func) -> str:
+    owner = getattr(func, '__self__', None)
+    if isinstance(owner, type):
+        return f"{owner.__name__}.{func.__name__}"
+    return func.__name__
+
+
+def call(func, *args, **kwargs):
+    """Esegue una chiamata API Stripe (bloccante) rispettando il limite di concorrenza."""
+    name = _call_name(func)
+    started = time.monotonic()
+    with _slots:
+        metrics.observe('stripe_slot_wait_seconds', time.monotonic() - started)
+        outcome = 'ok'
+        try:
+            return func(*args, **kwargs)
+        except stripe.error.StripeError:
+            outcome = 'error'
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.observe('stripe_call_seconds', elapsed, method=name, outcome=outcome)
+            metrics.record_call('stripe', elapsed)
+
+
+async def arun(func, *args, timeout: float = STRIPE_TIMEOUT, **kwargs):
+    """
+    Esegue in un thread una funzione bloccante che usa Stripe (es.
+    payments.get_checkout_url), al massimo STRIPE_MAX_CONCURRENCY alla volta.
+    Dopo `timeout` secondi la chiamata viene abbandonata (asyncio.TimeoutError).
+    """
+    global _async_slots
+    if _async_slots is None:
+        _async_slots = asyncio.Semaphore(STRIPE_MAX_CONCURRENCY)
+    started = time.monotonic()
+    async with _async_slots:
+        metrics.observe('stripe_async_slot_wait_seconds', time.monotonic() - started)
+        return await asyncio.wait_for(asyncio.to_thread(func, *args, **kwargs), timeout)
+
+
+async def acall(func, *args, timeout: float = STRIPE_TIMEOUT, **kwargs):
+    """Versione asincrona di call() (una singola chiamata API Stripe)."""
+    return await arun(call, func, *args, timeout=timeout, **kwargs)
+
+
+def warm_up():
+    """Apre in anticipo una connessione verso Stripe (da chiamare all'avvio)."""
+    try:
+        _session.head(stripe.api_base, timeout=STRIPE_TIMEOUT)
+    except requests.RequestException as e:
+        logger.warning(f"Connessione preventiva a Stripe non riuscita: {e}")
@@ -0,0 +1,80 @@
+"""
+ELABORAZIONE CONCORRENTE DEGLI UPDATE - OPERAZIONE RISVEGLIO
+=============================================================
+Processore di update per python-telegram-bot che elabora in parallelo
+gli update di utenti diversi, mantenendo l'ordine stretto per gli update
+dello stesso utente (necessario per i ConversationHandler di consenso e
+supporto, che non sono sicuri con update concorrenti dello stesso utente).
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def _sequence_key(update: object) -> Optional[int]:
+    """
+    Restituisce la chiave di serializzazione di un update: l'ID utente se
+    presente, altrimenti l'ID della chat. None = nessun vincolo d'ordine.
+    """
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Elabora fino a `max_concurrent_updates` update contemporaneamente,
+    ma al massimo uno per utente. Gli update dello stesso utente attendono
+    il proprio turno in ordine di arrivo (asyncio.Lock è FIFO) senza occupare
+    uno slot globale, così un utente lento non blocca gli altri.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # chiave -> [lock, numero di update in coda/in corso]
+        self._user_locks = {}
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = _sequence_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+
+        try:
+            # Prima il turno dell'utente, poi lo slot globale
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                # Nessun altro update in coda: libera la memoria
+                del self._user_locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        logger.info(f"Update processor avviato (max {self.max_concurrent_updates} update concorrenti)")
+
+    async def shutdown(self) -> None:
+        self._user_locks.clear()
+
+    @property
+    def active_users(self) -> int:
+        """Numero di utenti con almeno un update in coda o in elaborazione."""
+        return len(self._user_locks)
@@ -3,92 +3,290 @@ WEBHOOK SERVER - OPERAZIONE RISVEGLIO
 ======================================
 Server per ricevere i webhook da Stripe e attivare gli abbonamenti.
 
-Per avviare: python webhook.py
+Gira nello stesso event loop del bot (avviato da on_startup in bot.py):
+condivide il pool di connessioni al database e usa application.bot per
+avvisare gli utenti. Le chiamate sincrone (database, Stripe) vengono
+eseguite con asyncio.to_thread per non bloccare il bot.
+
+Ogni evento viene solo verificato e salvato nella tabella stripe_events
+(chiave: id dell'evento), poi si risponde subito 200. Le consegne ripetute
+da Stripe vengono ignorate. Un worker in background elabora gli eventi
+una sola volta, con nuovi tentativi e scarto dopo troppi errori.
+
+Espone anche le esportazioni CSV per gli amministratori
+(/admin/export/{tabella}, vedi copy_export.py) e le metriche in formato
+Prometheus (/metrics con METRICS_TOKEN, vedi instrumentation.py).
+
+Per avviarlo da solo (senza notifiche Telegram): python webhook.py
 """
 
-from aiohttp import web
+import asyncio
+import hmac
 import logging
+import time
+from typing import Optional
+
+import stripe
+from aiohttp import web
+
+import metrics
+from copy_export import export_handler
+from config import (
+    MESSAGES, METRICS_TOKEN, STRIPE_EVENT_BATCH_SIZE, STRIPE_EVENT_MAX_ATTEMPTS, STRIPE_EVENT_POLL_SECONDS,
+    STRIPE_EVENT_LEASE_SECONDS, STRIPE_EVENT_RETRY_SECONDS
+)
 from payments import verify_webhook_signature, handle_webhook_event
-from database import activate_subscription, deactivate_subscription, record_payment
+from database import (
+    get_user, store_stripe_event, claim_stripe_events, apply_stripe_event, fail_stripe_event
+)
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Chiavi dell'app aiohttp
+APPLICATION_KEY = 'telegram_application'
+WORKER_KEY = 'stripe_event_worker'
+
+# Azioni che modificano il database e richiedono un utente
+USER_ACTIONS = ('activate_subscription', 'renew_subscription', 'cancel_subscription')
+
+# Ritardo massimo tra due tentativi (secondi)
+MAX_RETRY_DELAY = 3600
+
 
 async def stripe_webhook(request):
     """
     Endpoint che riceve i webhook da Stripe.
-    
+
     Configurazione su Stripe:
     1. dashboard.stripe.com > Sviluppatori > Webhook
     2. Aggiungi endpoint
-    3. URL: https://tuo-dominio.railway.app/webhook
-    4. Eventi: checkout.session.completed, invoice.payment_succeeded, 
+    3. URL: https://tuo-dominio.railway.app/webhook (oppure /webhook/stripe)
+    4. Eventi: checkout.session.completed, invoice.payment_succeeded,
        invoice.payment_failed, customer.subscription.deleted
     """
+    started = time.monotonic()
     payload = await request.read()
     sig_header = request.headers.get('Stripe-Signature')
-    
+
     try:
         event = verify_webhook_signature(payload, sig_header)
-        result = handle_webhook_event(event)
-        
-        if result['action'] == 'activate_subscription':
-            activate_subscription(
-                user_id=result['user_id'],
-                stripe_customer_id=result['details']['customer_id'],
-                stripe_subscription_id=result['details'].get('subscription_id')
-            )
-            record_payment(
-                user_id=result['user_id'],
-                stripe_payment_id=event['id'],
-                amount=result['details']['amount_total'],
-                status='succeeded'
-            )
-            logger.info(f"Abbonamento attivato per utente {result['user_id']}")
-        
-        elif result['action'] == 'renew_subscription':
-            activate_subscription(
-                user_id=result['user_id'],
-                stripe_customer_id=result['details'].get('customer_id', ''),
-                stripe_subscription_id=result['details'].get('subscription_id')
-            )
-            logger.info(f"Abbonamento rinnovato per utente {result['user_id']}")
-        
-        elif result['action'] == 'cancel_subscription':
-            deactivate_subscription(result['user_id'])
-            logger.info(f"Abbonamento cancellato per utente {result['user_id']}")
-        
-        elif result['action'] == 'payment_failed':
-            logger.warning(f"Pagamento fallito per utente {result['user_id']}")
-        
-        return web.Response(status=200)
-        
-    except ValueError as e:
-        logger.error(f"Payload non valido: {e}")
+    except (ValueError, stripe.error.SignatureVerificationError):
+        metrics.inc('stripe_webhook_total', outcome='invalid')
         return web.Response(status=400)
+
+    try:
+        inserted = await asyncio.to_thread(
+            store_stripe_event, event['id'], event['type'], payload.decode('utf-8')
+        )
     except Exception as e:
-        logger.error(f"Errore webhook: {e}")
+        # Senza salvataggio l'evento andrebbe perso: Stripe lo ritenterà
+        logger.error(f"Errore salvataggio evento {event['id']}: {e}")
+        metrics.inc('stripe_webhook_total', outcome='error')
         return web.Response(status=500)
 
+    if inserted:
+        request.app[WORKER_KEY].wake()
+    else:
+        logger.info(f"Evento {event['id']} già ricevuto, ignorato")
+
+    metrics.inc('stripe_webhook_total', outcome='stored' if inserted else 'duplicate')
+    metrics.observe('stripe_webhook_seconds', time.monotonic() - started)
+    return web.Response(status=200)
+
+
+class StripeEventWorker:
+    """Elabora in background gli eventi salvati in stripe_events."""
+
+    def __init__(self, application=None,
+                 batch_size: int = STRIPE_EVENT_BATCH_SIZE,
+                 max_attempts: int = STRIPE_EVENT_MAX_ATTEMPTS,
+                 poll_interval: float = STRIPE_EVENT_POLL_SECONDS,
+                 lease_seconds: int = STRIPE_EVENT_LEASE_SECONDS,
+                 retry_delay: float = STRIPE_EVENT_RETRY_SECONDS):
+        self.application = application
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def wake(self):
+        """Segnala un nuovo evento da elaborare."""
+        self._wakeup.set()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                processed = await self.run_once()
+            except Exception as e:
+                logger.error(f"Worker eventi Stripe: errore database: {e}")
+                processed = 0
+
+            # Coda svuotata: attendi un nuovo evento o il prossimo controllo
+            # (nuovi tentativi ed eventi di altre repliche)
+            if processed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def run_once(self) -> int:
+        """Elabora un blocco di eventi. Restituisce quanti ne ha presi in carico."""
+        events = await asyncio.to_thread(claim_stripe_events, self.batch_size, self.lease_seconds)
+        for row in events:
+            await self._process(row)
+        return len(events)
+
+    async def _process(self, row: dict):
+        event_id = row['event_id']
+        try:
+            result = await asyncio.to_thread(handle_webhook_event, row['payload'])
+            if result['action'] in USER_ACTIONS and not result['user_id']:
+                raise ValueError("telegram_user_id non trovato")
+            end_date = await asyncio.to_thread(
+                apply_stripe_event, event_id, result['action'], result['user_id'], result['details']
+            )
+        except LookupError:
+            # Già elaborato da un altro worker
+            metrics.inc('stripe_events_total', outcome='duplicate')
+            return
+        except Exception as e:
+            delay = min(self.retry_delay * 2 ** (row['attempts'] - 1), MAX_RETRY_DELAY)
+            status = await asyncio.to_thread(
+                fail_stripe_event, event_id, str(e), self.max_attempts, delay
+            )
+            if status == 'dead':
+                logger.error(
+                    f"Evento {event_id} ({row['event_type']}) scartato dopo "
+                    f"{row['attempts']} tentativi: {e}"
+                )
+                metrics.inc('stripe_events_total', outcome='dead')
+            else:
+                logger.warning(
+                    f"Evento {event_id} ({row['event_type']}) fallito "
+                    f"(tentativo {row['attempts']}), riprovo tra {delay:.0f}s: {e}"
+                )
+                metrics.inc('stripe_events_total', outcome='retry')
+            return
+
+        metrics.inc('stripe_events_total', outcome='done')
+        log_webhook_result(result)
+
+        if result['action'] == 'activate_subscription' and end_date:
+            await notify_payment_success(self.application, result['user_id'])
+
+
+def log_webhook_result(result: dict):
+    action = result['action']
+    user_id = result['user_id']
+    if action == 'activate_subscription':
+        logger.info(f"Abbonamento attivato per utente {user_id}")
+    elif action == 'renew_subscription':
+        logger.info(f"Abbonamento rinnovato per utente {user_id}")
+    elif action == 'cancel_subscription':
+        logger.info(f"Abbonamento cancellato per utente {user_id}")
+    elif action == 'payment_failed':
+        logger.warning(f"Pagamento fallito per utente {user_id}")
+
+
+async def notify_payment_success(application, user_id: int):
+    """Invia all'utente la conferma del pagamento (se il bot è disponibile)."""
+    if application is None:
+        return
+    try:
+        user = await asyncio.to_thread(get_user, user_id)
+        if not user or not user.get('subscription_end'):
+            return
+        await application.bot.send_message(
+            user_id,
+            MESSAGES['payment_success'].format(
+                name=user.get('first_name') or '',
+                end_date=user['subscription_end'].strftime('%d/%m/%Y')
+            ),
+            parse_mode='Markdown'
+        )
+    except Exception as e:
+        logger.error(f"Errore notifica pagamento a {user_id}: {e}")
+
+
+async def metrics_handler(request):
+    """
+    Metriche del bot nel formato testuale di Prometheus. La porta è quella
+    pubblica dei webhook Stripe: senza METRICS_TOKEN l'endpoint non esiste.
+    """
+    if not METRICS_TOKEN:
+        raise web.HTTPNotFound()
+    expected = f"Bearer {METRICS_TOKEN}"
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected.encode()):
+        raise web.HTTPUnauthorized()
+    return web.Response(
+        body=metrics.render_prometheus().encode('utf-8'),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+    )
+
 
 async def health_check(request):
     """Endpoint per verificare che il server sia attivo."""
     return web.Response(text="OK", status=200)
 
 
-def create_app():
-    """Crea l'applicazione web."""
+def create_app(application=None):
+    """
+    Crea l'applicazione web con il worker degli eventi Stripe.
+    Con `application` (python-telegram-bot) il worker può avvisare gli utenti.
+    """
     app = web.Application()
+    app[APPLICATION_KEY] = application
+    app[WORKER_KEY] = StripeEventWorker(application)
+
+    async def start_worker(app):
+        await app[WORKER_KEY].start()
+
+    async def stop_worker(app):
+        await app[WORKER_KEY].stop()
+
+    app.on_startup.append(start_worker)
+    app.on_cleanup.append(stop_worker)
+
     app.router.add_post('/webhook', stripe_webhook)
+    app.router.add_post('/webhook/stripe', stripe_webhook)
+    app.router.add_get('/admin/export/{table}', export_handler)
+    app.router.add_get('/metrics', metrics_handler)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/', health_check)
     return app
 
 
+async def start_server(application=None, port: int = 8080, host: str = '0.0.0.0') -> web.AppRunner:
+    """Avvia server e worker nell'event loop corrente. Fermarli con runner.cleanup()."""
+    runner = web.AppRunner(create_app(application))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"🌐 Webhook server su porta {port}")
+    return runner
+
+
 if __name__ == '__main__':
-    import os
-    port = int(os.getenv('PORT', 8080))
-    
+    from config import WEBHOOK_PORT
+
+    logging.basicConfig(level=logging.INFO)
+
     app = create_app()
-    logger.info(f"Webhook server avviato sulla porta {port}")
-    web.run_app(app, port=port)
+    logger.info(f"Webhook server avviato sulla porta {WEBHOOK_PORT}")
+    web.run_app(app, port=WEBHOOK_PORT)
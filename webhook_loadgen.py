@@ -0,0 +1,420 @@
+"""
+GENERATORE DI CARICO WEBHOOK STRIPE - OPERAZIONE RISVEGLIO
+===========================================================
+Simula una tempesta di rinnovi di inizio mese sul percorso dei webhook:
+genera eventi Stripe sintetici firmati con STRIPE_WEBHOOK_SECRET e li invia
+a ritmo costante, con una quota di consegne ripetute (come fa Stripe),
+alternando /webhook e /webhook/stripe. Le ripetizioni vanno sull'altro
+percorso, per verificare l'idempotenza tra i due.
+
+Eventi (--mix, pesi relativi):
+    rinnovo     invoice.payment_succeeded (subscription_cycle)
+    fallito     invoice.payment_failed
+    cancellato  customer.subscription.deleted
+    checkout    checkout.session.completed
+
+I clienti vengono creati nel database (utenti attivi) e nello Stripe finto
+(fake_stripe.py), che sostituisce Customer.retrieve. Una quota di clienti
+(--solo-stripe) non ha stripe_customer_id nel database, così il worker
+deve risalire all'utente tramite Stripe.
+
+Report: latenza ed errori HTTP per percorso, stato di elaborazione degli
+eventi, ritardo del worker ed effetti sul database (pagamenti attesi e
+registrati, duplicati). Esce con codice 1 se ci sono errori o effetti
+diversi da quelli attesi.
+
+Uso (server webhook nello stesso processo, database dedicato):
+
+    python webhook_loadgen.py --database-url postgresql://localhost/risveglio_sim --rate 200 --eventi 20000
+
+Contro un server già avviato (con STRIPE_API_BASE che punta a --stripe-porta
+e lo stesso STRIPE_WEBHOOK_SECRET e database):
+
+    python webhook_loadgen.py --url http://127.0.0.1:8080 --database-url ... --stripe-porta 12111
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import ClientError, ClientSession, TCPConnector
+
+import fake_stripe
+from load_simulation import SIM_USER_BASE, cleanup_simulated_users, free_port, percentile
+
+logger = logging.getLogger(__name__)
+
+# Utenti dei clienti simulati (nell'intervallo ripulito da load_simulation)
+LOADGEN_USER_BASE = SIM_USER_BASE + 100_000_000
+
+PATHS = ('/webhook', '/webhook/stripe')
+DEFAULT_MIX = 'rinnovo=85,fallito=10,cancellato=2,checkout=3'
+
+# Tipi di evento che registrano un pagamento (payments.stripe_payment_id = id evento)
+PAYMENT_EVENTS = ('rinnovo', 'fallito', 'checkout')
+
+# Ritardo massimo di una consegna ripetuta rispetto all'originale (secondi)
+MAX_DUPLICATE_DELAY = 2.0
+
+
+def customer_id(user_id: int) -> str:
+    return f"cus_load_{user_id}"
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ('rinnovo', 'fallito', 'cancellato', 'checkout'):
+            raise argparse.ArgumentTypeError(f"tipo di evento sconosciuto: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def build_event(kind: str, user_id: int) -> dict:
+    if kind == 'rinnovo':
+        return fake_stripe.invoice_event('invoice.payment_succeeded', customer_id(user_id))
+    if kind == 'fallito':
+        return fake_stripe.invoice_event('invoice.payment_failed', customer_id(user_id))
+    if kind == 'cancellato':
+        return fake_stripe.subscription_deleted(customer_id(user_id))
+    return fake_stripe.checkout_completed(user_id, customer_id(user_id))
+
+
+def build_plan(args, users: list, rng: random.Random) -> tuple:
+    """
+    Sequenza di invio: [(evento, tipo, percorso, ripetizione)], con le
+    ripetizioni poco dopo l'originale e sull'altro percorso.
+    """
+    kinds, weights = zip(*args.mix.items())
+    unique = []
+    entries = []
+    for i in range(args.eventi):
+        kind = rng.choices(kinds, weights)[0]
+        event = build_event(kind, rng.choice(users))
+        path = args.percorsi[i % len(args.percorsi)]
+        unique.append((event, kind))
+        entries.append((i, (event, kind, path, False)))
+        if rng.random() < args.duplicati:
+            other = args.percorsi[(i + 1) % len(args.percorsi)]
+            offset = rng.uniform(0, MAX_DUPLICATE_DELAY) * args.rate
+            entries.append((i + offset + 0.5, (event, kind, other, True)))
+    entries.sort(key=lambda e: e[0])
+    return [entry for _, entry in entries], unique
+
+
+# =============================================================================
+# DATABASE
+# =============================================================================
+
+def seed_customers(get_connection, count: int, stripe_only: float) -> list:
+    """Crea `count` utenti abbonati; una quota senza cliente Stripe nel database."""
+    every = max(1, round(1 / stripe_only)) if stripe_only > 0 else 0
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        INSERT INTO users (
+            user_id, first_name, approved, consent_completed, subscription_status,
+            subscription_start, subscription_end, stripe_customer_id
+        )
+        SELECT %(base)s + n, 'Carico', TRUE, TRUE, 'active',
+               CURRENT_DATE - 30, CURRENT_DATE,
+               CASE WHEN %(every)s > 0 AND n %% %(every)s = 0 THEN NULL
+                    ELSE 'cus_load_' || (%(base)s + n) END
+        FROM generate_series(1, %(count)s) AS n
+    ''', {'base': LOADGEN_USER_BASE, 'every': every, 'count': count})
+    conn.commit()
+    conn.close()
+    return [LOADGEN_USER_BASE + n for n in range(1, count + 1)]
+
+
+def pending_events(get_connection, event_ids: list) -> int:
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT COUNT(*) AS n FROM stripe_events
+        WHERE event_id = ANY(%s) AND status IN ('pending', 'processing')
+    ''', (event_ids,))
+    count = cur.fetchone()['n']
+    conn.close()
+    return count
+
+
+def database_effects(get_connection, event_ids: list) -> dict:
+    """Stato degli eventi, ritardo di elaborazione e pagamenti registrati."""
+    conn = get_connection()
+    cur = conn.cursor()
+
+    cur.execute('''
+        SELECT status, COUNT(*) AS n FROM stripe_events
+        WHERE event_id = ANY(%s) GROUP BY status
+    ''', (event_ids,))
+    statuses = {row['status']: row['n'] for row in cur.fetchall()}
+
+    cur.execute('''
+        SELECT
+            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM processed_at - received_at)) AS p50,
+            PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM processed_at - received_at)) AS p95,
+            MAX(EXTRACT(EPOCH FROM processed_at - received_at)) AS max
+        FROM stripe_events
+        WHERE event_id = ANY(%s) AND processed_at IS NOT NULL
+    ''', (event_ids,))
+    lag = cur.fetchone()
+
+    cur.execute('''
+        SELECT kind, status, COUNT(*) AS n, COUNT(DISTINCT stripe_payment_id) AS distinct_ids
+        FROM payments WHERE stripe_payment_id = ANY(%s)
+        GROUP BY kind, status
+    ''', (event_ids,))
+    payments = cur.fetchall()
+
+    cur.execute('''
+        SELECT subscription_status, COUNT(*) AS n FROM users
+        WHERE user_id > %s GROUP BY subscription_status
+    ''', (LOADGEN_USER_BASE,))
+    users = {row['subscription_status']: row['n'] for row in cur.fetchall()}
+
+    conn.close()
+    return {
+        'events': statuses,
+        'lag': {k: round(float(v or 0), 3) for k, v in lag.items()},
+        'payments': {f"{p['kind']}/{p['status']}": p['n'] for p in payments},
+        'payment_rows': sum(p['n'] for p in payments),
+        'duplicate_payments': sum(p['n'] - p['distinct_ids'] for p in payments),
+        'users': users,
+    }
+
+
+# =============================================================================
+# INVIO
+# =============================================================================
+
+class LoadGenerator:
+    """Invia il piano di eventi a ritmo costante (senza attendere le risposte)."""
+
+    def __init__(self, base_url: str, secret: str, rate: float):
+        self.base_url = base_url.rstrip('/')
+        self.secret = secret
+        self.rate = rate
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    async def _send(self, http: ClientSession, event: dict, path: str):
+        payload = fake_stripe.encode_event(event)
+        # Ogni consegna (anche ripetuta) ha una firma nuova, come da Stripe
+        headers = {
+            'Stripe-Signature': fake_stripe.sign_payload(payload, self.secret),
+            'Content-Type': 'application/json',
+        }
+        started = time.monotonic()
+        try:
+            async with http.post(self.base_url + path, data=payload, headers=headers) as response:
+                await response.read()
+                status = str(response.status)
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f"Errore invio {event['id']}: {e!r}")
+            status = 'connessione'
+        self.latencies[path].append(time.monotonic() - started)
+        self.statuses[path][status] += 1
+
+    async def run(self, plan: list) -> float:
+        tasks = []
+        started = time.monotonic()
+        async with ClientSession(connector=TCPConnector(limit=0)) as http:
+            for i, (event, _, path, _) in enumerate(plan):
+                delay = started + i / self.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(self._send(http, event, path)))
+            await asyncio.gather(*tasks)
+        return time.monotonic() - started
+
+    def summary(self) -> dict:
+        return {
+            path: {
+                'requests': len(values),
+                'statuses': dict(self.statuses[path]),
+                'errors': sum(n for s, n in self.statuses[path].items() if not s.startswith('2')),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 1),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 1),
+            }
+            for path, values in self.latencies.items()
+        }
+
+
+# =============================================================================
+# AVVIO
+# =============================================================================
+
+def configure_environment(args, ports: dict):
+    """Variabili d'ambiente del server interno (prima di importare config)."""
+    os.environ['DATABASE_URL'] = args.database_url
+    if args.url:
+        # Server esterno: stesso segreto del server sotto test
+        return
+    os.environ.update({
+        'STRIPE_SECRET_KEY': 'sk_test_simulazione',
+        'STRIPE_WEBHOOK_SECRET': 'whsec_simulazione',
+        'STRIPE_API_BASE': f"http://127.0.0.1:{ports['stripe']}",
+        'STRIPE_MAX_RETRIES': '0',
+    })
+
+
+async def generate(args, ports: dict) -> dict:
+    # Moduli del bot importati solo dopo configure_environment()
+    from config import STRIPE_WEBHOOK_SECRET
+    from database import init_db, get_connection, close_pool
+
+    if not STRIPE_WEBHOOK_SECRET:
+        raise SystemExit("STRIPE_WEBHOOK_SECRET non impostato")
+
+    rng = random.Random(args.seed)
+    await asyncio.to_thread(init_db)
+    await asyncio.to_thread(cleanup_simulated_users, get_connection)
+    users = await asyncio.to_thread(seed_customers, get_connection, args.clienti, args.solo_stripe)
+
+    stripe_app = fake_stripe.create_app(args.latenza_stripe / 1000)
+    for user_id in users:
+        fake_stripe.register_customer(stripe_app, customer_id(user_id), user_id)
+    stripe_runner = await fake_stripe.start_server(stripe_app, ports['stripe'])
+
+    webhook_runner = None
+    base_url = args.url
+    if not base_url:
+        from webhook import start_server
+        webhook_runner = await start_server(None, port=ports['webhook'], host='127.0.0.1')
+        base_url = f"http://127.0.0.1:{ports['webhook']}"
+
+    plan, unique = build_plan(args, users, rng)
+    event_ids = [event['id'] for event, _ in unique]
+    generator = LoadGenerator(base_url, STRIPE_WEBHOOK_SECRET, args.rate)
+
+    try:
+        seconds = await generator.run(plan)
+
+        # Attende che il worker abbia elaborato tutti gli eventi
+        wait_started = time.monotonic()
+        while time.monotonic() - wait_started < args.attesa:
+            if not await asyncio.to_thread(pending_events, get_connection, event_ids):
+                break
+            await asyncio.sleep(0.5)
+        drained = time.monotonic() - wait_started
+
+        effects = await asyncio.to_thread(database_effects, get_connection, event_ids)
+    finally:
+        if webhook_runner:
+            await webhook_runner.cleanup()
+        await stripe_runner.cleanup()
+        close_pool()
+
+    kinds = Counter(kind for _, kind in unique)
+    return {
+        'unique_events': len(unique),
+        'duplicates': len(plan) - len(unique),
+        'kinds': dict(kinds),
+        'sent_seconds': round(seconds, 2),
+        'achieved_rate': round(len(plan) / seconds, 1) if seconds else 0.0,
+        'drain_seconds': round(drained, 2),
+        'http': generator.summary(),
+        'expected_payments': sum(kinds[k] for k in PAYMENT_EVENTS),
+        'stripe_calls': dict(stripe_app[fake_stripe.CALLS_KEY]),
+        **effects,
+    }
+
+
+def check_report(report: dict, max_error_rate: float) -> list:
+    """Anomalie del report (lista vuota = percorso webhook corretto)."""
+    problems = []
+    requests = sum(p['requests'] for p in report['http'].values())
+    errors = sum(p['errors'] for p in report['http'].values())
+    if requests and errors / requests > max_error_rate:
+        problems.append(f"{errors} risposte HTTP in errore su {requests}")
+    stored = sum(report['events'].values())
+    if stored != report['unique_events']:
+        problems.append(f"{stored} eventi salvati invece di {report['unique_events']}")
+    for status in ('pending', 'processing', 'dead'):
+        if report['events'].get(status):
+            problems.append(f"{report['events'][status]} eventi in stato {status}")
+    if report['payment_rows'] != report['expected_payments']:
+        problems.append(f"{report['payment_rows']} pagamenti registrati invece di {report['expected_payments']}")
+    if report['duplicate_payments']:
+        problems.append(f"{report['duplicate_payments']} pagamenti duplicati")
+    return problems
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        "⚡ CARICO WEBHOOK STRIPE",
+        "",
+        f"Eventi unici: {report['unique_events']} ({', '.join(f'{k} {n}' for k, n in report['kinds'].items())})",
+        f"Consegne ripetute: {report['duplicates']}",
+        f"Invio: {report['sent_seconds']}s, {report['achieved_rate']} richieste/s",
+        f"Coda smaltita in {report['drain_seconds']}s dopo l'ultimo invio",
+        "",
+    ]
+    for path, p in report['http'].items():
+        lines.append(
+            f"{path}: {p['requests']} richieste, {p['errors']} errori, "
+            f"p50/p95/p99 {p['p50_ms']}/{p['p95_ms']}/{p['p99_ms']} ms, stati {p['statuses']}"
+        )
+    lag = report['lag']
+    lines += [
+        "",
+        f"Eventi nel database: {report['events']}",
+        f"Ritardo elaborazione: p50 {lag['p50']}s, p95 {lag['p95']}s, max {lag['max']}s",
+        f"Pagamenti: {report['payment_rows']} (attesi {report['expected_payments']}) {report['payments']}",
+        f"Pagamenti duplicati: {report['duplicate_payments']}",
+        f"Utenti simulati per stato: {report['users']}",
+        f"Chiamate a Stripe finto: {report['stripe_calls']}",
+    ]
+    return "\n".join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Carico sintetico sul percorso dei webhook Stripe")
+    parser.add_argument('--database-url', default=os.getenv('SIM_DATABASE_URL'),
+                        help="PostgreSQL dedicato (lo stesso del server sotto test)")
+    parser.add_argument('--url', help="server webhook esterno (default: server interno)")
+    parser.add_argument('--stripe-porta', type=int, help="porta dello Stripe finto (default: libera)")
+    parser.add_argument('--rate', type=float, default=100, help="richieste al secondo")
+    parser.add_argument('--eventi', type=int, default=5000, help="eventi unici da generare")
+    parser.add_argument('--clienti', type=int, default=1000, help="clienti simulati")
+    parser.add_argument('--duplicati', type=float, default=0.1, help="quota di consegne ripetute (0-1)")
+    parser.add_argument('--solo-stripe', type=float, default=0.1,
+                        help="quota di clienti noti solo a Stripe (Customer.retrieve)")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument('--percorsi', nargs='+', choices=PATHS, default=list(PATHS))
+    parser.add_argument('--latenza-stripe', type=float, default=0.0, help="latenza dello Stripe finto (ms)")
+    parser.add_argument('--attesa', type=float, default=60, help="attesa massima dell'elaborazione (s)")
+    parser.add_argument('--max-errori', type=float, default=0.0, help="quota massima di errori HTTP")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    if not args.database_url:
+        parser.error("serve --database-url (o SIM_DATABASE_URL): usare un database dedicato")
+
+    ports = {'stripe': args.stripe_porta or free_port(), 'webhook': free_port()}
+    configure_environment(args, ports)
+    report = asyncio.run(generate(args, ports))
+
+    print(format_report(report))
+    problems = check_report(report, args.max_errori)
+    if problems:
+        print("\n❌ ANOMALIE")
+        for problem in problems:
+            print(f"• {problem}")
+        return 1
+    print("\n✅ Tutti gli eventi elaborati una sola volta")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())